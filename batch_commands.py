@@ -0,0 +1,189 @@
+"""
+Run many gdrive-cli commands in one process.
+
+Commands are read one per line as JSON objects such as
+
+    {"id": 1, "command": "rename", "args": ["<file_id>", "<new_title>"]}
+
+where args are those of the gdrive-cli option of the same name
+(download takes a file id and a local filename, like --download-to).
+Every command is answered with one JSON line
+
+    {"id": 1, "command": "rename", "code": 200, "reason": "", "result": {...}}
+
+They all share one warm service object and database session, either
+for a stream on stdin (gdrive-cli --batch) or for the connections of a
+daemon listening on a Unix socket (gdrive-cli --serve).
+"""
+
+from __future__ import print_function
+from gdrive import gdrive
+from db import helper as dbhelper
+import SocketServer
+import contextlib
+import os
+import simplejson
+import socket
+import stat
+import sys
+import traceback
+
+def run_show(service, session, file_id):
+    return gdrive.get_file_instance(service, file_id, fields=None)
+
+def run_download(service, session, file_id, filename):
+    drive_file, code, reason = gdrive.get_file_instance(service, file_id)
+    if not drive_file:
+        return (None, code, reason)
+    size, code, reason = gdrive.download_file_to_path(service, drive_file, filename)
+    if size is None:
+        return (None, code, reason)
+    return ({'size': size}, code, reason)
+
+def run_insert(service, session, title, description, parent_id, mime_type, filename):
+    if parent_id == "none":
+        parent_id = None
+    file, code, reason = gdrive.insert_file(service, title, description, parent_id,
+            mime_type, filename, fields=None)
+    if file:
+        dbhelper.save_file(file, session)
+    return (file, code, reason)
+
+def run_rename(service, session, file_id, new_title):
+    file, code, reason = gdrive.rename_file(service, file_id, new_title)
+    if file:
+        dbhelper.rename_file(file_id, new_title, session)
+    return (file, code, reason)
+
+def run_update(service, session, file_id, new_title, new_description, new_mime_type,
+        new_filename, new_revision):
+    file, code, reason = gdrive.update_file(service, file_id, new_title, new_description,
+            new_mime_type, new_filename, new_revision != "false", fields=None)
+    if file:
+        dbhelper.save_file(file, session)
+    return (file, code, reason)
+
+COMMANDS = {
+    'show': run_show,
+    'download': run_download,
+    'insert': run_insert,
+    'rename': run_rename,
+    'update': run_update,
+}
+
+def run_command(service, session, command):
+    """
+    Runs one decoded command object.
+
+    Returns:
+        the response object for command
+    """
+    response = {'id': command.get('id'), 'command': command.get('command')}
+    fn = COMMANDS.get(command.get('command'))
+    args = command.get('args', [])
+    if fn is None:
+        obj, code, reason = (None, 400, 'unknownCommand')
+    elif not isinstance(args, list) or len(args) != fn.func_code.co_argcount - 2:
+        obj, code, reason = (None, 400, 'badArguments')
+    else:
+        try:
+            obj, code, reason = fn(service, session, *args)
+        except Exception, error:
+            traceback.print_exc(file=sys.stderr)
+            obj, code, reason = (None, 500, repr(error))
+    response.update({'code': code, 'reason': reason, 'result': obj})
+    return response
+
+def run_stream(service, session, infile, outfile):
+    """
+    Answers every command line of infile on outfile, flushing after each
+    response so the caller can wait for it. The gdrive module prints its
+    diagnostics to stdout; they go to stderr meanwhile.
+
+    Returns:
+        number of commands run
+    """
+    count = 0
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        for line in iter(infile.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                command = simplejson.loads(line)
+                if not isinstance(command, dict):
+                    raise ValueError("not an object")
+            except ValueError:
+                response = {'id': None, 'command': None, 'code': 400,
+                        'reason': 'parseError', 'result': None}
+            else:
+                response = run_command(service, session, command)
+            outfile.write(simplejson.dumps(response) + "\n")
+            outfile.flush()
+            session.commit()
+            count += 1
+    finally:
+        sys.stdout = stdout
+    return count
+
+class CommandServer(SocketServer.UnixStreamServer):
+    """
+    Serves command streams on a Unix socket, one connection at a time,
+    so every command runs on the same service object.
+    """
+
+    def __init__(self, socket_path, service, session):
+        self.service = service
+        self.session = session
+        SocketServer.UnixStreamServer.__init__(self, socket_path, CommandHandler)
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        run_stream(self.server.service, self.server.session, self.rfile, self.wfile)
+
+def serve(socket_path, service, session):
+    """
+    Runs a command daemon on socket_path until interrupted. A socket
+    left at socket_path by an earlier daemon is replaced, anything else
+    there is left alone and nothing is served.
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except OSError:
+        mode = None
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            print("not a socket, refusing to replace:", socket_path, file=sys.stderr)
+            return
+        os.remove(socket_path)
+    # only the owner may connect, from the moment the socket exists
+    umask = os.umask(0077)
+    try:
+        server = CommandServer(socket_path, service, session)
+    finally:
+        os.umask(umask)
+    print("serving commands on", socket_path, file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+def forward(socket_path, infile, outfile):
+    """
+    Sends the command lines of infile to the daemon on socket_path and
+    copies its responses to outfile.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    with contextlib.closing(sock):
+        rfile = sock.makefile('rb')
+        wfile = sock.makefile('wb', 0)
+        for line in iter(infile.readline, ''):
+            if not line.strip():
+                continue
+            wfile.write(line.rstrip("\n") + "\n")
+            outfile.write(rfile.readline())
+            outfile.flush()
@@ -0,0 +1,672 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Drive v2 API, for offline benchmarks.
+
+Serves what gdrive/gdrive.py uses: files get/list/insert/patch/update/
+delete/copy, parents insert, changes list and about get; simple,
+multipart and resumable media uploads; ranged downloads; and batch
+requests. Files live in memory. Latency, a bandwidth cap, a request rate
+limit and random 403/503 errors can be injected to exercise the retry
+layer.
+
+    drive = FakeDrive(latency=0.02, error_rate=0.01).start()
+    service = drive.service()
+    ...
+    drive.stop()
+
+usage: python bench/fake_drive.py [--port N] [--latency S] ...
+"""
+
+from __future__ import print_function
+import BaseHTTPServer
+import SocketServer
+import argparse
+import hashlib
+import os
+import random
+import re
+import simplejson
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+################################################################################
+# Discovery document
+################################################################################
+
+def param(type_, location='query', required=False):
+    p = {'type': type_, 'location': location}
+    if required:
+        p['required'] = True
+    return p
+
+def method(id_, path, http_method, params, order=None, request=None, response=None, media=False):
+    m = {'id': id_, 'path': path, 'httpMethod': http_method,
+         'parameters': params, 'parameterOrder': order or []}
+    if request:
+        m['request'] = {'$ref': request}
+    if response:
+        m['response'] = {'$ref': response}
+    if media:
+        m['supportsMediaUpload'] = True
+        m['mediaUpload'] = {'accept': ['*/*'], 'maxSize': '5120GB', 'protocols': {
+            'simple': {'multipart': True, 'path': '/upload/drive/v2/' + path},
+            'resumable': {'multipart': True, 'path': '/resumable/upload/drive/v2/' + path}}}
+    return m
+
+def discovery_document(root):
+    """
+    Returns:
+        a Drive v2 discovery document, reduced to the methods served
+        here, with root as rootUrl
+    """
+    def params(**kw):
+        p = {'fields': param('string')}
+        p.update(kw)
+        return p
+    file_id = {'fileId': param('string', 'path', True)}
+    page = {'maxResults': param('integer'), 'pageToken': param('string')}
+    return {
+        'kind': 'discovery#restDescription', 'discoveryVersion': 'v1',
+        'id': 'drive:v2', 'name': 'drive', 'version': 'v2',
+        'rootUrl': root, 'servicePath': 'drive/v2/', 'batchPath': 'batch',
+        'parameters': {'fields': param('string'), 'alt': param('string')},
+        'schemas': dict((name, {'id': name, 'type': 'object'}) for name in
+                ('File', 'FileList', 'ParentReference', 'ChangeList', 'About')),
+        'resources': {
+            'files': {'methods': {
+                'get': method('drive.files.get', 'files/{fileId}', 'GET',
+                        params(**file_id), ['fileId'], None, 'File'),
+                'list': method('drive.files.list', 'files', 'GET',
+                        params(q=param('string'), **page), [], None, 'FileList'),
+                'insert': method('drive.files.insert', 'files', 'POST',
+                        params(), [], 'File', 'File', media=True),
+                'patch': method('drive.files.patch', 'files/{fileId}', 'PATCH',
+                        params(**file_id), ['fileId'], 'File', 'File'),
+                'update': method('drive.files.update', 'files/{fileId}', 'PUT',
+                        params(newRevision=param('boolean'), **file_id), ['fileId'],
+                        'File', 'File', media=True),
+                'delete': method('drive.files.delete', 'files/{fileId}', 'DELETE',
+                        params(**file_id), ['fileId']),
+                'copy': method('drive.files.copy', 'files/{fileId}/copy', 'POST',
+                        params(**file_id), ['fileId'], 'File', 'File'),
+            }},
+            'parents': {'methods': {
+                'insert': method('drive.parents.insert', 'files/{fileId}/parents', 'POST',
+                        params(**file_id), ['fileId'], 'ParentReference', 'ParentReference'),
+            }},
+            'changes': {'methods': {
+                'list': method('drive.changes.list', 'changes', 'GET',
+                        params(startChangeId=param('string'), includeDeleted=param('boolean'),
+                            **page), [], None, 'ChangeList'),
+            }},
+            'about': {'methods': {
+                'get': method('drive.about.get', 'about', 'GET', params(), [], None, 'About'),
+            }},
+        },
+    }
+
+################################################################################
+# Requests
+################################################################################
+
+class Response(object):
+    def __init__(self, status, body='', headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.obj = None
+
+def json_response(obj, status=200):
+    response = Response(status, simplejson.dumps(obj), {'Content-Type': 'application/json'})
+    response.obj = obj
+    return response
+
+def error_response(status, reason, message=''):
+    return json_response({'error': {'code': status, 'message': message or reason,
+            'errors': [{'domain': 'global', 'reason': reason, 'message': message or reason}]}},
+            status)
+
+def rfc3339(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + '.%03dZ' % (t % 1 * 1000)
+
+def parse_multipart(content_type, body):
+    """
+    Splits a multipart body into (headers dict, payload) parts without
+    touching the payloads, which may be binary.
+    """
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+    parts = []
+    for chunk in body.split('--' + boundary)[1:]:
+        if chunk.startswith('--'):
+            break
+        chunk = chunk.lstrip('\r\n')
+        match = re.search(r'\r?\n\r?\n', chunk)
+        head, payload = chunk[:match.start()], chunk[match.end():]
+        if payload.endswith('\r\n'):
+            payload = payload[:-2]
+        elif payload.endswith('\n'):
+            payload = payload[:-1]
+        headers = {}
+        for line in re.split(r'\r?\n', head):
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        parts.append((headers, payload))
+    return parts
+
+def parse_fields(fields):
+    """
+    Returns:
+        dict mapping each field of a partial response selector such as
+        'nextPageToken,items(id,parents(id))' to the dict of its
+        subfields, or to None for the whole field
+    """
+    def parse(pos):
+        selected = {}
+        name = ''
+        while pos < len(fields):
+            c = fields[pos]
+            pos += 1
+            if c == '(':
+                selected[name.strip()], pos = parse(pos)
+                name = None
+            elif c == ')':
+                break
+            elif c == ',':
+                if name and name.strip():
+                    selected[name.strip()] = None
+                name = ''
+            elif name is not None:
+                name += c
+        if name and name.strip():
+            selected[name.strip()] = None
+        return selected, pos
+    return parse(0)[0]
+
+def project(obj, selected):
+    """Keeps the selected fields of obj, see parse_fields."""
+    if selected is None:
+        return obj
+    if isinstance(obj, list):
+        return [project(item, selected) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    return dict((name, project(obj[name], sub)) for name, sub in selected.items() if name in obj)
+
+# Clauses of the files.list queries gdrive.py sends, all joined by 'and'
+QUERY_CLAUSE = re.compile(
+        r"(?P<field>title|mimeType)\s*(?P<op>=|!=)\s*'(?P<value>(?:[^'\\]|\\.)*)'"
+        r"|'(?P<parent>(?:[^'\\]|\\.)*)'\s+in\s+parents"
+        r"|trashed\s*=\s*(?P<trashed>true|false)")
+
+def compile_query(q):
+    """
+    Returns:
+        a predicate on file metadata implementing query q
+    """
+    tests = []
+    for m in QUERY_CLAUSE.finditer(q or ''):
+        if m.group('field'):
+            field, value = m.group('field'), m.group('value').replace("\\'", "'")
+            if m.group('op') == '=':
+                tests.append(lambda f, field=field, value=value: f.get(field) == value)
+            else:
+                tests.append(lambda f, field=field, value=value: f.get(field) != value)
+        elif m.group('parent') is not None:
+            parent = m.group('parent')
+            tests.append(lambda f, parent=parent: parent in [p['id'] for p in f['parents']])
+        else:
+            trashed = m.group('trashed') == 'true'
+            tests.append(lambda f, trashed=trashed: f['labels']['trashed'] == trashed)
+    return lambda f: all(test(f) for test in tests)
+
+class FakeDrive(object):
+    """In-memory Drive served over HTTP on localhost.
+
+    Args:
+        port: port to listen on; 0 picks a free one.
+        latency: seconds added to every HTTP request.
+        bandwidth: bytes per second that request and response bodies are
+            held to, None for no limit.
+        qps: requests per second (batch parts included) above which
+            requests fail with 403 rateLimitExceeded, None for no limit.
+        error_rate: probability of a 403 userRateLimitExceeded per request.
+        server_error_rate: probability of a 503 backendError per request.
+        seed: random seed for the injected errors.
+    """
+
+    def __init__(self, port=0, latency=0.0, bandwidth=None, qps=None, error_rate=0.0,
+                 server_error_rate=0.0, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.qps = qps
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.files = {}
+        self.order = []
+        self.content = {}
+        self.sessions = {}
+        self.changes = []
+        self.next_id = 0
+        self.counts = {}
+        self.window = (0, 0)
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+        self.server.drive = self
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-drive")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.close_connections()
+
+    def discovery_document(self):
+        return discovery_document(self.url + '/')
+
+    def service(self):
+        """
+        Returns:
+            a Drive service object talking to this server over its own
+            connection
+        """
+        from apiclient.discovery import build_from_document
+        from gdrive.gdrive import DriveRequest, new_http
+        return build_from_document(simplejson.dumps(self.discovery_document()),
+                http=new_http(), requestBuilder=DriveRequest)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def injected_error(self):
+        """
+        Returns:
+            an error Response if this request is to fail, else None
+        """
+        with self.lock:
+            if self.qps:
+                second = int(time.time())
+                start, count = self.window
+                if start != second:
+                    start, count = second, 0
+                self.window = (start, count + 1)
+                if count >= self.qps:
+                    self.counts['throttled'] = self.counts.get('throttled', 0) + 1
+                    return error_response(403, 'rateLimitExceeded', 'Rate Limit Exceeded')
+            draw = self.random.random()
+        if draw < self.error_rate:
+            self.count('injected_403')
+            return error_response(403, 'userRateLimitExceeded', 'User Rate Limit Exceeded')
+        if draw < self.error_rate + self.server_error_rate:
+            self.count('injected_503')
+            return error_response(503, 'backendError', 'Backend Error')
+        return None
+
+    ############################################################################
+    # Files
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return 'fake%07d' % self.next_id
+
+    def record_change(self, file_id, deleted=False):
+        self.changes.append({'kind': 'drive#change', 'id': str(len(self.changes) + 1),
+                'fileId': file_id, 'deleted': deleted,
+                'file': None if deleted else self.files[file_id]})
+
+    def set_content(self, f, content):
+        self.content[f['id']] = content
+        f['fileSize'] = str(len(content))
+        f['md5Checksum'] = hashlib.md5(content).hexdigest()
+        f['downloadUrl'] = '%s/download/%s' % (self.url, f['id'])
+        f['modifiedDate'] = f['modifiedByMeDate'] = rfc3339(time.time())
+
+    def apply_metadata(self, f, body):
+        for key in ('title', 'description', 'mimeType'):
+            if key in body:
+                f[key] = body[key]
+        if 'parents' in body:
+            f['parents'] = [self.parent_reference(p['id']) for p in body['parents']]
+        if 'labels' in body:
+            f['labels'].update(body['labels'])
+        ext = os.path.splitext(f['title'])[1]
+        f['fileExtension'] = ext[1:] if f['mimeType'] != FOLDER_MIMETYPE else ''
+
+    def parent_reference(self, parent_id):
+        return {'kind': 'drive#parentReference', 'id': parent_id,
+                'parentLink': '%s/drive/v2/files/%s' % (self.url, parent_id),
+                'isRoot': parent_id == 'root'}
+
+    def insert(self, body, content=None):
+        now = rfc3339(time.time())
+        f = {'kind': 'drive#file', 'id': self.new_id(), 'title': 'Untitled',
+             'mimeType': 'application/octet-stream', 'description': '',
+             'parents': [self.parent_reference('root')],
+             'labels': {'hidden': False, 'starred': False, 'trashed': False},
+             'createdDate': now, 'modifiedDate': now, 'modifiedByMeDate': now,
+             'lastViewedByMeDate': now,
+             'userPermission': {'kind': 'drive#permission', 'etag': '"owner"',
+                 'role': 'owner', 'type': 'user'}}
+        f['etag'] = '"%s"' % f['id']
+        with self.lock:
+            self.apply_metadata(f, body)
+            if content is not None:
+                self.set_content(f, content)
+            self.files[f['id']] = f
+            self.order.append(f['id'])
+            self.record_change(f['id'])
+        return f
+
+    def update(self, file_id, body, content=None):
+        with self.lock:
+            f = self.files.get(file_id)
+            if f is None:
+                return None
+            self.apply_metadata(f, body)
+            if content is not None:
+                self.set_content(f, content)
+            self.record_change(file_id)
+            return f
+
+    def delete(self, file_id):
+        with self.lock:
+            if self.files.pop(file_id, None) is None:
+                return False
+            self.order.remove(file_id)
+            self.content.pop(file_id, None)
+            self.record_change(file_id, deleted=True)
+            return True
+
+    def list_page(self, items, query):
+        start = int(query.get('pageToken', 0))
+        count = min(int(query.get('maxResults', 100)), 1000)
+        page = {'items': items[start:start + count]}
+        if start + count < len(items):
+            page['nextPageToken'] = str(start + count)
+        return page
+
+    ############################################################################
+    # Dispatch
+
+    def handle(self, verb, uri, headers, body):
+        """
+        Answers one API request, also for the parts of a batch, with the
+        partial response its fields parameter asks for.
+
+        Returns:
+            a Response
+        """
+        response = self.route(verb, uri, headers, body)
+        fields = urlparse.parse_qs(urlparse.urlparse(uri).query).get('fields')
+        if fields and response.obj is not None and response.status < 300:
+            response = json_response(project(response.obj, parse_fields(fields[0])),
+                    response.status)
+        return response
+
+    def route(self, verb, uri, headers, body):
+        parsed = urlparse.urlparse(uri)
+        path = parsed.path
+        query = dict(urlparse.parse_qsl(parsed.query))
+        if path == '/discovery/v1/apis/drive/v2/rest':
+            return json_response(self.discovery_document())
+        if path == '/batch':
+            self.count('batch')
+            return self.handle_batch(headers, body)
+        error = self.injected_error()
+        if error:
+            return error
+        if path.startswith('/download/'):
+            self.count('download')
+            return self.handle_download(path[len('/download/'):], headers)
+        if path.startswith('/upload/drive/v2/files'):
+            self.count('upload')
+            return self.handle_upload(verb, path[len('/upload/drive/v2/files'):].lstrip('/'),
+                    query, headers, body)
+        if not path.startswith('/drive/v2/'):
+            return error_response(404, 'notFound')
+        parts = path[len('/drive/v2/'):].strip('/').split('/')
+        self.count('%s %s' % (verb, parts[0]))
+        data = simplejson.loads(body) if body else {}
+        with self.lock:
+            if parts == ['files'] and verb == 'GET':
+                test = compile_query(query.get('q'))
+                items = [self.files[i] for i in self.order if test(self.files[i])]
+                return json_response(dict(self.list_page(items, query), kind='drive#fileList'))
+            if parts == ['files'] and verb == 'POST':
+                return json_response(self.insert(data))
+            if parts == ['changes'] and verb == 'GET':
+                start = int(query.get('startChangeId', 1)) - 1
+                page = self.list_page(self.changes[start:], query)
+                page.update(kind='drive#changeList', largestChangeId=str(len(self.changes)))
+                return json_response(page)
+            if parts == ['about'] and verb == 'GET':
+                return json_response({'kind': 'drive#about', 'largestChangeId': str(len(self.changes)),
+                        'rootFolderId': 'root'})
+            if parts[0] != 'files' or len(parts) < 2:
+                return error_response(404, 'notFound')
+            f = self.files.get(parts[1])
+            if f is None:
+                return error_response(404, 'notFound', 'File not found: %s' % parts[1])
+            if len(parts) == 2:
+                if verb == 'GET':
+                    return json_response(f)
+                if verb in ('PUT', 'PATCH'):
+                    return json_response(self.update(f['id'], data))
+                if verb == 'DELETE':
+                    self.delete(f['id'])
+                    return Response(204)
+            elif parts[2] == 'copy' and verb == 'POST':
+                body = dict((k, f[k]) for k in ('title', 'description', 'mimeType'))
+                body['parents'] = f['parents']
+                body.update(data)
+                return json_response(self.insert(body, self.content.get(f['id'])))
+            elif parts[2] == 'parents' and verb == 'POST':
+                reference = self.parent_reference(data['id'])
+                if data['id'] not in [p['id'] for p in f['parents']]:
+                    f['parents'].append(reference)
+                    self.record_change(f['id'])
+                return json_response(reference)
+        return error_response(404, 'notFound')
+
+    def handle_download(self, file_id, headers):
+        content = self.content.get(file_id)
+        if content is None:
+            return error_response(404, 'notFound')
+        match = re.match(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+        if not match:
+            return Response(200, content)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(content) - 1
+        end = min(end, len(content) - 1)
+        if start >= len(content):
+            return Response(416, '', {'Content-Range': 'bytes */%d' % len(content)})
+        return Response(206, content[start:end + 1],
+                {'Content-Range': 'bytes %d-%d/%d' % (start, end, len(content))})
+
+    def handle_upload(self, verb, file_id, query, headers, body):
+        upload_id = query.get('upload_id')
+        if upload_id:
+            return self.handle_chunk(upload_id, headers, body)
+        upload_type = query.get('uploadType')
+        if upload_type == 'resumable':
+            with self.lock:
+                upload_id = self.new_id()
+                size = headers.get('x-upload-content-length')
+                self.sessions[upload_id] = {
+                    'fileId': file_id or None,
+                    'body': simplejson.loads(body) if body else {},
+                    'size': int(size) if size else None,
+                    'data': [], 'received': 0,
+                }
+            location = '%s/upload/drive/v2/files?uploadType=resumable&upload_id=%s' % (self.url, upload_id)
+            return Response(200, '', {'Location': location})
+        if upload_type == 'multipart':
+            (meta_headers, meta), (media_headers, content) = parse_multipart(
+                    headers.get('content-type', ''), body)
+            data = simplejson.loads(meta)
+        else:
+            data, content = {}, body
+        return self.finish_upload(file_id, data, content)
+
+    def finish_upload(self, file_id, data, content):
+        if file_id:
+            f = self.update(file_id, data, content)
+            if f is None:
+                return error_response(404, 'notFound')
+            return json_response(f)
+        return json_response(self.insert(data, content))
+
+    def handle_chunk(self, upload_id, headers, body):
+        with self.lock:
+            session = self.sessions.get(upload_id)
+            if session is None:
+                return error_response(404, 'notFound', 'No such upload session')
+            match = re.match(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)', headers.get('content-range', ''))
+            if not match:
+                return error_response(400, 'badContentRange')
+            if match.group(4) != '*':
+                session['size'] = int(match.group(4))
+            if match.group(1) != '*':
+                start = int(match.group(2))
+                if start != session['received']:
+                    return error_response(400, 'badContentRange',
+                            'expected offset %d' % session['received'])
+                session['data'].append(body)
+                session['received'] += len(body)
+            if session['size'] is not None and session['received'] >= session['size']:
+                del self.sessions[upload_id]
+                content = ''.join(session['data'])
+            else:
+                response = Response(308)
+                if session['received']:
+                    response.headers['Range'] = 'bytes=0-%d' % (session['received'] - 1)
+                return response
+        return self.finish_upload(session['fileId'], session['body'], content)
+
+    def handle_batch(self, headers, body):
+        boundary = 'batch_fake_drive_%d' % self.random.randint(0, 10**9)
+        out = []
+        for part_headers, payload in parse_multipart(headers.get('content-type', ''), body):
+            request_line, rest = re.split(r'\r?\n', payload, 1)
+            verb, uri = request_line.split(' ')[:2]
+            match = re.search(r'\r?\n\r?\n', rest)
+            if match:
+                head, part_body = rest[:match.start()], rest[match.end():]
+            else:
+                head, part_body = rest, ''
+            sub_headers = {}
+            for line in re.split(r'\r?\n', head):
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    sub_headers[name.strip().lower()] = value.strip()
+            response = self.handle(verb, uri, sub_headers, part_body)
+            content_id = part_headers.get('content-id', '<+>')
+            lines = ['HTTP/1.1 %d %s' % (response.status,
+                    BaseHTTPServer.BaseHTTPRequestHandler.responses.get(response.status, ('',))[0])]
+            for name, value in response.headers.items():
+                lines.append('%s: %s' % (name, value))
+            out.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n%s\r\n\r\n%s\r\n' % (
+                    boundary, content_id[1:-1], '\r\n'.join(lines), response.body))
+        out.append('--%s--\r\n' % boundary)
+        return Response(200, ''.join(out),
+                {'Content-Type': 'multipart/mixed; boundary=%s' % boundary})
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        with self.connections_lock:
+            self.connections[thread] = request
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections.pop(threading.current_thread(), None)
+
+    def close_connections(self):
+        """Ends the keep-alive connections clients still hold open."""
+        with self.connections_lock:
+            connections = self.connections.items()
+        for thread, request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for thread, request in connections:
+            thread.join(1.0)
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one piece: small writes of the status line
+    # and headers would each wait for the client's delayed ACK
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def dispatch(self):
+        drive = self.server.drive
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        headers = dict((name.lower(), value) for name, value in self.headers.items())
+        if drive.latency:
+            time.sleep(drive.latency)
+        response = drive.handle(self.command, self.path, headers, body)
+        if drive.bandwidth:
+            time.sleep((len(body) + len(response.body)) / float(drive.bandwidth))
+        self.send_response(response.status)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response.body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(response.body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+def make_argparser():
+    parser = argparse.ArgumentParser(description="fake_drive: serve an in-memory Drive v2 API on localhost")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--latency", help="seconds added to every request", type=float, default=0.0)
+    parser.add_argument("--bandwidth", help="bytes per second", type=float)
+    parser.add_argument("--qps", help="requests per second before 403 rateLimitExceeded", type=int)
+    parser.add_argument("--error-rate", help="probability of a 403 userRateLimitExceeded", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", help="probability of a 503 backendError", type=float, default=0.0)
+    return parser
+
+if __name__ == "__main__":
+    args = make_argparser().parse_args()
+    drive = FakeDrive(args.port, args.latency, args.bandwidth, args.qps, args.error_rate,
+            args.server_error_rate)
+    print("serving fake drive on", drive.url, file=sys.stderr)
+    print("discovery document:", drive.url + "/discovery/v1/apis/drive/v2/rest", file=sys.stderr)
+    try:
+        drive.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
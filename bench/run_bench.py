@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+Transfer and database benchmarks against bench/fake_drive.py.
+
+Builds a synthetic local tree of the given shape, uploads it with
+upload_tree, uploads it again with a journal (the resume path), downloads
+it with download_tree, and times saving and looking up file metadata in
+the local database. Nothing talks to Google: the Drive API is served by
+an in-memory FakeDrive on localhost, with optional latency and injected
+rate limit errors, and the database lives in a temporary HOME.
+
+Each benchmark runs --repeat times on a fresh server; the results (wall
+time, HTTP requests by kind, client stats counters) are written as JSON
+with --output and compared against an earlier run with --compare, which
+exits with status 1 if a benchmark got slower than --threshold allows.
+
+usage: python bench/run_bench.py [--depth 2 --fanout 3 --files 10 ...]
+           [--output results.json] [--compare baseline.json]
+"""
+
+from __future__ import print_function
+import argparse
+import contextlib
+import os
+import platform
+import shutil
+import simplejson
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_drive import FakeDrive
+
+BENCHMARKS = ["upload", "upload_resume", "download", "db_save", "db_lookup"]
+
+def make_tree(root, depth, fanout, files, size, large_files=0, large_size=0):
+    """
+    Creates depth levels of fanout folders below root, each folder
+    holding files files of size bytes, plus large_files files of
+    large_size bytes in root. Contents differ from file to file.
+
+    Returns:
+        (number of files, number of bytes)
+    """
+    counts = [0, 0]
+    def write(path, n):
+        with open(path, "wb") as f:
+            f.write(("%s\n" % path).ljust(n, "x")[:n])
+        counts[0] += 1
+        counts[1] += n
+    def fill(folder, level):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for i in range(files):
+            write(os.path.join(folder, "file%03d.txt" % i), size)
+        if level < depth:
+            for i in range(fanout):
+                fill(os.path.join(folder, "folder%02d" % i), level + 1)
+    fill(root, 0)
+    for i in range(large_files):
+        write(os.path.join(root, "large%02d.bin" % i), large_size)
+    return tuple(counts)
+
+@contextlib.contextmanager
+def quiet():
+    """Sends stdout, which upload_tree and download_tree chat on, to /dev/null."""
+    saved = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = saved
+
+def counter_delta(before, after):
+    return dict((name, value - before.get(name, 0)) for name, value in after.items()
+            if value != before.get(name, 0))
+
+def begin(args, drive):
+    """
+    Starts counting the requests of a timed section.
+
+    Returns:
+        the client stats counters so far, for end()
+    """
+    from gdrive import stats
+
+    reset_client(args)
+    if drive:
+        with drive.lock:
+            drive.counts.clear()
+    return stats.default_stats.snapshot()["counters"]
+
+def end(drive, before):
+    """
+    Returns:
+        dict of the client stats counters and the HTTP requests by kind
+        since begin()
+    """
+    from gdrive import stats
+
+    counts = {"counters": counter_delta(before, stats.default_stats.snapshot()["counters"])}
+    if drive:
+        counts["http"] = dict(drive.counts)
+    return counts
+
+def reset_client(args):
+    """
+    Lifts the client's request rate back up: the fake server has no
+    quota, and the rate limit errors injected into one run must not slow
+    down the next.
+    """
+    from gdrive import retry
+
+    retry.configure(rate=10000.0, max_rate=10000.0)
+    retry.default_limiter.burst = 100
+    retry.default_policy.base = args.backoff
+    retry.default_policy.budget = float(retry.default_policy.budget_size)
+
+def start_drive(args):
+    return FakeDrive(latency=args.latency, error_rate=args.error_rate,
+            server_error_rate=args.server_error_rate, seed=0).start()
+
+def find_root(drive, title):
+    for f in drive.files.values():
+        if f["title"] == title and f["parents"][0]["id"] == "root":
+            return f["id"]
+    return None
+
+def bench_upload(args, workdir, drive, resume=False):
+    import upload_tree
+    from db import helper as dbhelper
+    from db import journal as dbjournal
+
+    service = drive.service()
+    session = journal = None
+    if resume:
+        session = dbhelper.Session()
+        # a job name per server, so repeats don't resume each other's journal
+        journal = dbjournal.Journal(upload_tree.journal_name(args.tree, drive.url), session)
+        with quiet():
+            upload_tree.upload_tree(service, args.tree, "bench", args.workers, drive.service,
+                    journal=journal, session=session)
+    before = begin(args, drive)
+    started = time.time()
+    try:
+        with quiet():
+            results = upload_tree.upload_tree(service, args.tree, "bench", args.workers, drive.service,
+                    journal=journal, session=session, chunksize=args.chunk_size)
+    finally:
+        if session:
+            session.close()
+    seconds = time.time() - started
+    return seconds, dict(end(drive, before), files=len(results), failed=len(results.failed))
+
+def bench_download(args, workdir, drive):
+    import download_tree
+    import upload_tree
+
+    service = drive.service()
+    with quiet():
+        upload_tree.upload_tree(service, args.tree, "bench", args.workers, drive.service)
+    destdir = os.path.join(workdir, "download")
+    shutil.rmtree(destdir, True)
+    before = begin(args, drive)
+    started = time.time()
+    with quiet():
+        results = download_tree.download_tree(service, find_root(drive, "bench"), destdir,
+                args.workers, drive.service)
+    seconds = time.time() - started
+    return seconds, dict(end(drive, before), files=len(results), failed=len(results.failed))
+
+def synthetic_metadata(count, folders):
+    for i in range(count):
+        yield {
+            "kind": "drive#file",
+            "id": "file%07d" % i,
+            "title": "file%07d.txt" % i,
+            "mimeType": "text/plain",
+            "createdDate": "2014-01-01T00:00:00.000Z",
+            "modifiedDate": "2014-01-01T00:00:00.000Z",
+            "fileSize": str(i),
+            "md5Checksum": "%032x" % i,
+            "labels": {"hidden": False, "starred": False, "trashed": False},
+            "parents": [{"id": "folder%05d" % (i % folders), "isRoot": False}],
+            "userPermission": {"etag": "x", "role": "owner", "type": "user"},
+        }
+
+def bench_db(args, workdir, lookup=False):
+    from db import helper as dbhelper
+
+    dbpath = os.path.join(workdir, "bench.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(dbpath + suffix):
+            os.remove(dbpath + suffix)
+    folders = max(1, args.db_files // 100)
+    metadatas = list(synthetic_metadata(args.db_files, folders))
+    session = dbhelper.Session(dbpath=dbpath)
+    try:
+        started = time.time()
+        if lookup:
+            dbhelper.save_files(metadatas, session)
+            session.commit()
+            started = time.time()
+            found = 0
+            for metadata in metadatas:
+                if dbhelper.find_file_by_parent(metadata["parents"][0]["id"], metadata["title"], session):
+                    found += 1
+            extra = {"lookups": len(metadatas), "found": found}
+        else:
+            for start in range(0, len(metadatas), 1000):
+                dbhelper.save_files(metadatas[start:start + 1000], session)
+            session.commit()
+            extra = {"files": len(metadatas)}
+        return time.time() - started, extra
+    finally:
+        session.close()
+
+def run_benchmark(name, args, workdir):
+    """
+    Returns:
+        dict of the benchmark's timings and counts over args.repeat runs
+    """
+    runs = [ ]
+    for i in range(args.repeat):
+        drive = None
+        if not name.startswith("db_"):
+            drive = start_drive(args)
+        try:
+            if name == "upload":
+                seconds, extra = bench_upload(args, workdir, drive)
+            elif name == "upload_resume":
+                seconds, extra = bench_upload(args, workdir, drive, resume=True)
+            elif name == "download":
+                seconds, extra = bench_download(args, workdir, drive)
+            else:
+                seconds, extra = bench_db(args, workdir, lookup=(name == "db_lookup"))
+        finally:
+            if drive:
+                drive.stop()
+        runs.append((seconds, extra))
+    times = sorted(seconds for seconds, extra in runs)
+    result = {"seconds": times, "min": times[0], "median": times[len(times) // 2]}
+    result.update(runs[-1][1])
+    return result
+
+def compare(results, baseline, threshold):
+    """
+    Prints the median time of each benchmark next to the baseline's.
+
+    Returns:
+        list of names of benchmarks slower than threshold times the baseline
+    """
+    slower = [ ]
+    print("%-15s %12s %12s %8s" % ("benchmark", "baseline", "current", "ratio"))
+    for name, result in sorted(results.items()):
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            print("%-15s %12s %10.1fms %8s" % (name, "-", result["median"] * 1000, "-"))
+            continue
+        ratio = result["median"] / base["median"] if base["median"] else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = " SLOWER"
+            slower.append(name)
+        elif ratio < 1 / threshold:
+            flag = " faster"
+        print("%-15s %10.1fms %10.1fms %7.2fx%s" % (name, base["median"] * 1000,
+                result["median"] * 1000, ratio, flag))
+    return slower
+
+def make_argparser():
+    parser = argparse.ArgumentParser(description="run_bench: time transfers against a local fake drive and database operations")
+    parser.add_argument("benchmarks", help="benchmarks to run (default: all)", nargs="*")
+    parser.add_argument("--depth", help="folder levels below the root", type=int, default=2)
+    parser.add_argument("--fanout", help="subfolders per folder", type=int, default=3)
+    parser.add_argument("--files", help="files per folder", type=int, default=10)
+    parser.add_argument("--size", help="bytes per file", type=int, default=4096)
+    parser.add_argument("--large-files", help="large files in the root folder, uploaded in chunks", type=int, default=0)
+    parser.add_argument("--large-size", help="bytes per large file", type=int, default=12 * 2**20)
+    parser.add_argument("--chunk-size", help="upload chunk size in bytes", type=int)
+    parser.add_argument("--workers", help="upload and download threads", type=int, default=4)
+    parser.add_argument("--db-files", help="file records for the database benchmarks", type=int, default=20000)
+    parser.add_argument("--latency", help="seconds the fake drive adds to every request", type=float, default=0.0)
+    parser.add_argument("--error-rate", help="probability of a 403 rate limit error per request", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", help="probability of a 503 error per request", type=float, default=0.0)
+    parser.add_argument("--backoff", help="base seconds of the retry backoff", type=float, default=0.05)
+    parser.add_argument("--repeat", help="runs per benchmark", type=int, default=3)
+    parser.add_argument("--output", help="write results as JSON", metavar="<path>")
+    parser.add_argument("--compare", help="compare with the results of an earlier run", metavar="<path>")
+    parser.add_argument("--threshold", help="ratio to the baseline above which a benchmark counts as slower", type=float, default=1.2)
+    return parser
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="gdrive-bench-")
+    # the local database and discovery cache go into a throwaway HOME
+    os.environ["HOME"] = workdir
+    try:
+        args.tree = os.path.join(workdir, "tree")
+        nfiles, nbytes = make_tree(args.tree, args.depth, args.fanout, args.files, args.size,
+                args.large_files, args.large_size)
+        print("tree: %d files, %d bytes" % (nfiles, nbytes), file=sys.stderr)
+        results = { }
+        for name in args.benchmarks or BENCHMARKS:
+            result = results[name] = run_benchmark(name, args, workdir)
+            print("%-15s min %8.1f ms   median %8.1f ms" % (name, result["min"] * 1000,
+                    result["median"] * 1000), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, True)
+    config = dict((key, value) for key, value in vars(args).items()
+            if key not in ("benchmarks", "output", "compare", "tree"))
+    report = {"time": time.time(), "python": platform.python_version(), "config": config,
+              "tree": {"files": nfiles, "bytes": nbytes}, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            simplejson.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = simplejson.load(f)
+        if baseline.get("config") != config:
+            print("warning: baseline was run with different options", file=sys.stderr)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = make_argparser()
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s; choose from %s" % (name, ", ".join(BENCHMARKS)))
+    sys.exit(main(args))
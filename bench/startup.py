@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Startup time of gdrive-cli commands.
+
+Runs each command line several times in a fresh interpreter and prints
+the fastest and the median wall-clock time. The default commands,
+--help and --list, need neither credentials nor the network; --list
+reads the local database.
+
+usage: python bench/startup.py [--runs N] ["--show <file_id>" ...]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gdrive-cli.py")
+
+DEFAULT_COMMANDS = ["--help", "--list"]
+
+def time_command(args, runs):
+    """
+    Returns:
+        sorted list of wall-clock seconds, one per run
+    """
+    times = [ ]
+    with open(os.devnull, "w") as devnull:
+        for i in range(runs):
+            started = time.time()
+            subprocess.call([sys.executable, CLI] + args, stdout=devnull, stderr=devnull)
+            times.append(time.time() - started)
+    return sorted(times)
+
+def make_argparser():
+    parser = argparse.ArgumentParser(description="startup: time gdrive-cli commands")
+    parser.add_argument("commands", help="gdrive-cli arguments, one quoted string per command", nargs="*")
+    parser.add_argument("--runs", help="runs per command", type=int, default=20)
+    return parser
+
+if __name__ == "__main__":
+    args = make_argparser().parse_args()
+    # warm the page cache and write .pyc files first
+    time_command(["--help"], 1)
+    for command in args.commands or DEFAULT_COMMANDS:
+        times = time_command(command.split(), args.runs)
+        print("%-30s min %6.1f ms   median %6.1f ms" %
+                (command, times[0] * 1000, times[len(times) // 2] * 1000))
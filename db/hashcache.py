@@ -0,0 +1,121 @@
+"""
+Cache of the md5 checksums of local files.
+
+Entries are keyed by the stat signature of a file (device, inode, size
+and mtime in nanoseconds), so a file is only read again after it
+changed. Comparing a tree with Drive's md5Checksum values then costs a
+stat per file instead of reading every byte.
+"""
+
+import hashlib
+import os
+
+from helper import Session, reading, writing
+
+# Large reads keep the disk streaming; hashlib releases the GIL while
+# it digests them, so several threads can hash at once.
+HASH_BLOCKSIZE = 4*2**20
+
+def create_hashcache_schema(cursor):
+    """
+    tbl_hashCache
+        one row per (device, inode) of a hashed local file
+
+    Applied by db.schema.migrate.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tbl_hashCache (
+            device INTEGER,
+            inode INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            md5 TEXT,
+            PRIMARY KEY (device, inode)
+            );
+        """)
+
+def md5_file(file_path, blocksize=HASH_BLOCKSIZE):
+    md5 = hashlib.md5()
+    f = open(file_path, "rb")
+    try:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+def stat_signature(st):
+    """
+    Returns:
+        (device, inode, size, mtime_ns) of an os.stat result
+    """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 10**9))
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+class HashCache(object):
+    """
+    md5 checksums of local files, looked up by stat signature and
+    computed on a miss. Safe to share between threads.
+    """
+
+    def __init__(self, session=None):
+        self.owns_session = session is None
+        if session is None:
+            session = Session()
+        self.session = session
+
+    def get(self, st):
+        """
+        Returns:
+            the cached md5 of the file st was taken from, or None if it
+            was not hashed since it last changed
+        """
+        device, inode, size, mtime_ns = stat_signature(st)
+        with reading(self.session) as cursor:
+            cursor.execute("""
+                SELECT md5 FROM tbl_hashCache
+                WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?;
+                """, (device, inode, size, mtime_ns))
+            row = cursor.fetchone()
+        return row and row[0]
+
+    def put(self, st, md5):
+        with writing(self.session) as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO tbl_hashCache (
+                    device,
+                    inode,
+                    size,
+                    mtime_ns,
+                    md5
+                ) VALUES (
+                    ?,?,?,?,?
+                );
+                """, stat_signature(st) + (md5,))
+
+    def md5(self, file_path, st=None):
+        """
+        Returns:
+            the md5 of file_path, read from the file only if the cache
+            has none for its current stat signature
+        """
+        if st is None:
+            st = os.stat(file_path)
+        md5 = self.get(st)
+        if md5 is None:
+            md5 = md5_file(file_path)
+            # a file modified while it was read gets no entry
+            if stat_signature(os.stat(file_path)) == stat_signature(st):
+                self.put(st, md5)
+        return md5
+
+    def close(self):
+        if self.owns_session:
+            self.session.close()
+        else:
+            self.session.commit()
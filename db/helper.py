@@ -2,20 +2,184 @@
 Helper methods for database
 """
 
+import contextlib
 import sqlite3
 import os
+import threading
 
-def connect():
+def get_database_path():
     home = os.getenv("HOME")
 
     #windows
     if home is None:
         home = os.getenv("HOMEPATH")
 
-    dbpath = home + os.path.sep + ".gdrive-cli.db"
-    return sqlite3.connect(dbpath)
+    return home + os.path.sep + ".gdrive-cli.db"
 
-def insert_file(metadata):
+def connect(check_same_thread=True, dbpath=None):
+    """
+    Opens the local database, or the one at 'dbpath', bringing its schema
+    up to date first, so every connection sees the current tables and
+    indexes.
+    """
+    import schema
+
+    if dbpath is None:
+        dbpath = get_database_path()
+    conn = sqlite3.connect(dbpath, check_same_thread=check_same_thread)
+    schema.migrate(conn)
+    return conn
+
+class Session(object):
+    """
+    A connection to the local database meant to be kept open for many
+    operations, and shared between threads.
+
+    Writes are committed once batch_size rows have been written rather
+    than one by one; commit() and close() flush the rest. The database is
+    switched to WAL journal mode, so a commit costs one append to the
+    log and readers don't wait for the writer. Like every connection, a
+    session brings the schema up to date when it is opened.
+
+    The session begins and ends its transactions itself rather than
+    leaving that to the sqlite3 module, which would commit before every
+    SAVEPOINT, so that writing() can drop the rows of a failed block
+    and keep the rest of the batch.
+    """
+
+    def __init__(self, batch_size=1000, dbpath=None):
+        self.conn = connect(False, dbpath)
+        self.conn.isolation_level = None
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.batch_size = batch_size
+        self.pending = 0
+        self.held = 0
+        self.in_transaction = False
+        self.lock = threading.RLock()
+
+    def begin(self):
+        with self.lock:
+            if not self.in_transaction:
+                self.conn.execute("BEGIN;")
+                self.in_transaction = True
+
+    def wrote(self, rows=1):
+        """
+        Counts rows written since the last commit, committing when a
+        batch is full, unless a transaction() holds the commits back.
+        """
+        with self.lock:
+            self.pending += rows
+            if self.pending >= self.batch_size and not self.held:
+                self.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.in_transaction:
+                self.conn.execute("COMMIT;")
+                self.in_transaction = False
+            self.pending = 0
+
+    def rollback(self):
+        with self.lock:
+            if self.in_transaction:
+                self.conn.execute("ROLLBACK;")
+                self.in_transaction = False
+            self.pending = 0
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Makes the writes of the block one transaction: what was written
+        before is committed first, no batch is committed during the
+        block, and the block's writes are committed when it ends, or
+        rolled back if it raises. Call rollback() in the block to drop
+        them without raising.
+        """
+        with self.lock:
+            self.commit()
+            self.held += 1
+        try:
+            yield self
+        except:
+            with self.lock:
+                self.held -= 1
+                self.rollback()
+            raise
+        with self.lock:
+            self.held -= 1
+            self.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+@contextlib.contextmanager
+def writing(session=None, rows=1):
+    """
+    Yields a cursor for writing 'rows' rows through 'session', which
+    commits them in batches; if the block raises, what it wrote is
+    rolled back and the rest of the batch kept. Without a session, a
+    connection is opened for the occasion and committed and closed on
+    exit.
+    """
+    if session is None:
+        conn = connect()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+        return
+    with session.lock:
+        session.begin()
+        cursor = session.conn.cursor()
+        try:
+            cursor.execute("SAVEPOINT writing;")
+            try:
+                yield cursor
+            except:
+                cursor.execute("ROLLBACK TO writing;")
+                cursor.execute("RELEASE writing;")
+                raise
+            cursor.execute("RELEASE writing;")
+        finally:
+            cursor.close()
+        session.wrote(rows)
+
+@contextlib.contextmanager
+def reading(session=None):
+    """
+    Yields a cursor for queries through 'session', or through a
+    connection opened for the occasion.
+    """
+    if session is None:
+        conn = connect()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            conn.close()
+        return
+    with session.lock:
+        cursor = session.conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+def insert_file(metadata, session=None):
     """
     Inserts file metadata returned by gdrive.insert_file into the
     tbl_files table and tables related to it.
@@ -24,106 +188,102 @@ def insert_file(metadata):
         id of the inserted data
     """
 
-    conn = connect()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        INSERT INTO tbl_files (
-            createdDate,
-            description,
-            downloadUrl,
-            etag,
-            fileExtension,
-            fileSize,
-            id,
-            kind,
-            lastViewedDate,
-            md5Checksum,
-            mimeType,
-            modifiedByMeDate,
-            modifiedDate,
-            title
-        ) VALUES (
-           ?,?,?,?,?,?,?,?,?,?,?,?,?,?
-        );
-        """, (
-            metadata["createdDate"],
-            metadata["description"],
-            metadata["downloadUrl"],
-            metadata["etag"],
-            metadata["fileExtension"],
-            metadata["fileSize"],
-            metadata["id"],
-            metadata["kind"],
-            metadata["lastViewedDate"],
-            metadata["md5Checksum"],
-            metadata["mimeType"],
-            metadata["modifiedByMeDate"],
-            metadata["modifiedDate"],
-            metadata["title"],
+    with writing(session) as cursor:
+        cursor.execute("""
+            INSERT INTO tbl_files (
+                createdDate,
+                description,
+                downloadUrl,
+                etag,
+                fileExtension,
+                fileSize,
+                id,
+                kind,
+                lastViewedDate,
+                md5Checksum,
+                mimeType,
+                modifiedByMeDate,
+                modifiedDate,
+                title
+            ) VALUES (
+               ?,?,?,?,?,?,?,?,?,?,?,?,?,?
+            );
+            """, (
+                metadata["createdDate"],
+                metadata["description"],
+                metadata["downloadUrl"],
+                metadata["etag"],
+                metadata["fileExtension"],
+                metadata["fileSize"],
+                metadata["id"],
+                metadata["kind"],
+                metadata["lastViewedDate"],
+                metadata["md5Checksum"],
+                metadata["mimeType"],
+                metadata["modifiedByMeDate"],
+                metadata["modifiedDate"],
+                metadata["title"],
+                )
+            );
+
+        cursor.execute("""
+            INSERT INTO tbl_labels (
+                files_id,
+                hidden,
+                starred,
+                trashed
+            ) VALUES (
+                ?,?,?,?
+            );
+            """, (
+                metadata["id"],
+                metadata["labels"]["hidden"],
+                metadata["labels"]["starred"],
+                metadata["labels"]["trashed"],
             )
         );
 
-    cursor.execute("""
-        INSERT INTO tbl_labels (
-            files_id,
-            hidden,
-            starred,
-            trashed
-        ) VALUES (
-            ?,?,?,?
-        );
-        """, (
-            metadata["id"],
-            metadata["labels"]["hidden"],
-            metadata["labels"]["starred"],
-            metadata["labels"]["trashed"],
-        )
-    );
-
-    for parent in metadata["parentsCollection"]:
+        for parent in metadata["parentsCollection"]:
+            cursor.execute("""
+                INSERT INTO tbl_parentsCollection (
+                    files_id,
+                    parent_id,
+                    parentLink
+                ) VALUES (
+                    ?,?,?
+                );
+                """, (
+                    metadata["id"],
+                    parent["id"],
+                    parent["parentLink"],
+                )
+            );
+
         cursor.execute("""
-            INSERT INTO tbl_parentsCollection (
+            INSERT INTO tbl_userPermission (
                 files_id,
-                parent_id,
-                parentLink
+                etag,
+                kind,
+                role,
+                type
             ) VALUES (
-                ?,?,?
-            );
+                ?,?,?,?,?
+            )
             """, (
                 metadata["id"],
-                parent["id"],
-                parent["parentLink"],
+                metadata["userPermission"]["etag"],
+                metadata["userPermission"]["kind"],
+                metadata["userPermission"]["role"],
+                metadata["userPermission"]["type"],
             )
         );
 
-    cursor.execute("""
-        INSERT INTO tbl_userPermission (
-            files_id,
-            etag,
-            kind,
-            role,
-            type
-        ) VALUES (
-            ?,?,?,?,?
-        )
-        """, (
-            metadata["id"],
-            metadata["userPermission"]["etag"],
-            metadata["userPermission"]["kind"],
-            metadata["userPermission"]["role"],
-            metadata["userPermission"]["type"],
-        )
-    );
-
-
-    conn.commit()
-    cursor.close()
+
 
     return metadata["id"]
 
 
-def rename_file(file_id, name):
+def rename_file(file_id, name, session=None):
     """
     Renames the file in the local sqlite database to reflect the remote change.
     Infers fileExtension from the filename.
@@ -131,28 +291,23 @@ def rename_file(file_id, name):
     Returns:
         id of renamed file
     """
-    conn = connect()
-    cursor = conn.cursor()
-
     tokens = name.split(".")
     fileExtension = tokens[len(tokens) - 1]
 
-    cursor.execute("""
-        UPDATE tbl_files
-        SET title = ?,  fileExtension = ?
-        WHERE id = ?;
-        """, (
-            name,
-            fileExtension,
-            file_id
-        ))
-
-    conn.commit()
-    cursor.close()
+    with writing(session) as cursor:
+        cursor.execute("""
+            UPDATE tbl_files
+            SET title = ?,  fileExtension = ?
+            WHERE id = ?;
+            """, (
+                name,
+                fileExtension,
+                file_id
+            ))
 
     return file_id
 
-def update_file(metadata):
+def update_file(metadata, session=None):
     """
     Updates file metadata returned by gdrive.update_file into the
     tbl_files table and tables related to it.
@@ -161,125 +316,380 @@ def update_file(metadata):
         id of the inserted data
     """
 
-    conn = connect()
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        UPDATE tbl_files
-        SET createdDate = ?,
-            description = ?, 
-            downloadUrl = ?, 
-            etag = ?, 
-            fileExtension = ?, 
-            fileSize = ?, 
-            kind = ?, 
-            lastViewedDate = ?, 
-            md5Checksum = ?, 
-            mimeType = ?, 
-            modifiedBymeDate = ?, 
-            modifiedDate = ?, 
-            title = ?
-        WHERE id = ?;
-        """, (
-            metadata["createdDate"],
-            metadata["description"],
-            metadata["downloadUrl"],
-            metadata["etag"],
-            metadata["fileExtension"],
-            metadata["fileSize"],
-            metadata["kind"],
-            metadata["lastViewedDate"],
-            metadata["md5Checksum"],
-            metadata["mimeType"],
-            metadata["modifiedByMeDate"],
-            metadata["modifiedDate"],
-            metadata["title"],
-            metadata["id"],
-        )
-    );
-
-    cursor.execute("""
-        UPDATE tbl_labels
-        SET hidden = ?,
-            starred = ?,
-            trashed = ?
-        WHERE files_id = ?;
-        """, (
-            metadata["labels"]["hidden"],
-            metadata["labels"]["starred"],
-            metadata["labels"]["trashed"],
-            metadata["id"],
-        )
-    );
-
-    for parent in metadata["parentsCollection"]:
+    with writing(session) as cursor:
         cursor.execute("""
-            UPDATE tbl_parentsCollection
-            SET parent_id = ?,
-                parentLink = ?
-            WHERE files_id = ?
+            UPDATE tbl_files
+            SET createdDate = ?,
+                description = ?, 
+                downloadUrl = ?, 
+                etag = ?, 
+                fileExtension = ?, 
+                fileSize = ?, 
+                kind = ?, 
+                lastViewedDate = ?, 
+                md5Checksum = ?, 
+                mimeType = ?, 
+                modifiedBymeDate = ?, 
+                modifiedDate = ?, 
+                title = ?
+            WHERE id = ?;
             """, (
-                parent["id"],
-                parent["parentLink"],
+                metadata["createdDate"],
+                metadata["description"],
+                metadata["downloadUrl"],
+                metadata["etag"],
+                metadata["fileExtension"],
+                metadata["fileSize"],
+                metadata["kind"],
+                metadata["lastViewedDate"],
+                metadata["md5Checksum"],
+                metadata["mimeType"],
+                metadata["modifiedByMeDate"],
+                metadata["modifiedDate"],
+                metadata["title"],
+                metadata["id"],
+            )
+        );
+
+        cursor.execute("""
+            UPDATE tbl_labels
+            SET hidden = ?,
+                starred = ?,
+                trashed = ?
+            WHERE files_id = ?;
+            """, (
+                metadata["labels"]["hidden"],
+                metadata["labels"]["starred"],
+                metadata["labels"]["trashed"],
+                metadata["id"],
+            )
+        );
+
+        # a file can have several parents: replace the whole set
+        cursor.execute("DELETE FROM tbl_parentsCollection WHERE files_id = ?;",
+            (metadata["id"],))
+
+        for parent in metadata["parentsCollection"]:
+            cursor.execute("""
+                INSERT INTO tbl_parentsCollection (
+                    files_id,
+                    parent_id,
+                    parentLink
+                ) VALUES (
+                    ?,?,?
+                );
+                """, (
+                    metadata["id"],
+                    parent["id"],
+                    parent["parentLink"],
+                )
+            );
+
+        cursor.execute("""
+            UPDATE tbl_userPermission 
+            SET etag = ?,
+                kind = ?,
+                role = ?,
+                type = ?
+            WHERE files_id = ?;
+            """, (
+                metadata["userPermission"]["etag"],
+                metadata["userPermission"]["kind"],
+                metadata["userPermission"]["role"],
+                metadata["userPermission"]["type"],
                 metadata["id"],
             )
         );
 
-    cursor.execute("""
-        UPDATE tbl_userPermission 
-        SET etag = ?,
-            kind = ?,
-            role = ?,
-            type = ?
-        WHERE files_id = ?;
-        """, (
-            metadata["userPermission"]["etag"],
-            metadata["userPermission"]["kind"],
-            metadata["userPermission"]["role"],
-            metadata["userPermission"]["type"],
-            metadata["id"],
-        )
-    );
-
-    conn.commit()
-    cursor.close()
 
     return metadata["id"]
 
 
-def select_all_files():
+def select_all_files(session=None):
     """
     Generates a basic listing of files in tbl_files
     """
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute("SELECT title, id FROM tbl_files")
-    files = cursor.fetchall()
-    cursor.close()
-    conn.commit()
+    with reading(session) as cursor:
+        cursor.execute("SELECT title, id FROM tbl_files")
+        files = cursor.fetchall()
 
     return files
 
 
 
-def get_file_id_by_name(file_name):
+def get_file_id_by_name(file_name, session=None):
     """
-    Returns the id associated with 'file_name' 
+    Returns the id associated with 'file_name', or None
     """
     file_name = file_name.strip()
 
-    conn = connect()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM tbl_files WHERE title = ?; ",
-        (file_name,))
-
-    file_id = cursor.fetchone()
+    with reading(session) as cursor:
+        cursor.execute("SELECT id FROM tbl_files WHERE title = ?; ",
+            (file_name,))
 
-    cursor.close()
-    conn.commit()
+        file_id = cursor.fetchone()
 
+    if file_id is None:
+        return None
     return file_id[0]
 
 
+def save_file(metadata, session=None):
+    """
+    Inserts or replaces file metadata returned by the v2 API (for
+    example by gdrive.insert_file, gdrive.update_file or a files().list
+    page) in the tbl_files table and tables related to it. Fields missing
+    from the metadata are stored as NULL.
+
+    Returns:
+        id of the saved file
+    """
+    save_files([metadata], session)
+    return metadata["id"]
+
+def save_files(metadatas, session=None):
+    """
+    Like save_file, for a list of metadata, with one executemany per
+    table.
+
+    Returns:
+        number of saved files
+    """
+    file_ids = [(metadata["id"],) for metadata in metadatas]
+    files = [ ]
+    labels = [ ]
+    parents = [ ]
+    permissions = [ ]
+    for metadata in metadatas:
+        file_id = metadata["id"]
+        files.append((
+            metadata.get("createdDate"),
+            metadata.get("description"),
+            metadata.get("downloadUrl"),
+            metadata.get("etag"),
+            metadata.get("fileExtension"),
+            metadata.get("fileSize"),
+            file_id,
+            metadata.get("kind"),
+            metadata.get("lastViewedByMeDate", metadata.get("lastViewedDate")),
+            metadata.get("md5Checksum"),
+            metadata.get("mimeType"),
+            metadata.get("modifiedByMeDate"),
+            metadata.get("modifiedDate"),
+            metadata.get("title"),
+        ))
+
+        label = metadata.get("labels", {})
+        labels.append((
+            file_id,
+            label.get("hidden"),
+            label.get("starred"),
+            label.get("trashed"),
+        ))
+
+        # v2 calls it parents, v1 parentsCollection
+        for parent in metadata.get("parents", metadata.get("parentsCollection", [])):
+            parents.append((
+                file_id,
+                parent["id"],
+                parent.get("parentLink"),
+            ))
+
+        permission = metadata.get("userPermission")
+        if permission:
+            permissions.append((
+                file_id,
+                permission.get("etag"),
+                permission.get("kind"),
+                permission.get("role"),
+                permission.get("type"),
+            ))
+
+    with writing(session, len(metadatas)) as cursor:
+        cursor.executemany("""
+            INSERT OR REPLACE INTO tbl_files (
+                createdDate,
+                description,
+                downloadUrl,
+                etag,
+                fileExtension,
+                fileSize,
+                id,
+                kind,
+                lastViewedDate,
+                md5Checksum,
+                mimeType,
+                modifiedByMeDate,
+                modifiedDate,
+                title
+            ) VALUES (
+               ?,?,?,?,?,?,?,?,?,?,?,?,?,?
+            );
+            """, files)
+
+        for table in ("tbl_labels", "tbl_parentsCollection", "tbl_userPermission"):
+            cursor.executemany("DELETE FROM %s WHERE files_id = ?;" % table, file_ids)
+
+        cursor.executemany("""
+            INSERT INTO tbl_labels (
+                files_id,
+                hidden,
+                starred,
+                trashed
+            ) VALUES (
+                ?,?,?,?
+            );
+            """, labels)
+
+        cursor.executemany("""
+            INSERT INTO tbl_parentsCollection (
+                files_id,
+                parent_id,
+                parentLink
+            ) VALUES (
+                ?,?,?
+            );
+            """, parents)
+
+        cursor.executemany("""
+            INSERT INTO tbl_userPermission (
+                files_id,
+                etag,
+                kind,
+                role,
+                type
+            ) VALUES (
+                ?,?,?,?,?
+            )
+            """, permissions)
+
+    return len(metadatas)
 
+def find_file_by_parent(parent_id, title, session=None):
+    """
+    Looks up the file called 'title' that is not in the trash, in the
+    folder 'parent_id'. If there are several, the most recently modified
+    one wins.
+
+    Returns:
+        (id, fileSize, md5Checksum, modifiedDate) or None
+    """
+    with reading(session) as cursor:
+        cursor.execute("""
+            SELECT f.id, f.fileSize, f.md5Checksum, f.modifiedDate
+            FROM tbl_files f
+            JOIN tbl_parentsCollection p ON p.files_id = f.id
+            LEFT JOIN tbl_labels l ON l.files_id = f.id
+            WHERE p.parent_id = ? AND f.title = ?
+                AND (l.trashed IS NULL OR NOT l.trashed)
+            ORDER BY f.modifiedDate DESC
+            LIMIT 1;
+            """, (parent_id, title))
+
+        row = cursor.fetchone()
+
+    return row
+
+def find_folder_by_parent(parent_id, title, session=None):
+    """
+    Looks up the folder called 'title' that is not in the trash, in the
+    folder 'parent_id' or, if that is None, anywhere.
 
+    Returns:
+        the folder id or None
+    """
+    with reading(session) as cursor:
+        cursor.execute("""
+            SELECT f.id
+            FROM tbl_files f
+            LEFT JOIN tbl_parentsCollection p ON p.files_id = f.id
+            LEFT JOIN tbl_labels l ON l.files_id = f.id
+            WHERE f.mimeType = 'application/vnd.google-apps.folder' AND f.title = ?
+                AND (? IS NULL OR p.parent_id = ?)
+                AND (l.trashed IS NULL OR NOT l.trashed)
+            ORDER BY f.modifiedDate DESC
+            LIMIT 1;
+            """, (title, parent_id, parent_id))
+
+        row = cursor.fetchone()
+
+    return row and row[0]
+
+def find_file_by_md5(md5, size, title=None, session=None):
+    """
+    Looks up a file that is not in the trash by content. Files called
+    'title' come first, then the most recently modified one.
+
+    Returns:
+        (id, title) or None
+    """
+    with reading(session) as cursor:
+        cursor.execute("""
+            SELECT f.id, f.title
+            FROM tbl_files f
+            LEFT JOIN tbl_labels l ON l.files_id = f.id
+            WHERE f.md5Checksum = ? AND f.fileSize = ?
+                AND (l.trashed IS NULL OR NOT l.trashed)
+            ORDER BY f.title = ? DESC, f.modifiedDate DESC
+            LIMIT 1;
+            """, (md5, str(size), title))
+
+        row = cursor.fetchone()
+
+    return row
+
+def add_parent(file_id, parent, session=None):
+    """
+    Records an additional parent reference, as returned by the parents
+    insert method, for a file.
+    """
+    with writing(session) as cursor:
+        cursor.execute("""
+            INSERT INTO tbl_parentsCollection (
+                files_id,
+                parent_id,
+                parentLink
+            ) VALUES (
+                ?,?,?
+            );
+            """, (file_id, parent["id"], parent.get("parentLink")))
+
+def delete_files(file_ids, session=None):
+    """
+    Removes files from tbl_files and the tables related to it.
+
+    Returns:
+        number of deleted files
+    """
+    rows = [(file_id,) for file_id in file_ids]
+    with writing(session, len(rows)) as cursor:
+        for table in ("tbl_labels", "tbl_parentsCollection", "tbl_userPermission"):
+            cursor.executemany("DELETE FROM %s WHERE files_id = ?;" % table, rows)
+        cursor.executemany("DELETE FROM tbl_files WHERE id = ?;", rows)
+
+    return len(rows)
+
+def delete_all_files(session=None):
+    """
+    Empties tbl_files and the tables related to it.
+    """
+    with writing(session) as cursor:
+        for table in ("tbl_labels", "tbl_parentsCollection", "tbl_userPermission", "tbl_files"):
+            cursor.execute("DELETE FROM %s;" % table)
+
+def get_sync_state(key, session=None):
+    """
+    Returns the value stored under 'key' in tbl_syncState, or None
+    """
+    with reading(session) as cursor:
+        cursor.execute("SELECT value FROM tbl_syncState WHERE key = ?;", (key,))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+    return row[0]
+
+def set_sync_state(key, value, session=None):
+    with writing(session) as cursor:
+        cursor.execute("INSERT OR REPLACE INTO tbl_syncState (key, value) VALUES (?,?);",
+            (key, value))
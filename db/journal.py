@@ -0,0 +1,228 @@
+"""
+Upload journal for upload_tree.
+
+Records every folder and file an upload job touches, with its Drive id,
+size, mtime and status, so an interrupted job can resume from a local
+table scan instead of asking Drive what already exists.
+
+The journal is stored as a tree: each row holds one path component and
+the node of its parent folder, rather than a full path, so the paths of
+a job share the rows of their folders.
+"""
+
+import os
+import threading
+
+from helper import Session, reading, writing
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+def create_journal_schema(cursor):
+    """
+    tbl_uploadJournal
+        one row per (job, local path)
+
+    Applied by db.schema.migrate.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tbl_uploadJournal (
+            job TEXT,
+            path TEXT,
+            drive_id TEXT,
+            is_folder INTEGER,
+            size INTEGER,
+            mtime REAL,
+            status TEXT,
+            PRIMARY KEY (job, path)
+            );
+        """)
+
+def create_journal_tree_schema(cursor):
+    """
+    tbl_uploadJournalTree
+        one row per (job, parent node, name); top-level nodes (parent 0)
+        are filesystem roots, and folders that were never journaled
+        themselves have no status
+
+    Takes over the rows of tbl_uploadJournal and drops it. Applied by
+    db.schema.migrate.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tbl_uploadJournalTree (
+            node INTEGER PRIMARY KEY,
+            job TEXT,
+            parent INTEGER,
+            name TEXT,
+            drive_id TEXT,
+            is_folder INTEGER,
+            size INTEGER,
+            mtime REAL,
+            status TEXT,
+            UNIQUE (job, parent, name)
+            );
+        """)
+    rows = cursor.connection.cursor()
+    rows.execute("""
+        SELECT job, path, drive_id, is_folder, size, mtime, status
+        FROM tbl_uploadJournal
+        ORDER BY job;
+        """)
+    nodes = { }
+    for row in rows:
+        write_entries(cursor, nodes, row[0], [row[1:]])
+    rows.close()
+    cursor.execute("DROP TABLE tbl_uploadJournal;")
+
+def folder_node(cursor, nodes, job, path):
+    """
+    Returns the node of the folder at path in the journal of job, adding
+    rows without a status for it and its ancestors where missing. nodes
+    caches the nodes of the job by (parent node, name).
+    """
+    head, name = os.path.split(path)
+    if name:
+        parent = folder_node(cursor, nodes, job, head)
+    else:
+        parent, name = 0, path
+    node = nodes.get((parent, name))
+    if node is None:
+        cursor.execute("""
+            INSERT INTO tbl_uploadJournalTree (job, parent, name, is_folder)
+            VALUES (?,?,?,1);
+            """, (job, parent, name))
+        node = nodes[(parent, name)] = cursor.lastrowid
+    return node
+
+def write_entries(cursor, nodes, job, entries):
+    """
+    Inserts or replaces a list of
+    (path, drive_id, is_folder, size, mtime, status) entries of job.
+    """
+    files = [ ]
+    for path, drive_id, is_folder, size, mtime, status in entries:
+        if is_folder:
+            cursor.execute("""
+                UPDATE tbl_uploadJournalTree
+                SET drive_id = ?, size = ?, mtime = ?, status = ?
+                WHERE node = ?;
+                """, (drive_id, size, mtime, status, folder_node(cursor, nodes, job, path)))
+        else:
+            head, name = os.path.split(path)
+            files.append((job, folder_node(cursor, nodes, job, head), name, drive_id,
+                    size, mtime, status))
+    cursor.executemany("""
+        INSERT OR REPLACE INTO tbl_uploadJournalTree (
+            job,
+            parent,
+            name,
+            drive_id,
+            is_folder,
+            size,
+            mtime,
+            status
+        ) VALUES (
+            ?,?,?,?,0,?,?,?
+        );
+        """, files)
+
+class Journal(object):
+    """
+    The journal of one upload job, identified by a name such as the
+    source and destination of the upload. Safe to share between upload
+    threads.
+
+    Entries are written through a db.helper.Session and committed in
+    batches, so call commit() before acting on entries that must survive
+    a crash. The nodes of the job's folders are kept in memory once
+    something is recorded; its files are not.
+    """
+
+    def __init__(self, job, session=None):
+        self.job = job
+        self.owns_session = session is None
+        if session is None:
+            session = Session()
+        self.session = session
+        self.lock = threading.Lock()
+        self.nodes = None
+
+    def load(self):
+        """
+        Returns:
+            dict mapping each journaled path to a
+            (drive_id, is_folder, size, mtime, status) tuple
+        """
+        return dict(self.iter_entries())
+
+    def iter_entries(self):
+        """
+        Yields a (path, (drive_id, is_folder, size, mtime, status)) tuple
+        per journaled path, folders first, without holding the files in
+        memory.
+        """
+        paths = { }
+        with reading(self.session) as cursor:
+            # a folder's parent always has a lower node
+            cursor.execute("""
+                SELECT node, parent, name, drive_id, size, mtime, status
+                FROM tbl_uploadJournalTree
+                WHERE job = ? AND is_folder
+                ORDER BY node;
+                """, (self.job,))
+            for node, parent, name, drive_id, size, mtime, status in cursor.fetchall():
+                path = paths[node] = parent and os.path.join(paths[parent], name) or name
+                if status is not None:
+                    yield (path, (drive_id, True, size, mtime, status))
+            cursor.execute("""
+                SELECT parent, name, drive_id, size, mtime, status
+                FROM tbl_uploadJournalTree
+                WHERE job = ? AND NOT is_folder;
+                """, (self.job,))
+            for parent, name, drive_id, size, mtime, status in cursor:
+                yield (os.path.join(paths[parent], name), (drive_id, False, size, mtime, status))
+
+    def record(self, path, drive_id, is_folder, size, mtime, status):
+        """
+        Inserts or replaces the entry for path.
+        """
+        self.record_many([(path, drive_id, is_folder, size, mtime, status)])
+
+    def record_many(self, entries):
+        """
+        Inserts or replaces a list of
+        (path, drive_id, is_folder, size, mtime, status) entries.
+        """
+        with self.lock:
+            if self.nodes is None:
+                self.nodes = self.load_nodes()
+            with writing(self.session, len(entries)) as cursor:
+                write_entries(cursor, self.nodes, self.job, entries)
+
+    def load_nodes(self):
+        nodes = { }
+        with reading(self.session) as cursor:
+            cursor.execute("""
+                SELECT node, parent, name
+                FROM tbl_uploadJournalTree
+                WHERE job = ? AND is_folder;
+                """, (self.job,))
+            for node, parent, name in cursor:
+                nodes[(parent, name)] = node
+        return nodes
+
+    def record_folder(self, path, drive_id):
+        if drive_id:
+            self.record(path, drive_id, True, None, None, STATUS_DONE)
+        else:
+            self.record(path, None, True, None, None, STATUS_FAILED)
+
+    def commit(self):
+        self.session.commit()
+
+    def close(self):
+        if self.owns_session:
+            self.session.close()
+        else:
+            self.session.commit()
@@ -1,11 +1,11 @@
 #!/usr/bin/env python
 
 from helper import connect
+from journal import create_journal_schema, create_journal_tree_schema
+from uploads import create_upload_schema
+from hashcache import create_hashcache_schema
 
-def create_schema():
-    conn = connect()
-    cursor = conn.cursor()
-
+def create_tables(cursor):
     """
     tbl_files
         -> tbl_labels
@@ -13,7 +13,7 @@ def create_schema():
         -> tbl_userPermission
     """
     cursor.execute("""
-        CREATE TABLE tbl_files (
+        CREATE TABLE IF NOT EXISTS tbl_files (
             createdDate TEXT,
             description TEXT,
             downloadUrl TEXT,
@@ -36,7 +36,7 @@ def create_schema():
             <- tbl_files
     """
     cursor.execute("""
-        CREATE TABLE tbl_labels (
+        CREATE TABLE IF NOT EXISTS tbl_labels (
             files_id TEXT,
             hidden INTEGER,
             starred INTEGER,
@@ -50,7 +50,7 @@ def create_schema():
             <- tbl_files
     """
     cursor.execute("""
-        CREATE TABLE tbl_parentsCollection (
+        CREATE TABLE IF NOT EXISTS tbl_parentsCollection (
             files_id TEXT,
             parent_id TEXT,
             parentLink TEXT,
@@ -64,7 +64,7 @@ def create_schema():
             <- tbl_files
     """
     cursor.execute("""
-        CREATE TABLE tbl_userPermission (
+        CREATE TABLE IF NOT EXISTS tbl_userPermission (
             files_id TEXT,
             etag TEXT,
             kind TEXT,
@@ -74,8 +74,73 @@ def create_schema():
             );
         """)
 
-    conn.commit()
-    cursor.close()
+def create_indexes(cursor):
+    """
+    Indexes for lookups by title, parent and checksum, and for joining
+    the tables related to tbl_files.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_title ON tbl_files (title);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_md5Checksum ON tbl_files (md5Checksum);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_labels_files_id ON tbl_labels (files_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_parentsCollection_files_id ON tbl_parentsCollection (files_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_parentsCollection_parent_id ON tbl_parentsCollection (parent_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_userPermission_files_id ON tbl_userPermission (files_id);")
+
+def create_sync_state(cursor):
+    """
+    tbl_syncState
+        key/value pairs of the metadata sync, e.g. largestChangeId
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tbl_syncState (
+            key TEXT PRIMARY KEY,
+            value TEXT
+            );
+        """)
+
+"""
+Schema migrations. MIGRATIONS[i] takes the schema from version i to
+version i + 1; the version of a database is kept in PRAGMA user_version.
+Databases created before versioning are at version 0 and, as every step
+only creates what is missing, migrate cleanly. Append new steps, never
+change old ones.
+"""
+MIGRATIONS = [
+    create_tables,
+    create_journal_schema,
+    create_indexes,
+    create_sync_state,
+    create_upload_schema,
+    create_hashcache_schema,
+    create_journal_tree_schema,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate(conn):
+    """
+    Applies the migrations conn's database is missing.
+
+    Returns:
+        the schema version before migrating
+    """
+    version = get_schema_version(conn)
+    if version < SCHEMA_VERSION:
+        cursor = conn.cursor()
+        for i in range(version, SCHEMA_VERSION):
+            MIGRATIONS[i](cursor)
+            cursor.execute("PRAGMA user_version = %d;" % (i + 1))
+        conn.commit()
+        cursor.close()
+    return version
+
+def create_schema():
+    # connect() migrates
+    conn = connect()
+    conn.close()
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,79 @@
+"""
+Resumable upload sessions.
+
+Drive keeps the session URI of an interrupted resumable upload valid for
+about a week. Storing it lets an upload that was cut short by a crash
+or restart continue from the last byte the server received.
+"""
+
+import time
+
+from helper import Session, reading, writing
+
+# Drive expires sessions after a week; stop trusting them a day earlier.
+SESSION_LIFETIME = 6 * 24 * 3600
+
+def create_upload_schema(cursor):
+    """
+    tbl_uploadSession
+        one row per unfinished resumable upload
+
+    Applied by db.schema.migrate.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tbl_uploadSession (
+            key TEXT PRIMARY KEY,
+            uri TEXT,
+            created REAL
+            );
+        """)
+
+class UploadSessionStore(object):
+    """
+    Session URI store for gdrive.insert_file and gdrive.update_file.
+    Keys are built by gdrive.upload_key and change with the size and
+    mtime of the local file, so a modified file starts a new upload.
+    """
+
+    def __init__(self, session=None):
+        self.owns_session = session is None
+        if session is None:
+            session = Session()
+        self.session = session
+
+    def get(self, key):
+        """
+        Returns:
+            the session URI stored for key, or None
+        """
+        with reading(self.session) as cursor:
+            cursor.execute("""
+                SELECT uri, created FROM tbl_uploadSession WHERE key = ?;
+                """, (key,))
+            row = cursor.fetchone()
+        if row is None or row[1] < time.time() - SESSION_LIFETIME:
+            return None
+        return row[0]
+
+    def put(self, key, uri):
+        """
+        Stores uri for key and commits, so the session outlives a crash.
+        """
+        with writing(self.session) as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO tbl_uploadSession (key, uri, created)
+                VALUES (?,?,?);
+                """, (key, uri, time.time()))
+        self.session.commit()
+
+    def delete(self, key):
+        with writing(self.session) as cursor:
+            cursor.execute("""
+                DELETE FROM tbl_uploadSession WHERE key = ?;
+                """, (key,))
+
+    def close(self):
+        if self.owns_session:
+            self.session.close()
+        else:
+            self.session.commit()
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+from gdrive import gdrive
+from gdrive import retry
+from gdrive import stats
+from gdrive import trace
+from gdrive.pool import Results, WorkerPool
+from upload_tree import authenticate, get_service_object, new_service_object
+from db import hashcache as dbhashcache
+import argparse
+import collections
+import functools
+import os
+import re
+
+# Change '/' to ':' in titles so they can be used as file names,
+# the inverse of upload_tree.map_mac_filename.  NUL characters,
+# which no file name may contain, become '_', and so do the dots of
+# '.' and '..' and an empty title, which would name the folder itself
+# or its parent.
+def map_drive_title(title):
+    name = re.sub(r'/', ":", title).replace("\0", "_")
+    if name in ("", ".", ".."):
+        name = "_" * max(1, len(name))
+    return name
+
+# Local names for the children of a folder.  Drive allows several
+# children with the same title; all but the first get their id
+# appended so every one of them is restored.
+def local_names(items):
+    names = { }
+    used = set()
+    for item in items:
+        name = map_drive_title(item['title'])
+        if name in used:
+            base, ext = os.path.splitext(name)
+            name = "%s (%s)%s" % (base, item['id'], ext)
+        used.add(name)
+        names[item['id']] = name
+    return names
+
+# A file waiting to be downloaded to path
+DownloadJob = collections.namedtuple('DownloadJob', 'drive_file path')
+
+def local_copy_matches(path, drive_file, hashes=None):
+    md5 = drive_file.get('md5Checksum')
+    size = drive_file.get('fileSize')
+    if not md5 or size is None or not os.path.exists(path):
+        return False
+    if os.path.getsize(path) != int(size):
+        return False
+    if hashes:
+        return hashes.md5(path) == md5
+    return dbhashcache.md5_file(path) == md5
+
+# WorkerPool handler.  Skips files whose local copy already has the
+# right md5 and downloads the others, see
+# gdrive.download_file_to_path.  Checksums of local files come from
+# hashes (a db.hashcache.HashCache) when given.  Returns True on
+# success.
+def download_job(service, job, hashes=None):
+    drive_file = job.drive_file
+    if local_copy_matches(job.path, drive_file, hashes):
+        print("unchanged file:", job.path)
+        return True
+    size, code, reason = gdrive.download_file_to_path(service, drive_file, job.path)
+    if size is None:
+        print("failed to download file", job.path, code, reason)
+        return False
+    print("downloaded file:", job.path)
+    return True
+
+# Run download_job and count the job and its bytes in the stats as
+# done or failed.
+def count_job(hashes, service, job):
+    ok = download_job(service, job, hashes)
+    stats.default_stats.incr(ok and "files_done" or "files_failed")
+    stats.default_stats.incr(ok and "bytes_done" or "bytes_failed",
+            int(job.drive_file.get('fileSize', 0)))
+    return ok
+
+# Recreate the Drive folder tree below folder_id in destdir.
+# Folders are listed page by page on the calling thread; files are
+# downloaded as they are found, by a pool of worker threads when
+# workers > 1.  A folder with several parents in the tree, or one
+# reached again through a cycle, is only mirrored where it is
+# found first.  Google Docs have no downloadable content and are
+# skipped.  Local copies are compared through the hash cache in the
+# local database, so unchanged files are not read again on later
+# runs.
+#
+# Returns a pool.Results with the number of files and the paths of
+# the failed ones.
+def download_tree(service, folder_id, destdir, workers=1, service_factory=new_service_object):
+    hashes = dbhashcache.HashCache()
+    handler = functools.partial(count_job, hashes)
+    results = Results()
+    pool = None
+    if workers > 1:
+        pool = WorkerPool(service_factory, handler, workers,
+                on_result=lambda job, ok: results.add(job.path, ok))
+    pending = [(folder_id, destdir)]
+    seen = set([folder_id])
+    stats.default_stats.set("scanning", 1)
+    try:
+        while pending:
+            folder_id, folder_path = pending.pop()
+            if not os.path.isdir(folder_path):
+                os.makedirs(folder_path)
+            print("in folder:", folder_path)
+            items, code, reason = gdrive.list_children(service, folder_id)
+            if items is None:
+                print("failed to list folder", folder_path, code, reason)
+                continue
+            names = local_names(items)
+            for item in items:
+                path = os.path.join(folder_path, names[item['id']])
+                if item['mimeType'] == gdrive.FOLDER_MIMETYPE:
+                    if item['id'] in seen:
+                        print("already mirrored folder:", path)
+                        continue
+                    seen.add(item['id'])
+                    pending.append((item['id'], path))
+                elif not item.get('downloadUrl'):
+                    print("no content to download for", path)
+                else:
+                    job = DownloadJob(item, path)
+                    stats.default_stats.incr("files_queued")
+                    stats.default_stats.incr("bytes_queued", int(item.get('fileSize', 0)))
+                    if pool:
+                        pool.submit(job)
+                    else:
+                        results.add(path, handler(service, job))
+        stats.default_stats.set("scanning", 0)
+    finally:
+        if pool:
+            pool.join()
+        hashes.close()
+    return results
+
+def make_argparser():
+    """
+    ArgumentParser factory
+    """
+    parser = argparse.ArgumentParser(description="download_tree: download a google drive folder tree")
+
+    parser.add_argument("folder_id", help="id of the google drive folder to download")
+
+    parser.add_argument("destdir", help="local folder to download into")
+
+    parser.add_argument("--workers", help="number of files to download concurrently", type=int, default=1)
+
+    parser.add_argument("--progress", help="show a progress line with throughput, queue depth, retries and ETA", action="store_true")
+
+    parser.add_argument("--stats-file", help="dump stats periodically: a prometheus textfile if the name ends in .prom, JSON lines otherwise", metavar="<path>")
+
+    parser.add_argument("--stats-interval", help="seconds between progress and stats reports", type=float, default=10.0)
+
+    parser.add_argument("--profile", help="print the number, time and bytes of the drive requests per API method at exit", action="store_true")
+
+    parser.add_argument("--trace-file", help="append one JSON line per drive request to a file", metavar="<path>")
+
+    parser.add_argument("--cprofile", help="profile the main thread with cProfile; '-' prints the report at exit, a path saves it for pstats", metavar="<path>")
+
+    parser.add_argument("--rate", help="limit the requests per second, starting at this rate and adapting to rate limit errors (default: no limit until the first rate limit error)", type=float)
+
+    return parser
+
+if __name__ == "__main__":
+    parser = make_argparser()
+    args = parser.parse_args()
+    retry.configure(rate=args.rate)
+    authenticate('https://www.googleapis.com/auth/drive')
+    service = get_service_object()
+    trace.setup(args.profile, args.trace_file, args.cprofile)
+    reporter = None
+    if args.progress or args.stats_file:
+        reporter = stats.Reporter(interval=args.stats_interval, progress=args.progress,
+                path=args.stats_file).start()
+    try:
+        download_tree(service, args.folder_id, args.destdir, args.workers)
+    finally:
+        if reporter:
+            reporter.stop()
+        trace.close()
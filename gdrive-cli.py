@@ -21,13 +21,14 @@ Date: Fri Apr 27 16:00:35 EDT 2012
 Official Docs: https://developers.google.com/drive/
 """
 
+# Only what every command needs is imported here.  The Drive client
+# libraries (apiclient, oauth2client, httplib2) are slow to import, so
+# the commands that talk to Drive import them when they run and
+# local commands such as --list start quickly.
 import argparse
-from oauth import simple_cli
-from gdrive import gdrive
 from os import getenv
-import pickle
+import sys
 from db import helper as dbhelper
-from db import schema as dbschema
 
 def get_stored_credentials_path():
     home = getenv("HOME")
@@ -38,11 +39,18 @@ def get_stored_credentials_path():
 
     return home + "/.gdrive_oauth"
 
+# Services share the stored credentials and a cached discovery
+# document; get_service_object returns the calling thread's service,
+# new_service_object a fresh one for another worker thread.
 def get_service_object():
-    credentials = get_stored_credentials()
-    return gdrive.build_service(credentials)
+    return get_service_factory()()
+
+def new_service_object():
+    return get_service_factory().new()
 
 def store_credentials(scopes):
+    import pickle
+    from oauth import simple_cli
     credentials = simple_cli.authenticate(scopes)
     pickled_creds_path = get_stored_credentials_path()
     pickle.dump(credentials, open(pickled_creds_path, "wb"))
@@ -51,9 +59,19 @@ def authenticate(scopes=None):
     store_credentials(scopes)
 
 def get_stored_credentials():
+    import pickle
     pickled_creds_path = get_stored_credentials_path()
     return pickle.load(open(pickled_creds_path, "rb"))
 
+service_factory = None
+
+def get_service_factory():
+    global service_factory
+    if service_factory is None:
+        from gdrive import gdrive
+        service_factory = gdrive.ServiceFactory(get_stored_credentials)
+    return service_factory
+
 def make_argparser():
     """
     ArgumentParser factory 
@@ -71,8 +89,13 @@ def make_argparser():
 
     parser.add_argument("--list", help="list application's files (uses local database)", action="store_true")
 
+    parser.add_argument("--sync-metadata", help="copy the metadata of all drive files into the local database, then keep it current from the changes feed", action="store_true")
+
     parser.add_argument("--download", help="download file contents and print to stdout", metavar="<drive_file>")
 
+    parser.add_argument("--download-to", help="download file contents to a local file, resuming a partial download", nargs=2,
+            metavar=("<drive_file>", "<filename>"))
+
     parser.add_argument("--insert", help="insert new file", nargs=5,
             metavar=("<title -- must include file ext>", "<description>", "<parent_id (if none, pass none)>", "<mime_type>", "<filename>"))
 
@@ -86,6 +109,19 @@ def make_argparser():
             metavar=("<file_id>", "<new_title>", "<new_description>", "<new_mime_type>",
                 "<new_filename>", "<new_revision>"))
 
+    parser.add_argument("--batch", help="run JSON command lines from a file or stdin on one service and print JSON results", nargs="?", const="-",
+            metavar="<command_file>")
+
+    parser.add_argument("--serve", help="run a daemon answering JSON command lines on a unix socket", metavar="<socket_path>")
+
+    parser.add_argument("--connect", help="send JSON command lines from stdin to a --serve daemon", metavar="<socket_path>")
+
+    parser.add_argument("--profile", help="print the number, time and bytes of the drive requests per API method at exit", action="store_true")
+
+    parser.add_argument("--trace-file", help="append one JSON line per drive request to a file", metavar="<path>")
+
+    parser.add_argument("--cprofile", help="profile the main thread with cProfile; '-' prints the report at exit, a path saves it for pstats", metavar="<path>")
+
     return parser
 
 def handle_args(args):
@@ -93,10 +129,14 @@ def handle_args(args):
         handle_authenticate()
     elif args.list is True:
         handle_list()
+    elif args.sync_metadata is True:
+        handle_sync_metadata()
     elif args.show is not None:
         handle_show(args.show)
     elif args.download is not None:
         handle_download(args.download)
+    elif args.download_to is not None:
+        handle_download_to(args.download_to)
     elif args.insert is not None:
         handle_insert(args.insert)
     elif args.rename is not None:
@@ -107,20 +147,44 @@ def handle_args(args):
         handle_init_database()
     elif args.easy_rename is not None:
         handle_easy_rename(args.easy_rename)
+    elif args.batch is not None:
+        handle_batch(args.batch)
+    elif args.serve is not None:
+        handle_serve(args.serve)
+    elif args.connect is not None:
+        handle_connect(args.connect)
 
 def handle_authenticate():
     authenticate()
 
 def handle_show(file_id):
+    from gdrive import gdrive
     service = get_service_object()
     gdrive.print_file(service, file_id)
 
 def handle_download(file_id):
+    from gdrive import gdrive
     service = get_service_object()
-    download, code, reason = gdrive.download_file_by_id(service, file_id)
-    print download
+    size, code, reason = gdrive.download_file_by_id_to(service, file_id, sys.stdout)
+    if code != 200:
+        print >>sys.stderr, "Download failed: %s %s" % (code, reason)
+
+def handle_download_to(args):
+    from gdrive import gdrive
+    service = get_service_object()
+    file_id = args[0]
+    filename = args[1]
+
+    drive_file, code, reason = gdrive.get_file_instance(service, file_id)
+    if drive_file:
+        size, code, reason = gdrive.download_file_to_path(service, drive_file, filename)
+    if code == 200:
+        print "Downloaded %s to %s" % (file_id, filename)
+    else:
+        print "Download failed: %s %s" % (code, reason)
 
 def handle_insert(args):
+    from gdrive import gdrive
     service = get_service_object()
 
     title = args[0]
@@ -134,9 +198,12 @@ def handle_insert(args):
     filename = args[4]
 
     file, code, reason = gdrive.insert_file(service, title, description, parent_id, mime_type,
-            filename)
+            filename, fields=None)
 
-    id = dbhelper.insert_file(file)
+    if file is None:
+        print "Insert failed: %s %s" % (code, reason)
+        return
+    id = dbhelper.save_file(file)
     print "Inserted file ", id
 
 def handle_list():
@@ -145,7 +212,21 @@ def handle_list():
     for f in files:
         print "%(title)s\t\t%(id)s" % { "title" : f[0], "id" : f[1] }
 
+def handle_sync_metadata():
+    import sync_metadata
+    service = get_service_object()
+    session = dbhelper.Session()
+    try:
+        count, code, reason = sync_metadata.sync_metadata(service, session)
+    finally:
+        session.close()
+    if count is None:
+        print "Sync failed: %s %s" % (code, reason)
+    else:
+        print "Synced %d files" % count
+
 def rename_file(file_id, new_name):
+    from gdrive import gdrive
     service = get_service_object()
     gdrive.rename_file(service, file_id, new_name)
     dbhelper.rename_file(file_id, new_name)
@@ -171,6 +252,7 @@ def handle_easy_rename(args):
     rename_file(old_id, new_name)
 
 def handle_update(args):
+    from gdrive import gdrive
     service = get_service_object()
 
     file_id = args[0]
@@ -186,12 +268,45 @@ def handle_update(args):
         new_revision = True
         
 
-    file, code, reason = gdrive.update_file(service, file_id, new_title, new_description, new_mime_type, new_filename, new_revision)
+    file, code, reason = gdrive.update_file(service, file_id, new_title, new_description, new_mime_type, new_filename, new_revision,
+            fields=None)
 
-    id = dbhelper.update_file(file)
+    if file is None:
+        print "Update failed: %s %s" % (code, reason)
+        return
+    id = dbhelper.save_file(file)
     print "Updated file ", id
 
+def handle_batch(command_file):
+    import batch_commands
+    service = get_service_object()
+    session = dbhelper.Session()
+    try:
+        if command_file == "-":
+            batch_commands.run_stream(service, session, sys.stdin, sys.stdout)
+        else:
+            with open(command_file) as infile:
+                batch_commands.run_stream(service, session, infile, sys.stdout)
+    finally:
+        session.close()
+
+def handle_serve(socket_path):
+    import batch_commands
+    service = get_service_object()
+    session = dbhelper.Session()
+    try:
+        batch_commands.serve(socket_path, service, session)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.close()
+
+def handle_connect(socket_path):
+    import batch_commands
+    batch_commands.forward(socket_path, sys.stdin, sys.stdout)
+
 def handle_init_database():
+    from db import schema as dbschema
     print "Creating database..."
     dbschema.create_schema()
     print "done."
@@ -200,7 +315,15 @@ def handle_init_database():
 if __name__ == "__main__":
     parser = make_argparser()
     args = parser.parse_args()
-    handle_args(args)
+    if args.profile or args.trace_file or args.cprofile:
+        from gdrive import trace
+        trace.setup(args.profile, args.trace_file, args.cprofile)
+        try:
+            handle_args(args)
+        finally:
+            trace.close()
+    else:
+        handle_args(args)
 
 
 
@@ -0,0 +1,174 @@
+"""
+Concurrent client for Drive metadata operations.
+
+Each call returns a Future right away. A few worker threads, each with
+its own service object and keep-alive connection, take whatever calls
+are pending and send them as multipart batches of up to batch_size
+requests. One calling thread can so keep hundreds of requests in flight
+without a thread per request.
+
+    client = Client(new_service_object)
+    futures = [client.rename_file(file_id, title) for file_id, title in renames]
+    for future in futures:
+        file, code, reason = future.result()
+    client.close()
+"""
+
+from __future__ import absolute_import
+
+import Queue
+import sys
+import threading
+import traceback
+
+from gdrive.gdrive import Batch, BATCH_SIZE, FILE_FIELDS, FOLDER_FIELDS
+
+
+class Future(object):
+    """The pending (obj, code, reason) result of a Client call."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def set_result(self, value):
+        with self.lock:
+            self.value = value
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the call to complete.
+
+        Returns:
+            the (obj, code, reason) tuple of the call, or None if timeout
+            seconds passed first.
+        """
+        self.event.wait(timeout)
+        return self.value
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) on completion, at once if already done."""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+
+class Client(object):
+    """Runs gdrive metadata calls concurrently in batches.
+
+    The get_file_instance, find_file, find_folder, insert_folder,
+    rename_file and delete_file_by_id methods take the same arguments as
+    the gdrive module functions of the same name, minus the service, and
+    return a Future of the same (obj, code, reason) tuple.
+
+    Args:
+        service_factory: callable returning a new Drive service object.
+        connections: number of worker threads and HTTP connections.
+        batch_size: maximum number of calls per HTTP round trip.
+        linger: seconds a worker waits for more calls to fill a batch.
+    """
+
+    def __init__(self, service_factory, connections=4, batch_size=BATCH_SIZE, linger=0.01):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.calls = Queue.Queue()
+        self.threads = []
+
+        # Build the services up front so credential problems surface in
+        # the caller instead of killing a worker thread.
+        services = [service_factory() for i in range(connections)]
+        for i, service in enumerate(services):
+            thread = threading.Thread(target=self.run, args=(service,),
+                    name="gdrive-client-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def call(self, name, *args):
+        """Queues the Batch method name with args.
+
+        Returns:
+            Future of the call's (obj, code, reason) tuple.
+        """
+        future = Future()
+        self.calls.put((name, args, future))
+        return future
+
+    def get_file_instance(self, file_id, fields=FILE_FIELDS):
+        return self.call('get_file_instance', file_id, fields)
+
+    def find_file(self, title, parent=None, fields=FILE_FIELDS):
+        return self.call('find_file', title, parent, fields)
+
+    def find_folder(self, title, parent=None, fields=FOLDER_FIELDS):
+        return self.call('find_folder', title, parent, fields)
+
+    def insert_folder(self, title, description, parent_id, fields=FOLDER_FIELDS):
+        return self.call('insert_folder', title, description, parent_id, fields)
+
+    def rename_file(self, file_id, new_title, fields='title'):
+        return self.call('rename_file', file_id, new_title, fields)
+
+    def delete_file_by_id(self, file_id):
+        return self.call('delete_file_by_id', file_id)
+
+    def next_calls(self):
+        """Blocks for a call, then collects more for up to linger seconds.
+
+        Returns:
+            (calls, stop): the calls to send in one batch, and whether the
+            worker was asked to stop.
+        """
+        call = self.calls.get()
+        if call is None:
+            return ([], True)
+        calls = [call]
+        while len(calls) < self.batch_size:
+            try:
+                call = self.calls.get(timeout=self.linger)
+            except Queue.Empty:
+                break
+            if call is None:
+                return (calls, True)
+            calls.append(call)
+        return (calls, False)
+
+    def run(self, service):
+        stop = False
+        while not stop:
+            calls, stop = self.next_calls()
+            if not calls:
+                continue
+            batch = Batch(service, self.batch_size)
+            try:
+                for name, args, future in calls:
+                    getattr(batch, name)(*args)
+                results = batch.execute()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                results = [(None, 500, 'clientError')] * len(calls)
+            for (name, args, future), result in zip(calls, results):
+                future.set_result(result)
+
+    def close(self):
+        """Waits for all queued calls and stops the workers."""
+        for thread in self.threads:
+            self.calls.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
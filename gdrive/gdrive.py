@@ -1,12 +1,28 @@
+from __future__ import absolute_import
+
 from apiclient import errors
 from apiclient.discovery import build
+from apiclient.discovery import build_from_document
+from apiclient.http import BatchHttpRequest
+from apiclient.http import HttpRequest
 from apiclient.http import MediaFileUpload
+from apiclient.http import MediaUploadProgress
 import cgi
+import httplib
 import httplib2
 import os
 import simplejson
+import socket
 import sys
+import threading
+import time
 import traceback
+import urlparse
+
+from db.hashcache import md5_file
+from gdrive import retry
+from gdrive import stats
+from gdrive import trace
 
 """
 Google Drive python module. The code in this file is taken directly from
@@ -35,26 +51,129 @@ Copyright 2012 Thomas Dignan <tom@tomdignan.com>
 # Service Object (do this first)                                                                                             #
 ################################################################################
 
-def build_service(credentials):
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v2/rest'
+# Seconds the cached discovery document is used before it is fetched again.
+DISCOVERY_CACHE_SECONDS = 24*3600
+
+_discovery_document = None
+
+def get_discovery_cache_path():
+    home = os.getenv("HOME")
+
+    # windows compat
+    if home is None:
+        home = os.getenv("HOMEPATH")
+
+    return home + os.path.sep + ".gdrive_discovery.json"
+
+def load_discovery_document(http):
+    """Get the Drive v2 discovery document, from memory or disk if possible.
+
+    Args:
+        http: httplib2.Http to fetch the document with when the cached copy
+            is missing or older than DISCOVERY_CACHE_SECONDS.
+    Returns:
+        The discovery document as a JSON string.
+    """
+    global _discovery_document
+    if _discovery_document is not None:
+        return _discovery_document
+    path = get_discovery_cache_path()
+    try:
+        if time.time() - os.path.getmtime(path) < DISCOVERY_CACHE_SECONDS:
+            _discovery_document = open(path, 'rb').read()
+            return _discovery_document
+    except (IOError, OSError):
+        pass
+    resp, content = http.request(DISCOVERY_URL)
+    if resp.status >= 400:
+        raise errors.HttpError(resp, content, uri=DISCOVERY_URL)
+    try:
+        # write and rename, so concurrent processes never read half a file
+        tmp_path = '%s.%d' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+    except (IOError, OSError), error:
+        print >>sys.stderr, 'could not cache discovery document: %s' % error
+    _discovery_document = content
+    return content
+
+def new_http():
+    """
+    Returns:
+        an httplib2.Http that does not follow 308 responses and counts
+        the bytes it transfers for the trace module. Resumable uploads
+        answer each chunk with 308 Resume Incomplete, which httplib2 0.16
+        and later would otherwise treat as a redirect.
+    """
+    http = httplib2.Http()
+    if hasattr(http, 'redirect_codes'):
+        http.redirect_codes = http.redirect_codes - set([308])
+    return trace.instrument(http)
+
+def build_service(credentials, http=None):
     """Build a Drive service object.
 
     Args:
         credentials: OAuth 2.0 credentials.
+        http: httplib2.Http to authorize and send requests with; a new one
+            if None.
 
     Returns:
         Drive service object.
     """
-    http = httplib2.Http()
+    if http is None:
+        http = new_http()
     http = credentials.authorize(http)
-    return build('drive', 'v2', http=http)
+    return build_from_document(load_discovery_document(http), http=http,
+            requestBuilder=DriveRequest)
+
+class ServiceFactory(object):
+    """Hand out Drive service objects built from one set of credentials.
+
+    Calling the factory returns the calling thread's service object,
+    building it the first time, so the commands and helpers running on a
+    thread share its keep-alive connection instead of each opening one
+    with a TLS handshake of its own. new() always builds another service,
+    for callers such as WorkerPool that give one to each of their threads.
+
+    Args:
+        load_credentials: callable returning OAuth 2.0 credentials; called
+            once, on first use.
+    """
+
+    def __init__(self, load_credentials):
+        self.load_credentials = load_credentials
+        self.credentials = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_credentials(self):
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = self.load_credentials()
+            return self.credentials
+
+    def new(self):
+        return build_service(self.get_credentials())
+
+    def __call__(self):
+        service = getattr(self.local, 'service', None)
+        if service is None:
+            service = self.new()
+            self.local.service = service
+        return service
 
 ################################################################################
-# Error handling: we re-raise errors that can be retried
+# Error handling: requests are sent through the retry module, which
+# retries rate limit errors, and 5xx responses and socket errors of
+# requests that do not create anything.
 # See https://developers.google.com/drive/handle-errors                                                                                                                         #
 ################################################################################
 
 def is_rate_limited_error(code, reason):
-    return (code == 403 or code == 503) and reason in ['rateLimitExceeded', 'userRateLimitExceeded']
+    return retry.is_rate_limited(code, reason)
     
 def http_error_tuple(rv, content):
     print 'An error occurred: %s' % content
@@ -70,6 +189,28 @@ def http_error_tuple(rv, content):
         traceback.print_exc(file=sys.stdout)
     return (rv, 500, 'parseError')
 
+################################################################################
+# Partial responses: every call asks only for the fields its callers
+# use by default.  Pass fields=None for the whole resource.
+# See https://developers.google.com/drive/v2/web/performance#partial-response
+################################################################################
+
+# What callers of get_file_instance, insert_file and update_file use,
+# including the downloads
+FILE_FIELDS = 'id,title,mimeType,fileSize,md5Checksum,modifiedDate,downloadUrl'
+
+FOLDER_FIELDS = 'id,title'
+
+# Everything db.helper.save_files stores
+METADATA_FIELDS = ('id,title,mimeType,description,fileExtension,fileSize,md5Checksum,'
+        'createdDate,modifiedDate,modifiedByMeDate,lastViewedByMeDate,downloadUrl,'
+        'etag,kind,labels,parents(id,parentLink),userPermission')
+
+def fields_param(param, fields):
+    if fields:
+        param['fields'] = fields
+    return param
+
 ################################################################################
 # Files: get                                                                                                                                     #
 ################################################################################
@@ -82,7 +223,8 @@ def print_file(service, file_id):
         file_id: ID of the file to print metadata for.
     """
     try:
-        file = service.files().get(fileId=file_id).execute()
+        file = retry.execute(service.files().get(fileId=file_id,
+                fields='title,description,mimeType'))
 
         print 'Title: %s' % file['title']
         print 'Description: %s' % file['description']
@@ -91,18 +233,22 @@ def print_file(service, file_id):
     except errors.HttpError, error:
         return http_error_tuple(False, error.content)
 
-def get_file_instance(service, file_id):
-    """Print a file's metadata.
+def get_file_request(service, file_id, fields=FILE_FIELDS):
+    return service.files().get(**fields_param({'fileId': file_id}, fields))
+
+def get_file_instance(service, file_id, fields=FILE_FIELDS):
+    """Get a file's metadata.
 
     Args:
         service: Drive API service instance.
-        file_id: ID of the file to print metadata for.
+        file_id: ID of the file to get metadata for.
+        fields: partial response selector, None for all fields.
 
     Returns:
         file instance or None
     """
     try:
-        file = service.files().get(fileId=file_id).execute()
+        file = retry.execute(get_file_request(service, file_id, fields))
         return (file, 200, '')
     except errors.HttpError, error:
         print "error %s" % error
@@ -111,36 +257,159 @@ def get_file_instance(service, file_id):
 def query_escape(s):
     return s.replace("'", "\\'")
 
-def find_file(service, title, parent=None):
-    query = "mimeType != 'application/vnd.google-apps.folder' and title = '%s'" % query_escape(title)
+def first_item(files):
+    # a partial response leaves out an empty items list
+    for file in files.get('items', []):
+        return (file, 200, '')
+    return (None, 404, 'notFound')
+
+def find_file_request(service, title, parent=None, fields=FILE_FIELDS):
+    query = "mimeType != 'application/vnd.google-apps.folder' and title = '%s' and trashed = false" % \
+            query_escape(title)
     if parent:
         query += (" and '%s' in parents" % parent)
     param = { }
     param['q'] = query
     param['maxResults'] = 10
+    if fields:
+        param['fields'] = 'items(%s)' % fields
+    return service.files().list(**param)
+
+def find_file(service, title, parent=None, fields=FILE_FIELDS):
     try:
-        files = service.files().list(**param).execute()
-        for file in files['items']:
-            return (file, 200, '')
-        return (None, 404, 'notFound')
+        files = retry.execute(find_file_request(service, title, parent, fields))
+        return first_item(files)
     except errors.HttpError, error:
         return http_error_tuple(None, error.content)
 
-def find_folder(service, title, parent=None):
+def find_folder_request(service, title, parent=None, fields=FOLDER_FIELDS):
     query = "mimeType = 'application/vnd.google-apps.folder' and title = '%s'" % query_escape(title)
     if parent:
         query += (" and '%s' in parents" % parent)
     param = { }
     param['q'] = query
     param['maxResults'] = 10
+    if fields:
+        param['fields'] = 'items(%s)' % fields
+    return service.files().list(**param)
+
+def find_folder(service, title, parent=None, fields=FOLDER_FIELDS):
+    try:
+        files = retry.execute(find_folder_request(service, title, parent, fields))
+        return first_item(files)
+    except errors.HttpError, error:
+        return http_error_tuple(None, error.content)
+
+################################################################################
+# Files: list
+################################################################################
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+def list_pages(method, callback, **param):
+    """Execute a list method page by page, following nextPageToken.
+
+    Args:
+        method: list method of a collection, e.g. service.files().list
+        callback: called with each page as it arrives.
+        param: arguments of the list method.
+    Returns:
+        the last page if successful, None otherwise.
+    """
     try:
-        files = service.files().list(**param).execute()
-        for folder in files['items']:
-            return (folder, 200, '')
-        return (None, 404, 'notFound')
+        while True:
+            page = retry.execute(method(**param))
+            callback(page)
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                return (page, 200, '')
+            param['pageToken'] = page_token
     except errors.HttpError, error:
         return http_error_tuple(None, error.content)
 
+def list_files(service, query, max_results=1000, fields=None):
+    """List every file matching a query, following nextPageToken.
+
+    Args:
+        service: Drive API service instance.
+        query: search query, see https://developers.google.com/drive/v2/web/search-parameters
+        max_results: page size; Drive caps this at 1000.
+        fields: optional partial response selector for each page.
+    Returns:
+        list of file instances if successful, None otherwise.
+    """
+    param = { }
+    param['q'] = query
+    param['maxResults'] = max_results
+    if fields:
+        param['fields'] = fields
+    items = [ ]
+    page, code, reason = list_pages(service.files().list,
+            lambda files: items.extend(files.get('items', [])), **param)
+    if page is None:
+        return (None, code, reason)
+    return (items, 200, '')
+
+def list_folders(service, max_results=1000):
+    """List every folder visible to the user with its parents.
+
+    Returns:
+        list of folder instances with id, title and parents if successful,
+        None otherwise.
+    """
+    query = "mimeType = '%s' and trashed = false" % FOLDER_MIMETYPE
+    return list_files(service, query, max_results,
+            fields='nextPageToken,items(id,title,parents(id))')
+
+def list_children(service, folder_id, max_results=1000):
+    """List the files and folders directly inside a folder.
+
+    Returns:
+        list of file instances with the fields needed to download them if
+        successful, None otherwise.
+    """
+    query = "'%s' in parents and trashed = false" % folder_id
+    return list_files(service, query, max_results,
+            fields='nextPageToken,items(id,title,mimeType,fileSize,md5Checksum,downloadUrl)')
+
+################################################################################
+# Changes
+# See https://developers.google.com/drive/v2/web/manage-changes
+################################################################################
+
+def get_largest_change_id(service):
+    """Get the id of the most recent change visible to the user.
+
+    Returns:
+        largest change id as a string if successful, None otherwise.
+    """
+    try:
+        about = retry.execute(service.about().get(fields='largestChangeId'))
+        return (about['largestChangeId'], 200, '')
+    except errors.HttpError, error:
+        return http_error_tuple(None, error.content)
+
+def list_changes(service, start_change_id, callback, max_results=1000, fields=None):
+    """Page through the changes since start_change_id, deletions included.
+
+    Args:
+        service: Drive API service instance.
+        start_change_id: id of the first change to list.
+        callback: called with each page of changes as it arrives.
+        max_results: page size.
+        fields: optional partial response selector for each page.
+    Returns:
+        the last page, which carries largestChangeId, if successful, None
+        otherwise.
+    """
+    param = { }
+    param['startChangeId'] = start_change_id
+    param['includeDeleted'] = True
+    param['maxResults'] = max_results
+    if fields:
+        param['fields'] = fields
+    return list_pages(service.changes().list, callback, **param)
+
 def download_file_by_id(service, file_id):
     """
     Download file content by id
@@ -162,20 +431,289 @@ def download_file(service, drive_file):
     """
     download_url = drive_file.get('downloadUrl')
     if download_url:
-        resp, content = service._http.request(download_url)
+        resp, content = retry.request(service._http, download_url)
         print 'Status: %s' % resp
         if resp.status == 200:
+            stats.default_stats.incr('bytes_downloaded', len(content))
             return (content, 200, '')
         else:
             return (None, resp.status, repr(resp))
     # The file doesn't have any content stored on Drive.
     return (None, 200, '')
 
+DOWNLOAD_CHUNKSIZE = 4*2**20
+
+def download_file_by_id_to(service, file_id, out, chunksize=DOWNLOAD_CHUNKSIZE):
+    """
+    Stream file content by id to a file object
+    """
+    drive_file, code, reason = get_file_instance(service, file_id)
+    if drive_file:
+        return download_file_to(service, drive_file, out, chunksize)
+    return (None, code, reason)
+
+def download_file_to(service, drive_file, out, chunksize=DOWNLOAD_CHUNKSIZE, offset=0):
+    """Stream a file's content to a file object.
+
+    The content is fetched in HTTP Range requests of chunksize bytes and
+    each chunk is written out before the next one is requested, so memory
+    use is bounded by chunksize. A chunk that fails with a dropped
+    connection or a 5xx response is retried, so the download continues
+    from the last byte written.
+
+    Args:
+        service: Drive API service instance.
+        drive_file: Drive File instance.
+        out: file object to write to, positioned at offset.
+        chunksize: number of bytes per request.
+        offset: number of bytes already written, to continue an earlier
+            download.
+
+    Returns:
+        Total number of bytes written (including offset) if successful,
+        None otherwise.
+    """
+    download_url = drive_file.get('downloadUrl')
+    if not download_url:
+        # The file doesn't have any content stored on Drive.
+        return (None, 200, '')
+
+    size = drive_file.get('fileSize')
+    if size is not None:
+        size = int(size)
+    while size is None or offset < size:
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + chunksize - 1)}
+        try:
+            resp, content = retry.request(service._http, download_url, headers=headers)
+        except (socket.error, httplib.HTTPException), error:
+            return (None, 500, repr(error))
+
+        if resp.status in [200, 206]:
+            # error response bodies are not content
+            stats.default_stats.incr('bytes_downloaded', len(content))
+        if resp.status == 206:
+            out.write(content)
+            offset += len(content)
+            if size is None:
+                # Content-Range: bytes 0-1023/4096
+                size = int(resp['content-range'].split('/')[1])
+            if not content:
+                break
+        elif resp.status == 200:
+            # The server ignored the range and sent everything.
+            out.write(content[offset:])
+            offset = len(content)
+            break
+        elif resp.status == 416:
+            # Nothing left after offset.
+            break
+        else:
+            return (None, resp.status, repr(resp))
+    out.flush()
+    return (offset, 200, '')
+
+# Suffix of the file a download is written to until it is complete
+PART_SUFFIX = '.part'
+
+def download_file_to_path(service, drive_file, path, chunksize=DOWNLOAD_CHUNKSIZE):
+    """Stream a file's content to a local file, resuming a partial copy.
+
+    The content is written to path + PART_SUFFIX and renamed to path
+    once it is complete and matches md5Checksum, so whatever is at path
+    is never taken for part of the download. A part file left by an
+    earlier, interrupted call is continued; if the result does not match
+    md5Checksum, the download starts over from the first byte once.
+
+    Returns:
+        Size of the local file if successful, None otherwise.
+    """
+    part_path = path + PART_SUFFIX
+    size = drive_file.get('fileSize')
+    md5 = drive_file.get('md5Checksum')
+    for attempt in range(2):
+        offset = 0
+        if attempt == 0 and os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+            if size is None or offset > int(size):
+                offset = 0
+        out = open(part_path, offset and "ab" or "wb")
+        try:
+            written, code, reason = download_file_to(service, drive_file, out, chunksize, offset)
+        finally:
+            out.close()
+        if written is None:
+            return (None, code, reason)
+        if not md5 or md5_file(part_path) == md5:
+            try:
+                os.rename(part_path, path)
+            except OSError:
+                # windows does not rename over an existing file
+                os.remove(path)
+                os.rename(part_path, path)
+            return (written, 200, '')
+        print 'md5 mismatch for %s' % path
+    os.remove(part_path)
+    return (None, 500, 'md5Mismatch')
+
+################################################################################
+# Resumable uploads
+# See https://developers.google.com/drive/v2/web/manage-uploads#resumable
+################################################################################
+
+# Files above this size are uploaded in chunks.
+RESUMABLE_THRESHOLD = 5*2**20
+UPLOAD_CHUNKSIZE = 8*2**20
+# Chunk sizes must be multiples of 256 KiB.
+UPLOAD_CHUNK_UNIT = 256*2**10
+MIN_UPLOAD_CHUNKSIZE = UPLOAD_CHUNK_UNIT
+MAX_UPLOAD_CHUNKSIZE = 256*2**20
+# Adaptive chunk sizing aims for chunks that take this many seconds:
+# long enough to keep a fast link busy, short enough that a failed
+# chunk is cheap to send again.
+UPLOAD_CHUNK_SECONDS = 5.0
+
+def upload_key(filename, *target):
+    """Key of the resumable upload session for filename.
+
+    Args:
+        filename: local file being uploaded.
+        target: anything else identifying the upload, such as the parent
+            folder id and title, or the id of the updated file.
+    Returns:
+        a string that changes when the size or mtime of filename does.
+    """
+    st = os.stat(filename)
+    return '|'.join([os.path.abspath(filename), str(st.st_size), str(int(st.st_mtime))] +
+            [str(t) for t in target])
+
+def round_chunksize(chunksize):
+    chunksize = max(MIN_UPLOAD_CHUNKSIZE, min(MAX_UPLOAD_CHUNKSIZE, chunksize))
+    return chunksize - chunksize % UPLOAD_CHUNK_UNIT
+
+def next_chunksize(chunksize, seconds):
+    """Doubles chunksize after a fast chunk and halves it after a slow one."""
+    if seconds < UPLOAD_CHUNK_SECONDS / 2:
+        return round_chunksize(chunksize * 2)
+    if seconds > UPLOAD_CHUNK_SECONDS * 2:
+        return round_chunksize(chunksize / 2)
+    return chunksize
+
+class ChunkedMediaFileUpload(MediaFileUpload):
+    """MediaFileUpload whose chunk size can change between chunks."""
+
+    def set_chunksize(self, chunksize):
+        self._chunksize = chunksize
+
+def make_media_body(filename, mime_type, chunksize=None):
+    """MediaFileUpload for filename, resumable if the file is large.
+
+    Args:
+        chunksize: initial chunk size of resumable uploads, in bytes;
+            UPLOAD_CHUNKSIZE if None.
+    """
+    if os.path.getsize(filename) > RESUMABLE_THRESHOLD:
+        return ChunkedMediaFileUpload(filename, mimetype=mime_type,
+                chunksize=round_chunksize(chunksize or UPLOAD_CHUNKSIZE), resumable=True)
+    return MediaFileUpload(filename, mimetype=mime_type)
+
+class DriveRequest(HttpRequest):
+    """HttpRequest whose resumable upload can continue a stored session
+    or start over; build_service makes every request one.
+
+    apiclient expects a Range header in every 308 Resume Incomplete
+    response, but Drive leaves it out until it has received the first
+    byte; such a response means the upload continues from the start.
+    """
+
+    def resume(self, resumable_uri):
+        """Continue the upload session at resumable_uri: the next
+        next_chunk() first asks the server how much it has received."""
+        self.resumable_uri = resumable_uri
+        self._in_error_state = True
+
+    def restart(self):
+        """Start a new upload session with the next next_chunk()."""
+        self.resumable_uri = None
+        self.resumable_progress = 0
+        self._in_error_state = False
+
+    def _process_response(self, resp, content):
+        if resp.status == 308 and 'range' not in resp:
+            self._in_error_state = False
+            self.resumable_progress = 0
+            if 'location' in resp:
+                self.resumable_uri = resp['location']
+            return (MediaUploadProgress(0, self.resumable.size()), None)
+        return HttpRequest._process_response(self, resp, content)
+
+def execute_upload(request, store=None, key=None, progress=None, adaptive=True):
+    """Execute a request, one chunk at a time if it uploads resumable media.
+
+    Chunks go out one after the other: the resumable protocol has a single
+    write offset per session, so they cannot be sent in parallel.
+
+    Args:
+        request: DriveRequest, e.g. from files().insert or files().update.
+        store: optional object with get(key), put(key, uri) and delete(key)
+            methods, such as db.uploads.UploadSessionStore, used to keep the
+            session URI so another process can continue the upload.
+        key: key of the upload in store, see upload_key.
+        progress: optional callable(bytes_sent, total_bytes) called after
+            every chunk.
+        adaptive: whether to grow and shrink the chunk size with the time
+            each chunk takes.
+    Returns:
+        The response body.
+    Raises:
+        apiclient.errors.HttpError once the upload cannot be retried any more.
+    """
+    media = request.resumable
+    if media is None:
+        body = retry.execute(request)
+        stats.default_stats.incr('bytes_uploaded', request.body_size)
+        return body
+    if key is None:
+        store = None
+    stored_uri = store and store.get(key)
+    if stored_uri:
+        request.resume(stored_uri)
+
+    restarted = False
+    body = None
+    sent = 0
+    while body is None:
+        started = time.time()
+        try:
+            # after a failed chunk, next_chunk asks the server where to
+            # continue before sending the next one
+            status, body = retry.call(request.next_chunk, method='%s.chunk' % request.methodId)
+        except errors.HttpError, error:
+            if error.resp.status not in [404, 410] or not request.resumable_uri or restarted:
+                raise
+            # The session expired; start a new one.
+            restarted = True
+            request.restart()
+            continue
+        if store and request.resumable_uri != stored_uri and body is None:
+            stored_uri = request.resumable_uri
+            store.put(key, stored_uri)
+        progress_bytes = request.resumable_progress if body is None else media.size()
+        stats.default_stats.incr('bytes_uploaded', max(0, progress_bytes - sent))
+        sent = progress_bytes
+        if progress:
+            progress(progress_bytes, media.size())
+        if adaptive and isinstance(media, ChunkedMediaFileUpload):
+            media.set_chunksize(next_chunksize(media.chunksize(), time.time() - started))
+    if stored_uri:
+        store.delete(key)
+    return body
+
 ################################################################################
 # Files: insert                                                                                                                                #
 ################################################################################
 
-def insert_file(service, title, description, parent_id, mime_type, filename):
+def insert_file(service, title, description, parent_id, mime_type, filename,
+                chunksize=None, store=None, progress=None, fields=FILE_FIELDS):
     """Insert new file.
 
     Args:
@@ -185,13 +723,14 @@ def insert_file(service, title, description, parent_id, mime_type, filename):
         parent_id: Parent folder's ID.
         mime_type: MIME type of the file to insert.
         filename: Filename of the file to insert.
+        chunksize: initial chunk size for large files, see make_media_body.
+        store: resumable session store, see execute_upload.
+        progress: progress callback, see execute_upload.
+        fields: partial response selector, None for all fields.
     Returns:
         Inserted file metadata if successful, None otherwise.
     """
-    if os.path.getsize(filename) > 5*2**20:
-        media_body = MediaFileUpload(filename, mimetype=mime_type, chunksize=1024*1024, resumable=True)
-    else:
-        media_body = MediaFileUpload(filename, mimetype=mime_type)
+    media_body = make_media_body(filename, mime_type, chunksize)
     body = {
         'title': title,
         'description': description,
@@ -203,9 +742,10 @@ def insert_file(service, title, description, parent_id, mime_type, filename):
         body['parents'] = [{'id': parent_id}]
 
     try:
-        file = service.files().insert(
-                body=body,
-                media_body=media_body).execute()
+        file = execute_upload(service.files().insert(**fields_param({
+                'body': body,
+                'media_body': media_body}, fields)),
+                store, upload_key(filename, parent_id, title), progress)
 
         # Uncomment the following line to print the File ID
         # print 'File ID: %s' % file['id']
@@ -219,7 +759,7 @@ def insert_file(service, title, description, parent_id, mime_type, filename):
 # Files: insert                                                                                                                                #
 ################################################################################
 
-def insert_folder(service, title, description, parent_id):
+def insert_folder(service, title, description, parent_id, fields=FOLDER_FIELDS):
     """Insert new folder.
 
     Args:
@@ -227,9 +767,22 @@ def insert_folder(service, title, description, parent_id):
         title: Title of the folder to insert, including the extension.
         description: Description of the folder to insert.
         parent_id: Parent folder's ID.
+        fields: partial response selector, None for all fields.
     Returns:
         Inserted folder metadata if successful, None otherwise.
     """
+    try:
+        folder = retry.execute(insert_folder_request(service, title, description, parent_id,
+                fields))
+
+        # Uncomment the following line to print the Folder ID
+        # print 'Folder ID: %s' % folder['id']
+
+        return (folder, 200, '')
+    except errors.HttpError, error:
+        return http_error_tuple(None, error.content)
+
+def insert_folder_request(service, title, description, parent_id, fields=FOLDER_FIELDS):
     body = {
         'title': title,
         'description': description,
@@ -240,45 +793,38 @@ def insert_folder(service, title, description, parent_id):
     if parent_id:
         body['parents'] = [{'id': parent_id}]
 
-    try:
-        folder = service.files().insert(
-                body=body).execute()
-
-        # Uncomment the following line to print the Folder ID
-        # print 'Folder ID: %s' % folder['id']
-
-        return (folder, 200, '')
-    except errors.HttpError, error:
-        return http_error_tuple(None, error.content)
+    return service.files().insert(**fields_param({'body': body}, fields))
 
 
 ################################################################################
 # Files: patch                                                                                                                                #
 ################################################################################
 
-def rename_file(service, file_id, new_title):
+def rename_file(service, file_id, new_title, fields='title'):
     """Rename a file.
 
     Args:
         service: Drive API service instance.
         file_id: ID of the file to rename.
         new_title: New title for the file.
+        fields: partial response selector, None for all fields.
     Returns:
         Updated file metadata if successful, None otherwise.
     """
     try:
-        file = {'title': new_title}
-
         # Rename the file.
-        updated_file = service.files().patch(
-                fileId=file_id,
-                body=file,
-                fields='title').execute()
+        updated_file = retry.execute(rename_file_request(service, file_id, new_title, fields))
 
         return (updated_file, 200, '')
     except errors.HttpError, error:
         return http_error_tuple(None, error.content)
 
+def rename_file_request(service, file_id, new_title, fields='title'):
+    file = {'title': new_title}
+    return service.files().patch(**fields_param({
+            'fileId': file_id,
+            'body': file}, fields))
+
 ################################################################################
 # Files: delete                                                                                                                                #
 ################################################################################
@@ -293,13 +839,64 @@ def delete_file_by_id(service, file_id):
         Success status message if successful, None otherwise.
     """
     try:
-        delete_file = service.files().delete(
-            fileId=file_id).execute()
+        delete_file = retry.execute(delete_file_request(service, file_id))
 
         return (file_id, 200, '')
     except errors.HttpError, error:
         return http_error_tuple(None, error.content)
-        
+
+def delete_file_request(service, file_id):
+    return service.files().delete(fileId=file_id)
+
+
+################################################################################
+# Files: copy
+################################################################################
+
+def copy_file(service, file_id, title, parent_id, fields=FILE_FIELDS):
+    """Copy a file on the server.
+
+    Args:
+        service: Drive API service instance.
+        file_id: ID of the file to copy.
+        title: Title of the copy.
+        parent_id: ID of the folder to put the copy in.
+        fields: partial response selector, None for all fields.
+    Returns:
+        Metadata of the copy if successful, None otherwise.
+    """
+    body = {
+        'title': title,
+        'parents': [{'id': parent_id}]
+    }
+    try:
+        file = retry.execute(service.files().copy(**fields_param(
+                {'fileId': file_id, 'body': body}, fields)))
+        return (file, 200, '')
+    except errors.HttpError, error:
+        return http_error_tuple(None, error.content)
+
+################################################################################
+# Parents: insert
+################################################################################
+
+def add_parent(service, file_id, parent_id, fields='id,parentLink'):
+    """Add a folder to the parents of a file, so it also shows up there.
+
+    Args:
+        service: Drive API service instance.
+        file_id: ID of the file.
+        parent_id: ID of the additional parent folder.
+        fields: partial response selector, None for all fields.
+    Returns:
+        The new parent reference if successful, None otherwise.
+    """
+    try:
+        parent = retry.execute(service.parents().insert(**fields_param(
+                {'fileId': file_id, 'body': {'id': parent_id}}, fields)))
+        return (parent, 200, '')
+    except errors.HttpError, error:
+        return http_error_tuple(None, error.content)
 
 
 ################################################################################
@@ -307,9 +904,14 @@ def delete_file_by_id(service, file_id):
 ################################################################################
 
 def update_file(service, file_id, new_title, new_description, new_mime_type,
-                                new_filename, new_revision):
+                                new_filename, new_revision, chunksize=None, store=None, progress=None,
+                                fields=FILE_FIELDS):
     """Update an existing file's metadata and content.
 
+    Only the new metadata is sent: files.update has patch semantics in
+    Drive v2, so the file need not be fetched first.  Without
+    new_filename only the metadata changes, with files.patch.
+
     Args:
         service: Drive API service instance.
         file_id: ID of the file to update.
@@ -318,30 +920,149 @@ def update_file(service, file_id, new_title, new_description, new_mime_type,
         new_mime_type: New MIME type for the file.
         new_filename: Filename of the new content to upload.
         new_revision: Whether or not to create a new revision for this file.
+        chunksize: initial chunk size for large files, see make_media_body.
+        store: resumable session store, see execute_upload.
+        progress: progress callback, see execute_upload.
+        fields: partial response selector, None for all fields.
     Returns:
         Updated file metadata if successful, None otherwise.
     """
+    # File's new metadata.
+    file = {
+        'title': new_title,
+        'description': new_description,
+        'mimeType': new_mime_type
+    }
+    param = fields_param({'fileId': file_id, 'body': file}, fields)
     try:
-        # First retrieve the file from the API.
-        file = service.files().get(fileId=file_id).execute()
-
-        # File's new metadata.
-        file['title'] = new_title
-        file['description'] = new_description
-        file['mimeType'] = new_mime_type
+        if not new_filename:
+            updated_file = retry.execute(service.files().patch(**param))
+            return (updated_file, 200, '')
 
         # File's new content.
-        if os.path.getsize(new_filename) > 5*2**20:
-            media_body = MediaFileUpload(new_filename, mimetype=new_mime_type, chunksize=1024*1024, resumable=True)
-        else:
-            media_body = MediaFileUpload(new_filename, mimetype=new_mime_type, resumable=False)
+        param['media_body'] = make_media_body(new_filename, new_mime_type, chunksize)
+        param['newRevision'] = new_revision
 
         # Send the request to the API.
-        updated_file = service.files().update(
-                fileId=file_id,
-                body=file,
-                newRevision=new_revision,
-                media_body=media_body).execute()
+        updated_file = execute_upload(service.files().update(**param),
+                store, upload_key(new_filename, file_id), progress)
         return (updated_file, 200, '')
     except errors.HttpError, error:
         return http_error_tuple(None, error.content)
+
+################################################################################
+# Batch requests
+# See https://developers.google.com/drive/v2/web/batch
+################################################################################
+
+BATCH_SIZE = 100
+
+def ok_tuple(obj):
+    return (obj, 200, '')
+
+class Batch(object):
+    """Group metadata requests into multipart batch requests.
+
+    The get_file_instance, find_file, find_folder, insert_folder,
+    rename_file and delete_file_by_id methods take the same arguments as the module
+    functions of the same name, minus the service, and queue the request.
+    execute() sends the queue in batches of at most batch_size requests.
+
+    Args:
+        service: Drive API service instance.
+        batch_size: maximum number of requests per HTTP round trip.
+    """
+
+    def __init__(self, service, batch_size=BATCH_SIZE):
+        self.service = service
+        self.batch_size = batch_size
+        self.requests = []
+
+    def add(self, request, postproc=ok_tuple):
+        """Queue a request.
+
+        Args:
+            request: apiclient HttpRequest.
+            postproc: callable turning the response into a (obj, code,
+                reason) tuple.
+        Returns:
+            index of the request's result in the list returned by execute().
+        """
+        self.requests.append((request, postproc))
+        return len(self.requests) - 1
+
+    def get_file_instance(self, file_id, fields=FILE_FIELDS):
+        return self.add(get_file_request(self.service, file_id, fields))
+
+    def find_file(self, title, parent=None, fields=FILE_FIELDS):
+        return self.add(find_file_request(self.service, title, parent, fields), first_item)
+
+    def find_folder(self, title, parent=None, fields=FOLDER_FIELDS):
+        return self.add(find_folder_request(self.service, title, parent, fields), first_item)
+
+    def insert_folder(self, title, description, parent_id, fields=FOLDER_FIELDS):
+        return self.add(insert_folder_request(self.service, title, description, parent_id,
+                fields))
+
+    def rename_file(self, file_id, new_title, fields='title'):
+        return self.add(rename_file_request(self.service, file_id, new_title, fields))
+
+    def delete_file_by_id(self, file_id):
+        return self.add(delete_file_request(self.service, file_id),
+                lambda response: (file_id, 200, ''))
+
+    def execute(self, policy=None):
+        """Send all queued requests and empty the queue.
+
+        Items that fail with a retryable error are sent again in a later
+        batch, following the retry policy.
+
+        Returns:
+            list of (obj, code, reason) tuples, one per queued request, in
+            the order the requests were added.
+        """
+        policy = policy or retry.default_policy
+        requests = self.requests
+        self.requests = []
+        results = [None] * len(requests)
+        pending = range(len(requests))
+        attempt = 0
+        while pending:
+            for start in range(0, len(pending), self.batch_size):
+                self.execute_chunk(requests, pending[start:start + self.batch_size], results)
+            failed = [index for index in pending
+                    if results[index][0] is None and retry.is_retryable(*results[index][1:],
+                            idempotent=retry.is_idempotent(requests[index][0].methodId))]
+            if not failed or not policy.should_retry(attempt):
+                break
+            if any(retry.is_rate_limited(*results[index][1:]) for index in failed):
+                retry.default_limiter.throttled()
+            time.sleep(policy.backoff(attempt))
+            pending = failed
+            attempt += 1
+        return results
+
+    def execute_chunk(self, requests, indexes, results):
+        def callback(request_id, response, exception):
+            index = int(request_id)
+            if exception is None:
+                results[index] = requests[index][1](response)
+            elif isinstance(exception, errors.HttpError):
+                results[index] = http_error_tuple(None, exception.content)
+            else:
+                results[index] = (None, 500, repr(exception))
+
+        # send batches to the host the service talks to, not always to
+        # www.googleapis.com, so a local stand-in server gets them too
+        batch_uri = urlparse.urljoin(self.service._baseUrl, '/batch')
+        batch = BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+        for index in indexes:
+            batch.add(requests[index][0], request_id=str(index))
+        try:
+            retry.execute(batch, idempotent=all(retry.is_idempotent(requests[index][0].methodId)
+                    for index in indexes))
+        except errors.HttpError, error:
+            # the batch request itself failed: every item shares the error
+            failed = http_error_tuple(None, error.content)
+            for index in indexes:
+                results[index] = failed
@@ -0,0 +1,179 @@
+"""
+Mappings from local paths below a root folder to values.
+
+upload_tree and upload_plan keep one entry per scanned file and folder,
+such as the Drive ids of the uploaded folders or the journal entries of
+the files. A PathTree stores them as a tree instead of a dict keyed by
+full path strings: each entry costs a dict slot and its last component,
+whose string is interned so a name recurring in many folders is stored
+once, and only folders get a node.
+"""
+
+import os
+
+
+class PathNode(object):
+    """A folder in a PathTree.
+
+    value is the folder's own value, folders maps the names of its
+    subfolders to their PathNodes, and leaves the names of the other
+    entries, which have no children, to their values. Both dicts are
+    created on first use.
+    """
+    __slots__ = ('parent', 'name', 'value', 'folders', 'leaves')
+
+    def __init__(self, parent, name, value=None):
+        self.parent = parent
+        self.name = name
+        self.value = value
+        self.folders = None
+        self.leaves = None
+
+
+class PathTree(object):
+    """Maps the paths below root to values, None standing for no value.
+
+    Paths outside the root are never present. Setting a value below a
+    path that holds a leaf turns the leaf into a folder that keeps its
+    value.
+    """
+
+    def __init__(self, root):
+        self.root = root.rstrip(os.sep) or os.sep
+        self.prefix = self.root if self.root == os.sep else self.root + os.sep
+        self.top = PathNode(None, "")
+        self.count = 0
+        # the folder found last: the next lookup is usually below it
+        self.last = (self.root, self.top)
+
+    def split(self, path):
+        """Returns the names of path's components below the root, or None."""
+        if path == self.root:
+            return [ ]
+        if not path.startswith(self.prefix):
+            return None
+        return path[len(self.prefix):].split(os.sep)
+
+    def folder(self, path, create=False):
+        """Returns the PathNode of the folder at path, or None."""
+        last_path, node = self.last
+        if path == last_path:
+            return node
+        if path.startswith(last_path + os.sep):
+            names = path[len(last_path) + 1:].split(os.sep)
+        else:
+            names = self.split(path)
+            if names is None:
+                return None
+            node = self.top
+        for name in names:
+            child = node.folders and node.folders.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = self.add_folder(node, name)
+            node = child
+        self.last = (path, node)
+        return node
+
+    def add_folder(self, node, name):
+        if isinstance(name, str):
+            name = intern(name)
+        value = None
+        if node.leaves and name in node.leaves:
+            value = node.leaves.pop(name)
+        child = PathNode(node, name, value)
+        if node.folders is None:
+            node.folders = { }
+        node.folders[name] = child
+        return child
+
+    def get(self, path, default=None):
+        value = None
+        folder = self.folder(path)
+        if folder is not None:
+            value = folder.value
+        else:
+            parent, sep, name = path.rpartition(os.sep)
+            folder = self.folder(parent or os.sep)
+            if folder is not None and folder.leaves:
+                value = folder.leaves.get(name)
+        if value is None:
+            return default
+        return value
+
+    def get_child(self, folder, name, default=None):
+        """Like get(os.path.join(folder, name)), without joining the path."""
+        value = None
+        node = self.folder(folder)
+        if node is not None:
+            child = node.folders and node.folders.get(name)
+            if child is not None:
+                value = child.value
+            elif node.leaves:
+                value = node.leaves.get(name)
+        if value is None:
+            return default
+        return value
+
+    def __getitem__(self, path):
+        value = self.get(path)
+        if value is None:
+            raise KeyError(path)
+        return value
+
+    def __setitem__(self, path, value):
+        folder = self.folder(path)
+        if folder is not None:
+            old = folder.value
+            folder.value = value
+            self.count += (value is not None) - (old is not None)
+        else:
+            parent, sep, name = path.rpartition(os.sep)
+            self.set_child(parent or os.sep, name, value)
+
+    def set_child(self, folder, name, value):
+        """Like self[os.path.join(folder, name)] = value, without joining
+        the path."""
+        node = self.folder(folder, True)
+        if node is None:
+            raise KeyError(os.path.join(folder, name))
+        child = node.folders and node.folders.get(name)
+        if child is not None:
+            old = child.value
+            child.value = value
+        else:
+            if node.leaves is None:
+                node.leaves = { }
+            old = node.leaves.get(name)
+            if value is None:
+                node.leaves.pop(name, None)
+            elif old is None:
+                node.leaves[intern(name) if isinstance(name, str) else name] = value
+            else:
+                node.leaves[name] = value
+        self.count += (value is not None) - (old is not None)
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __len__(self):
+        return self.count
+
+    def nodes(self):
+        """Yields (path, PathNode) for every folder, parents first."""
+        stack = [(self.root, self.top)]
+        while stack:
+            path, node = stack.pop()
+            yield (path, node)
+            if node.folders:
+                stack.extend((os.path.join(path, name), child)
+                        for name, child in node.folders.iteritems())
+
+    def items(self):
+        for path, node in self.nodes():
+            if node.value is not None:
+                yield (path, node.value)
+            if node.leaves:
+                for name, value in node.leaves.iteritems():
+                    yield (os.path.join(path, name), value)
@@ -0,0 +1,98 @@
+"""
+Bounded pool of worker threads for Drive transfers.
+
+httplib2.Http objects are not thread-safe, so every worker gets its own
+service object from service_factory and keeps it for its whole lifetime.
+The queue depth and the number of busy workers are kept as gauges in
+stats.default_stats. Results are passed to a callback as jobs finish,
+not kept, so a pool can run any number of jobs in bounded memory.
+"""
+
+import Queue
+import sys
+import threading
+import traceback
+
+from stats import default_stats
+
+
+class Results(object):
+    """Thread-safe tally of finished jobs that keeps only the failures.
+
+    Attributes:
+        count: number of jobs added.
+        failed: paths of the jobs whose result was false, in order.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def add(self, path, result):
+        with self.lock:
+            self.count += 1
+            if not result:
+                self.failed.append(path)
+
+    def __len__(self):
+        return self.count
+
+
+class WorkerPool(object):
+    """Runs handler(service, job) for submitted jobs on a fixed set of threads.
+
+    Args:
+        service_factory: callable returning a new Drive service object.
+        handler: callable(service, job) returning the job's result.
+        workers: number of worker threads.
+        queue_size: maximum number of pending jobs; submit() blocks when
+            the queue is full.
+        on_result: callable(job, result) called on the worker thread as
+            each job finishes, or None.
+    """
+
+    def __init__(self, service_factory, handler, workers, queue_size=None, on_result=None):
+        self.handler = handler
+        self.on_result = on_result
+        if queue_size is None:
+            queue_size = workers * 4
+        self.jobs = Queue.Queue(queue_size)
+        self.threads = []
+
+        # Build the services up front so credential problems surface in
+        # the caller instead of killing a worker thread.
+        services = [service_factory() for i in range(workers)]
+        for i, service in enumerate(services):
+            thread = threading.Thread(target=self.run, args=(service,),
+                    name="gdrive-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self, service):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            default_stats.set('queue_depth', self.jobs.qsize())
+            default_stats.add('workers_busy', 1)
+            try:
+                result = self.handler(service, job)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+                result = None
+            default_stats.add('workers_busy', -1)
+            if self.on_result is not None:
+                self.on_result(job, result)
+
+    def submit(self, job):
+        self.jobs.put(job)
+        default_stats.set('queue_depth', self.jobs.qsize())
+
+    def join(self):
+        """Waits for all submitted jobs and stops the workers."""
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
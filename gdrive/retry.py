@@ -0,0 +1,332 @@
+"""
+Retries and rate control for Drive API calls.
+
+Every request the gdrive module sends goes through execute() (API method
+calls and batches), call() (upload chunks) or request() (raw downloads).
+All three wait for a token from a process-wide, adaptive token bucket
+before sending, retry transient failures (rate limit errors, 5xx
+responses, socket errors) with full-jitter exponential backoff or the
+server's Retry-After, and report the outcome back to the bucket: every
+rate limit error halves the request rate of the whole process and every
+success raises it a little again. Unless configure() gives the bucket a
+rate, e.g. from a --rate option, it lets requests through unlimited
+until the first rate limit error, and from then on limits them to half
+the rate they were sent at.
+
+Requests that create something (NON_IDEMPOTENT_METHODS) are only
+retried after rate limit errors, which Drive sends before doing
+anything: after a 5xx response or a dropped connection the file may
+have been created already, and sending the request again would create
+a second one.
+
+See https://developers.google.com/drive/v2/web/handle-errors
+"""
+
+import httplib
+import random
+import simplejson
+import socket
+import threading
+import time
+
+from apiclient import errors
+
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+
+def is_rate_limited(code, reason):
+    return code == 429 or ((code == 403 or code == 503) and reason in RATE_LIMIT_REASONS)
+
+NON_IDEMPOTENT_METHODS = set(['drive.files.insert', 'drive.files.copy', 'drive.parents.insert'])
+
+def is_idempotent(method):
+    return method not in NON_IDEMPOTENT_METHODS
+
+def is_retryable(code, reason, idempotent=True):
+    return is_rate_limited(code, reason) or (idempotent and code >= 500)
+
+def parse_error(content):
+    """
+    Returns:
+        (code, reason) of a Drive error response body, (500, 'parseError')
+        if it is not one.
+    """
+    try:
+        error = simplejson.loads(content).get('error')
+        return (error.get('code'), error.get('errors')[0].get('reason'))
+    except Exception:
+        return (500, 'parseError')
+
+def get_retry_after(resp):
+    """
+    Returns:
+        seconds to wait according to a Retry-After header, or None
+    """
+    try:
+        return float(resp['retry-after'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class TokenBucket(object):
+    """Process-wide request rate limiter with additive increase and
+    multiplicative decrease.
+
+    Args:
+        rate: initial requests per second, None for no limit until the
+            first rate limit error, which sets it to half the rate
+            requests were sent at during the last window seconds.
+        burst: number of requests that may be sent at once after idling.
+        min_rate: floor for the rate after repeated rate limit errors.
+        max_rate: ceiling for the rate after repeated successes.
+        increase: requests per second added after each success.
+        window: seconds over which the rate of unlimited requests is
+            measured.
+    """
+
+    def __init__(self, rate=None, burst=10, min_rate=0.5, max_rate=50.0, increase=0.05,
+                 window=10.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.window = window
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+        # requests sent unlimited since window_start, and their rate
+        # in the window before
+        self.sent = 0
+        self.window_start = self.last
+        self.sent_rate = None
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        if self.rate is None:
+            with self.lock:
+                if self.rate is None:
+                    self.count_sent(time.time())
+                    return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def count_sent(self, now):
+        elapsed = now - self.window_start
+        if elapsed >= self.window:
+            self.sent_rate = self.sent / elapsed
+            self.sent = 0
+            self.window_start = now
+        self.sent += 1
+
+    def observed_rate(self):
+        """Requests per second sent unlimited lately."""
+        elapsed = time.time() - self.window_start
+        if self.sent_rate is not None and elapsed < self.window / 2:
+            return self.sent_rate
+        return self.sent / max(elapsed, 1.0)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate is not None:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self):
+        with self.lock:
+            if self.rate is None:
+                # start limiting from the rate that got throttled
+                self.rate = min(self.max_rate, self.observed_rate())
+                self.last = time.time()
+            self.rate = max(self.min_rate, self.rate / 2)
+            # stop the burst that is probably in flight
+            self.tokens = min(self.tokens, 0.0)
+
+class RetryPolicy(object):
+    """When and how long to wait before retrying.
+
+    Args:
+        max_retries: retries per request.
+        base: seconds; the n-th retry waits up to base * 2**n seconds.
+        cap: upper bound for a single wait in seconds.
+        budget_ratio: retries earned per successful request. Together with
+            budget_size this caps the share of retries across the whole
+            process, so a failing API is not hammered by every worker.
+        budget_size: retries available initially and at most.
+    """
+
+    def __init__(self, max_retries=5, base=1.0, cap=64.0, budget_ratio=0.2, budget_size=100):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.budget_ratio = budget_ratio
+        self.budget_size = budget_size
+        self.budget = float(budget_size)
+        self.lock = threading.Lock()
+
+    def succeeded(self):
+        with self.lock:
+            self.budget = min(self.budget_size, self.budget + self.budget_ratio)
+
+    def should_retry(self, attempt):
+        """Take a retry out of the budget if attempt may be retried."""
+        if attempt >= self.max_retries:
+            return False
+        with self.lock:
+            if self.budget < 1:
+                return False
+            self.budget -= 1
+            return True
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before retry number attempt (full jitter)."""
+        if retry_after is not None:
+            return min(retry_after, self.cap)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+default_policy = RetryPolicy()
+default_limiter = TokenBucket()
+
+def configure(rate=None, max_rate=None, max_retries=None):
+    """Adjust the process-wide limiter and retry policy."""
+    if rate is not None:
+        default_limiter.rate = rate
+        default_limiter.max_rate = max(default_limiter.max_rate, rate)
+    if max_rate is not None:
+        default_limiter.max_rate = max_rate
+    if max_retries is not None:
+        default_policy.max_retries = max_retries
+
+# Callables notified of every attempt, see add_listener
+listeners = []
+start_listeners = []
+
+def add_listener(listener, start=None):
+    """Call listener(method, attempt, seconds, code) after every attempt
+    to send a request: method names the API method (e.g.
+    'drive.files.insert'), attempt counts from 0, seconds is the time the
+    attempt took and code its HTTP status, 0 for a socket error. If
+    given, start(method, attempt) is called on the same thread just
+    before the attempt.
+    """
+    listeners.append(listener)
+    if start is not None:
+        start_listeners.append(start)
+
+def remove_listener(listener, start=None):
+    listeners.remove(listener)
+    if start is not None:
+        start_listeners.remove(start)
+
+def notify_start(method, attempt):
+    for start in start_listeners:
+        start(method, attempt)
+
+def notify(method, attempt, started, code):
+    if listeners:
+        seconds = time.time() - started
+        for listener in listeners:
+            listener(method, attempt, seconds, code)
+
+def execute(request, policy=None, limiter=None, idempotent=None):
+    """Execute an apiclient request (or batch) with rate control and retries.
+
+    Args:
+        idempotent: whether the request may be sent again after a 5xx
+            response or a socket error; by default, whether its method is
+            not in NON_IDEMPOTENT_METHODS. Pass False for a batch holding
+            such requests.
+    Raises:
+        apiclient.errors.HttpError, socket.error or httplib.HTTPException
+        once the request cannot be retried any more.
+    """
+    return call(request.execute, policy, limiter, getattr(request, 'methodId', None) or 'batch',
+            idempotent)
+
+def call(fn, policy=None, limiter=None, method='call', idempotent=None):
+    """Call fn, which sends one request with apiclient, with rate control
+    and retries, e.g. the next_chunk method of a resumable upload.
+    idempotent is as for execute(), by default from method.
+
+    Returns:
+        the result of fn()
+    Raises:
+        apiclient.errors.HttpError, socket.error or httplib.HTTPException
+        once the request cannot be retried any more.
+    """
+    policy = policy or default_policy
+    limiter = limiter or default_limiter
+    if idempotent is None:
+        idempotent = is_idempotent(method)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        notify_start(method, attempt)
+        started = time.time()
+        try:
+            result = fn()
+        except errors.HttpError, error:
+            code = error.resp.status
+            notify(method, attempt, started, code)
+            reason = parse_error(error.content)[1]
+            if is_rate_limited(code, reason):
+                limiter.throttled()
+            if not is_retryable(code, reason, idempotent) or not policy.should_retry(attempt):
+                raise
+            wait = policy.backoff(attempt, get_retry_after(error.resp))
+        except (socket.error, httplib.HTTPException):
+            notify(method, attempt, started, 0)
+            if not idempotent or not policy.should_retry(attempt):
+                raise
+            wait = policy.backoff(attempt)
+        else:
+            notify(method, attempt, started, 200)
+            limiter.succeeded()
+            policy.succeeded()
+            return result
+        attempt += 1
+        time.sleep(wait)
+
+def request(http, uri, policy=None, limiter=None, method='download', **kwargs):
+    """Send a raw request through http with rate control and retries.
+
+    Returns:
+        (response, content) of the last attempt.
+    Raises:
+        socket.error or httplib.HTTPException once the request cannot be
+        retried any more.
+    """
+    policy = policy or default_policy
+    limiter = limiter or default_limiter
+    attempt = 0
+    while True:
+        limiter.acquire()
+        notify_start(method, attempt)
+        started = time.time()
+        try:
+            resp, content = http.request(uri, **kwargs)
+        except (socket.error, httplib.HTTPException):
+            notify(method, attempt, started, 0)
+            if not policy.should_retry(attempt):
+                raise
+            wait = policy.backoff(attempt)
+        else:
+            notify(method, attempt, started, resp.status)
+            if resp.status < 400:
+                limiter.succeeded()
+                policy.succeeded()
+                return (resp, content)
+            code = resp.status
+            reason = parse_error(content)[1]
+            if is_rate_limited(code, reason):
+                limiter.throttled()
+            if not is_retryable(code, reason) or not policy.should_retry(attempt):
+                return (resp, content)
+            wait = policy.backoff(attempt, get_retry_after(resp))
+        attempt += 1
+        time.sleep(wait)
@@ -0,0 +1,225 @@
+"""
+Counters, gauges and latency histograms for long-running transfers.
+
+The gdrive module counts the bytes it moves and, through a retry
+listener, the latency and outcome of every request by API method into
+default_stats. Scripts add their own counters (files done, bytes
+queued, ...) and run a Reporter, which prints a live progress line and
+periodically dumps the numbers as JSON lines or as a Prometheus
+textfile (for node_exporter's textfile collector).
+"""
+
+import os
+import simplejson
+import sys
+import threading
+import time
+
+import retry
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+class Histogram(object):
+    """Per-bucket (not cumulative) counts, sum and count of observed values."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Stats(object):
+    """Thread-safe metrics of one process.
+
+    Counters only grow; gauges are set or adjusted; histograms are kept
+    per label, e.g. per API method.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def observe(self, name, label, value):
+        with self.lock:
+            histogram = self.histograms.get((name, label))
+            if histogram is None:
+                histogram = self.histograms[(name, label)] = Histogram()
+            histogram.observe(value)
+
+    def record_request(self, method, attempt, seconds, code):
+        """retry listener: counts requests, retries and errors."""
+        self.observe('request_seconds', method, seconds)
+        self.incr('requests')
+        if attempt > 0:
+            self.incr('retries')
+        if code >= 400 or code == 0:
+            self.incr('errors_%d' % code)
+
+    def snapshot(self):
+        """
+        Returns:
+            a JSON-serializable dict of every metric
+        """
+        with self.lock:
+            now = time.time()
+            return {
+                'time': now,
+                'elapsed': now - self.started,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': dict(('%s{%s}' % (name, label), {
+                    'buckets': [[bound, count] for bound, count in zip(h.buckets[:-1], h.counts)],
+                    'sum': h.sum,
+                    'count': h.count,
+                }) for (name, label), h in self.histograms.items()),
+            }
+
+    def prometheus(self, prefix='gdrive'):
+        """
+        Returns:
+            every metric in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+                lines.append('%s_%s_total %s' % (prefix, name, value))
+            for name, value in sorted(self.gauges.items()):
+                lines.append('# TYPE %s_%s gauge' % (prefix, name))
+                lines.append('%s_%s %s' % (prefix, name, value))
+            typed = set()
+            for (name, label), h in sorted(self.histograms.items()):
+                metric = '%s_%s' % (prefix, name)
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s histogram' % metric)
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    le = bound == float('inf') and '+Inf' or repr(bound)
+                    lines.append('%s_bucket{method="%s",le="%s"} %d' % (metric, label, le, cumulative))
+                lines.append('%s_sum{method="%s"} %f' % (metric, label, h.sum))
+                lines.append('%s_count{method="%s"} %d' % (metric, label, h.count))
+        lines.append('# TYPE %s_last_update_seconds gauge' % prefix)
+        lines.append('%s_last_update_seconds %f' % (prefix, time.time()))
+        return '\n'.join(lines) + '\n'
+
+default_stats = Stats()
+retry.add_listener(default_stats.record_request)
+
+def format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024:
+            return '%.1f %s' % (n, unit)
+        n /= 1024.0
+    return '%.1f TiB' % n
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def progress_line(snapshot):
+    """
+    One-line summary of a snapshot: files and bytes done with their
+    average rates, queue depth, retries and errors, and the estimated
+    time left for the bytes queued so far ('+' while more may come).
+    """
+    counters = snapshot['counters']
+    gauges = snapshot['gauges']
+    elapsed = max(snapshot['elapsed'], 1e-6)
+    files = counters.get('files_done', 0) + counters.get('files_failed', 0)
+    transferred = counters.get('bytes_uploaded', 0) + counters.get('bytes_downloaded', 0)
+    errors = sum(value for name, value in counters.items() if name.startswith('errors_'))
+    line = '[%s] %d files (%.1f/s, %d failed) %s (%s/s) queue %d retries %d errors %d' % (
+            format_seconds(elapsed), files, files / elapsed, counters.get('files_failed', 0),
+            format_bytes(transferred), format_bytes(transferred / elapsed),
+            gauges.get('queue_depth', 0), counters.get('retries', 0), errors)
+    done = counters.get('bytes_done', 0)
+    remaining = counters.get('bytes_queued', 0) - done - counters.get('bytes_failed', 0)
+    if done and remaining > 0:
+        line += ' ETA %s%s' % (format_seconds(remaining / (done / elapsed)),
+                gauges.get('scanning') and '+' or '')
+    return line
+
+class Reporter(object):
+    """Reports stats every interval seconds on a background thread.
+
+    Args:
+        stats: the Stats to report.
+        interval: seconds between reports.
+        progress: whether to print a progress line to stderr, rewritten
+            in place on a terminal.
+        path: optional file to dump the metrics to; a Prometheus textfile
+            if it ends in .prom, otherwise JSON lines appended to it.
+    """
+
+    def __init__(self, stats=None, interval=10.0, progress=True, path=None):
+        self.stats = stats or default_stats
+        self.interval = interval
+        self.progress = progress
+        self.path = path
+        self.tty = sys.stderr.isatty()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="stats-reporter")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.report()
+
+    def report(self, final=False):
+        snapshot = self.stats.snapshot()
+        if self.progress:
+            line = progress_line(snapshot)
+            if self.tty and not final:
+                sys.stderr.write('\r\033[K' + line)
+            else:
+                sys.stderr.write(('\r\033[K' if self.tty else '') + line + '\n')
+            sys.stderr.flush()
+        if self.path:
+            self.dump(snapshot)
+
+    def dump(self, snapshot):
+        if self.path.endswith('.prom'):
+            # write and rename, so the collector never reads half a file
+            tmp_path = '%s.%d' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(self.stats.prometheus())
+            os.rename(tmp_path, self.path)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(simplejson.dumps(snapshot) + '\n')
+
+    def stop(self):
+        """Stops reporting after a final report."""
+        self.done.set()
+        self.thread.join()
+        self.report(final=True)
@@ -0,0 +1,245 @@
+"""
+Per-request tracing of Drive API calls.
+
+Opt-in: nothing is recorded until a sink is added with add_sink(). From
+then on every attempt to send a request through the retry module (API
+method calls, batches, upload chunks and downloads) is passed to each
+sink's record() as a dict with the API method, the attempt number (0 for
+the first try), the seconds it took, its HTTP status (0 for a socket
+error) and the bytes sent and received during the attempt, as counted
+by the httplib2.Http objects instrument() was applied to; gdrive.new_http
+does that for every service. OAuth token refreshes are recorded on their
+own as 'oauth2.token', even when they happen during an attempt, and
+other requests such Http objects send outside of an attempt as
+'untracked <host>'.
+
+Sinks: Aggregator sums the records up per method and prints a table when
+closed, JsonlSink writes one JSON line per record, and ProfileSink runs
+cProfile on the calling thread until it is closed.
+"""
+
+import cProfile
+import httplib
+import pstats
+import simplejson
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+from oauth2client import GOOGLE_TOKEN_URI
+
+import retry
+
+sinks = []
+
+_local = threading.local()
+
+def add_sink(sink):
+    if not sinks:
+        retry.add_listener(record, start)
+    sinks.append(sink)
+    return sink
+
+def remove_sink(sink):
+    sinks.remove(sink)
+    if not sinks:
+        retry.remove_listener(record, start)
+
+def close():
+    """Removes and closes every sink."""
+    while sinks:
+        sink = sinks[-1]
+        remove_sink(sink)
+        sink.close()
+
+def body_size(body, headers):
+    if body is None:
+        return 0
+    if isinstance(body, basestring):
+        return len(body)
+    # upload chunks are sent as streams with their length in a header
+    for name, value in (headers or {}).items():
+        if name.lower() == 'content-length':
+            return int(value)
+    return 0
+
+def request_name(uri):
+    """Returns the method to record a request to uri under if it is not
+    part of an attempt, None if it is."""
+    if uri.startswith(GOOGLE_TOKEN_URI):
+        return 'oauth2.token'
+    if not getattr(_local, 'attempt', False):
+        return 'untracked %s' % urlparse.urlparse(uri).netloc
+    return None
+
+def instrument(http):
+    """Makes http count the bytes of every request it sends during an
+    attempt on the calling thread, for the record() that ends it, and
+    record token refreshes and requests outside of attempts on their
+    own. A no-op while there are no sinks.
+
+    Returns:
+        http
+    """
+    send = http.request
+    def request(uri, method='GET', body=None, headers=None, *args, **kwargs):
+        if not sinks:
+            return send(uri, method, body, headers, *args, **kwargs)
+        name = request_name(uri)
+        if name is None:
+            resp, content = send(uri, method, body, headers, *args, **kwargs)
+            _local.sent += body_size(body, headers)
+            _local.received += len(content or '')
+            return resp, content
+        started = time.time()
+        try:
+            resp, content = send(uri, method, body, headers, *args, **kwargs)
+        except (socket.error, httplib.HTTPException):
+            emit(name, 0, time.time() - started, 0, body_size(body, headers), 0)
+            raise
+        emit(name, 0, time.time() - started, resp.status, body_size(body, headers),
+                len(content or ''))
+        return resp, content
+    http.request = request
+    return http
+
+def start(method, attempt):
+    """retry start listener: counts bytes from here on for this attempt."""
+    _local.attempt = True
+    _local.sent = _local.received = 0
+
+def record(method, attempt, seconds, code):
+    """retry listener: passes one attempt on to the sinks."""
+    _local.attempt = False
+    emit(method, attempt, seconds, code, getattr(_local, 'sent', 0),
+            getattr(_local, 'received', 0))
+    _local.sent = _local.received = 0
+
+def emit(method, attempt, seconds, code, sent, received):
+    entry = {
+        'time': time.time(),
+        'method': method,
+        'attempt': attempt,
+        'seconds': seconds,
+        'status': code,
+        'sent': sent,
+        'received': received,
+    }
+    for sink in list(sinks):
+        sink.record(entry)
+
+class Aggregator(object):
+    """Sums up requests per method.
+
+    Args:
+        out: stream the summary is printed to on close(), None for none.
+    """
+
+    def __init__(self, out=sys.stderr):
+        self.out = out
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def record(self, entry):
+        with self.lock:
+            totals = self.methods.get(entry['method'])
+            if totals is None:
+                totals = self.methods[entry['method']] = {
+                    'calls': 0, 'retries': 0, 'errors': 0, 'seconds': 0.0,
+                    'max_seconds': 0.0, 'sent': 0, 'received': 0}
+            totals['calls'] += 1
+            if entry['attempt'] > 0:
+                totals['retries'] += 1
+            if entry['status'] >= 400 or entry['status'] == 0:
+                totals['errors'] += 1
+            totals['seconds'] += entry['seconds']
+            totals['max_seconds'] = max(totals['max_seconds'], entry['seconds'])
+            totals['sent'] += entry['sent']
+            totals['received'] += entry['received']
+
+    def summary(self):
+        """
+        Returns:
+            list of (method, totals dict) tuples, the method with the most
+            time spent first
+        """
+        with self.lock:
+            rows = [(method, dict(totals)) for method, totals in self.methods.items()]
+        return sorted(rows, key=lambda row: -row[1]['seconds'])
+
+    def format_summary(self):
+        lines = ['%-28s %7s %7s %6s %9s %8s %8s %11s %11s' % ('method', 'calls', 'retries',
+                'errors', 'total s', 'mean ms', 'max ms', 'sent', 'received')]
+        for method, totals in self.summary():
+            lines.append('%-28s %7d %7d %6d %9.2f %8.1f %8.1f %11d %11d' % (method,
+                    totals['calls'], totals['retries'], totals['errors'], totals['seconds'],
+                    totals['seconds'] / totals['calls'] * 1000, totals['max_seconds'] * 1000,
+                    totals['sent'], totals['received']))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.out is not None and self.methods:
+            print >>self.out, self.format_summary()
+
+class JsonlSink(object):
+    """Appends one JSON line per request to the file at path."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+    def record(self, entry):
+        line = simplejson.dumps(entry)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class ProfileSink(object):
+    """Profiles the calling thread with cProfile from creation to close(),
+    then prints the functions with the most cumulative time, or saves
+    the raw profile for pstats if path is given.
+
+    Args:
+        path: file to dump the profile to, None to print it.
+        limit: number of functions to print.
+        out: stream to print to.
+    """
+
+    def __init__(self, path=None, limit=30, out=sys.stderr):
+        self.path = path
+        self.limit = limit
+        self.out = out
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def record(self, entry):
+        pass
+
+    def close(self):
+        self.profile.disable()
+        if self.path:
+            self.profile.dump_stats(self.path)
+        else:
+            pstats.Stats(self.profile, stream=self.out).sort_stats('cumulative').print_stats(self.limit)
+
+def setup(profile=False, trace_file=None, cprofile=None):
+    """Adds the sinks the --profile, --trace-file and --cprofile options
+    of the command line tools ask for; close() them before exiting.
+
+    Args:
+        profile: whether to print a per-method summary.
+        trace_file: path of a JSON lines trace to append to, or None.
+        cprofile: '-' to print a cProfile report, a path to save it to,
+            or None.
+    """
+    if profile:
+        add_sink(Aggregator())
+    if trace_file:
+        add_sink(JsonlSink(trace_file))
+    if cprofile:
+        add_sink(ProfileSink(None if cprofile == '-' else cprofile))
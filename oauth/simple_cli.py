@@ -12,12 +12,6 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
-import httplib2
-from apiclient.discovery import build
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.file import Storage
-from oauth2client.tools import run
-from pprint import pprint
 import os
 import sys
 
@@ -31,15 +25,14 @@ global_location = "/etc/gdrive-client"
 local_location = home + "/.gdrive_client_secrets"
 test_location = ".private/client_secrets.json"
 
-if os.path.isfile(test_location):
-    client_secrets_location = test_location
-elif os.path.isfile(local_location):
-    client_secrets_location = local_location
-elif os.path.isfile(global_location):
-    client_secrets_location = global_location
-else:
-    print "No client_secrets.json file was found! Exiting."
-    sys.exit(1)
+def find_client_secrets():
+    """
+    Returns the path of the client_secrets.json file to use, or None.
+    """
+    for location in (test_location, local_location, global_location):
+        if os.path.isfile(location):
+            return location
+    return None
 
 DEFAULT_SCOPES = [
         'https://www.googleapis.com/auth/drive.file',
@@ -53,6 +46,15 @@ def authenticate(scopes=None):
 
     Warning, this launches a web browser! You will need to click.
     """
+    # oauth2client is slow to import; only authentication needs it.
+    from oauth2client.client import flow_from_clientsecrets
+    from oauth2client.file import Storage
+    from oauth2client.tools import run
+
+    client_secrets_location = find_client_secrets()
+    if client_secrets_location is None:
+        print "No client_secrets.json file was found! Exiting."
+        sys.exit(1)
     if scopes is None:
         scopes = DEFAULT_SCOPES
     elif isinstance(scopes, basestring):
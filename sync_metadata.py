@@ -0,0 +1,76 @@
+"""
+Mirror the metadata of every Drive file into the local database.
+
+The first sync crawls all files; later syncs only replay the Drive
+changes feed from the largestChangeId stored in tbl_syncState.
+"""
+
+from __future__ import print_function
+from gdrive import gdrive
+from db import helper as dbhelper
+
+def sync_metadata(service, session, full=False):
+    """
+    Brings the local metadata up to date, with a full crawl if the
+    database has never been synced or full is set.
+
+    Returns:
+        (number of files saved or deleted, code, reason)
+    """
+    change_id = dbhelper.get_sync_state("largestChangeId", session)
+    if change_id is None or full:
+        return crawl_files(service, session)
+    return apply_changes(service, session, int(change_id) + 1)
+
+def crawl_files(service, session):
+    # Take the change id first: changes made during the crawl are
+    # then replayed by the next sync.
+    change_id, code, reason = gdrive.get_largest_change_id(service)
+    if change_id is None:
+        return (None, code, reason)
+
+    count = [0]
+    def save_page(page):
+        items = page.get('items', [])
+        dbhelper.save_files(items, session)
+        count[0] += len(items)
+        print("saved", count[0], "files")
+
+    # The old metadata is replaced in one transaction, so a crawl that
+    # fails leaves it as it was.
+    with session.transaction():
+        dbhelper.delete_all_files(session)
+        page, code, reason = gdrive.list_pages(service.files().list, save_page,
+                q="trashed = false", maxResults=1000,
+                fields="nextPageToken,items(%s)" % gdrive.METADATA_FIELDS)
+        if page is None:
+            session.rollback()
+            return (None, code, reason)
+        dbhelper.set_sync_state("largestChangeId", change_id, session)
+    return (count[0], 200, '')
+
+def apply_changes(service, session, start_change_id):
+    count = [0]
+    def apply_page(page):
+        changed = [ ]
+        deleted = [ ]
+        for change in page.get('items', []):
+            file = change.get('file')
+            if change.get('deleted') or file is None or file.get('labels', {}).get('trashed'):
+                deleted.append(change['fileId'])
+            else:
+                changed.append(file)
+        dbhelper.save_files(changed, session)
+        dbhelper.delete_files(deleted, session)
+        count[0] += len(changed) + len(deleted)
+        print("applied", count[0], "changes")
+
+    page, code, reason = gdrive.list_changes(service, start_change_id, apply_page,
+            fields="nextPageToken,largestChangeId,items(fileId,deleted,file(%s))" % gdrive.METADATA_FIELDS)
+    if page is None:
+        session.commit()
+        return (None, code, reason)
+
+    dbhelper.set_sync_state("largestChangeId", page['largestChangeId'], session)
+    session.commit()
+    return (count[0], 200, '')
@@ -0,0 +1,81 @@
+"""
+Tests for batch_commands against Drive v2 shaped file resources.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import batch_commands
+from db import helper as dbhelper
+from gdrive import gdrive
+
+# What files.insert and files.update return with fields=None in Drive
+# v2: no lastViewedDate or parentsCollection as in v1
+V2_FILE = {
+    'kind': 'drive#file',
+    'id': 'file1',
+    'etag': '"etag1"',
+    'title': 'notes.txt',
+    'mimeType': 'text/plain',
+    'description': '',
+    'fileExtension': 'txt',
+    'fileSize': '5',
+    'md5Checksum': '5d41402abc4b2a76b9719d911017c592',
+    'createdDate': '2014-01-02T03:04:05.000Z',
+    'modifiedDate': '2014-01-02T03:04:05.000Z',
+    'modifiedByMeDate': '2014-01-02T03:04:05.000Z',
+    'downloadUrl': 'https://example.com/file1',
+    'labels': {'hidden': False, 'starred': False, 'trashed': False,
+            'restricted': False, 'viewed': True},
+    'parents': [{'kind': 'drive#parentReference', 'id': 'folder1',
+            'parentLink': 'https://example.com/folder1', 'isRoot': False}],
+    'userPermission': {'kind': 'drive#permission', 'etag': '"etag2"', 'id': 'me',
+            'role': 'owner', 'type': 'user'},
+}
+
+class RunCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.session = dbhelper.Session(dbpath=os.path.join(self.dir, 'test.db'))
+        self.saved = (gdrive.insert_file, gdrive.update_file)
+
+    def tearDown(self):
+        gdrive.insert_file, gdrive.update_file = self.saved
+        self.session.close()
+        shutil.rmtree(self.dir)
+
+    def stored(self):
+        return dbhelper.find_file_by_parent('folder1', 'notes.txt', self.session)
+
+    def test_insert_saves_v2_metadata(self):
+        gdrive.insert_file = lambda *args, **kwargs: (dict(V2_FILE), 200, '')
+        response = batch_commands.run_command(None, self.session, {'id': 1, 'command': 'insert',
+                'args': ['notes.txt', '', 'folder1', 'text/plain', '/tmp/notes.txt']})
+        self.assertEqual(response['code'], 200)
+        self.assertEqual(response['result']['id'], 'file1')
+        self.assertEqual(self.stored(), ('file1', '5', V2_FILE['md5Checksum'],
+                V2_FILE['modifiedDate']))
+
+    def test_update_saves_v2_metadata(self):
+        dbhelper.save_file(dict(V2_FILE), self.session)
+        updated = dict(V2_FILE, fileSize='6', md5Checksum='0' * 32,
+                modifiedDate='2015-01-01T00:00:00.000Z')
+        gdrive.update_file = lambda *args, **kwargs: (updated, 200, '')
+        response = batch_commands.run_command(None, self.session, {'id': 2, 'command': 'update',
+                'args': ['file1', 'notes.txt', '', 'text/plain', '/tmp/notes.txt', 'true']})
+        self.assertEqual(response['code'], 200)
+        self.assertEqual(self.stored(), ('file1', '6', '0' * 32,
+                '2015-01-01T00:00:00.000Z'))
+
+    def test_failed_insert_saves_nothing(self):
+        gdrive.insert_file = lambda *args, **kwargs: (None, 403, 'forbidden')
+        response = batch_commands.run_command(None, self.session, {'id': 3, 'command': 'insert',
+                'args': ['notes.txt', '', 'none', 'text/plain', '/tmp/notes.txt']})
+        self.assertEqual((response['code'], response['reason']), (403, 'forbidden'))
+        self.assertEqual(self.stored(), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+"""
+Tests for db.helper.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from db import helper as dbhelper
+from test_batch_commands import V2_FILE
+
+class HelperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.session = dbhelper.Session(dbpath=os.path.join(self.dir, 'test.db'))
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.dir)
+
+    def test_find_file_by_parent_skips_trash(self):
+        trashed = dict(V2_FILE, labels=dict(V2_FILE['labels'], trashed=True))
+        dbhelper.save_file(trashed, self.session)
+        self.assertEqual(dbhelper.find_file_by_parent('folder1', 'notes.txt', self.session), None)
+        dbhelper.save_file(dict(V2_FILE, id='file2'), self.session)
+        self.assertEqual(dbhelper.find_file_by_parent('folder1', 'notes.txt', self.session)[0],
+                'file2')
+
+    def test_failed_write_is_rolled_back(self):
+        with dbhelper.writing(self.session) as cursor:
+            cursor.execute("INSERT INTO tbl_syncState VALUES ('kept', '1');")
+        try:
+            with dbhelper.writing(self.session) as cursor:
+                cursor.execute("INSERT INTO tbl_syncState VALUES ('dropped', '2');")
+                raise ValueError()
+        except ValueError:
+            pass
+        self.session.commit()
+        rows = self.session.conn.execute("SELECT key FROM tbl_syncState;").fetchall()
+        self.assertEqual(rows, [('kept',)])
+
+if __name__ == '__main__':
+    unittest.main()
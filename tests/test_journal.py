@@ -0,0 +1,72 @@
+"""
+Tests for db.journal.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from db import helper as dbhelper
+from db import journal as dbjournal
+from db import schema
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.dir, 'test.db')
+        self.session = dbhelper.Session(dbpath=self.dbpath)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        journal = dbjournal.Journal('job', self.session)
+        journal.record_folder('/src', 'root')
+        journal.record_folder('/src/a', None)
+        journal.record_many([
+            ('/src/a/b.txt', None, False, 5, 1.5, dbjournal.STATUS_PENDING),
+            ('/src/c.txt', 'c', False, 6, 2.5, dbjournal.STATUS_DONE),
+        ])
+        journal.record('/src/a/b.txt', 'b', False, 5, 1.5, dbjournal.STATUS_DONE)
+        dbjournal.Journal('other', self.session).record_folder('/src', 'other')
+        self.assertEqual(dbjournal.Journal('job', self.session).load(), {
+            '/src': ('root', True, None, None, dbjournal.STATUS_DONE),
+            '/src/a': (None, True, None, None, dbjournal.STATUS_FAILED),
+            '/src/a/b.txt': ('b', False, 5, 1.5, dbjournal.STATUS_DONE),
+            '/src/c.txt': ('c', False, 6, 2.5, dbjournal.STATUS_DONE),
+        })
+
+    def test_rows_hold_names(self):
+        journal = dbjournal.Journal('job', self.session)
+        journal.record_folder('/src/a', 'a')
+        journal.record('/src/a/b.txt', 'b', False, 5, 1.5, dbjournal.STATUS_DONE)
+        names = [row[0] for row in self.session.conn.execute(
+                "SELECT name FROM tbl_uploadJournalTree ORDER BY node;")]
+        self.assertEqual(names, ['/', 'src', 'a', 'b.txt'])
+
+    def test_migrates_flat_journal(self):
+        self.session.close()
+        os.remove(self.dbpath)
+        conn = sqlite3.connect(self.dbpath)
+        cursor = conn.cursor()
+        for migration in schema.MIGRATIONS[:2]:
+            migration(cursor)
+        cursor.execute("PRAGMA user_version = 2;")
+        cursor.executemany("INSERT INTO tbl_uploadJournal VALUES (?,?,?,?,?,?,?);", [
+            ('job', '/src/a/b.txt', 'b', 0, 5, 1.5, dbjournal.STATUS_DONE),
+            ('job', '/src', 'root', 1, None, None, dbjournal.STATUS_DONE),
+        ])
+        conn.commit()
+        conn.close()
+        self.session = dbhelper.Session(dbpath=self.dbpath)
+        self.assertEqual(dbjournal.Journal('job', self.session).load(), {
+            '/src': ('root', True, None, None, dbjournal.STATUS_DONE),
+            '/src/a/b.txt': ('b', False, 5, 1.5, dbjournal.STATUS_DONE),
+        })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Tests for gdrive.pathtree.
+"""
+
+import unittest
+
+from gdrive.pathtree import PathTree
+
+class PathTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = PathTree('/src/')
+
+    def test_get_and_contains(self):
+        self.tree['/src/a/b.txt'] = 'file'
+        self.assertEqual(self.tree.get('/src/a/b.txt'), 'file')
+        self.assertEqual(self.tree['/src/a/b.txt'], 'file')
+        self.assertTrue('/src/a/b.txt' in self.tree)
+        self.assertFalse('/src/a/c.txt' in self.tree)
+        self.assertFalse('/src/a' in self.tree)
+        self.assertEqual(self.tree.get('/src/a/c.txt', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: self.tree['/src/a/c.txt'])
+
+    def test_get_outside_root(self):
+        self.tree['/src/a'] = 'folder'
+        self.assertEqual(self.tree.get('/other/a'), None)
+        self.assertEqual(self.tree.get('/srca'), None)
+        self.assertFalse('/' in self.tree)
+
+    def test_get_from_emptied_leaves(self):
+        self.tree['/src/a/b.txt'] = 'file'
+        self.tree['/src/a/b.txt'] = None
+        self.assertEqual(self.tree.get('/src/a/b.txt'), None)
+        self.assertEqual(self.tree.get('/src/a/b.txt', 'default'), 'default')
+        self.assertEqual(len(self.tree), 0)
+
+    def test_root_value(self):
+        self.tree['/src'] = 'root'
+        self.assertEqual(self.tree.get('/src'), 'root')
+        self.assertEqual(len(self.tree), 1)
+
+    def test_setitem_counts_entries(self):
+        self.tree['/src/a'] = 1
+        self.tree['/src/a'] = 2
+        self.tree['/src/b/c'] = 3
+        self.assertEqual(len(self.tree), 2)
+        self.tree['/src/a'] = None
+        self.assertEqual(len(self.tree), 1)
+        self.assertRaises(KeyError, self.tree.__setitem__, '/other/a', 1)
+
+    def test_leaf_promoted_to_folder(self):
+        self.tree['/src/a'] = 'folder'
+        self.assertEqual(self.tree.folder('/src/a'), None)
+        self.tree['/src/a/b'] = 'file'
+        node = self.tree.folder('/src/a')
+        self.assertEqual(node.value, 'folder')
+        self.assertEqual(self.tree.get('/src/a'), 'folder')
+        self.assertEqual(self.tree.get('/src/a/b'), 'file')
+        self.assertFalse(self.tree.top.leaves)
+        self.assertEqual(len(self.tree), 2)
+
+    def test_items(self):
+        entries = {'/src': 0, '/src/a': 1, '/src/a/b': 2, '/src/c': 3, '/src/a/d/e': 4}
+        for path, value in entries.items():
+            self.tree[path] = value
+        self.assertEqual(dict(self.tree.items()), entries)
+        self.assertEqual(len(self.tree), len(entries))
+
+    def test_child_accessors(self):
+        self.tree.set_child('/src/a', 'b', 'file')
+        self.tree['/src/a/c/d'] = 'deep'
+        self.assertEqual(self.tree.get('/src/a/b'), 'file')
+        self.assertEqual(self.tree.get_child('/src/a', 'b'), 'file')
+        self.assertEqual(self.tree.get_child('/src/a', 'x', 'default'), 'default')
+        self.assertEqual(self.tree.get_child('/src/missing', 'b'), None)
+        self.tree.set_child('/src/a', 'c', 'folder')
+        self.assertEqual(self.tree.get_child('/src/a', 'c'), 'folder')
+        self.assertEqual(self.tree.get('/src/a/c/d'), 'deep')
+        self.assertEqual(len(self.tree), 3)
+        self.assertRaises(KeyError, self.tree.set_child, '/other', 'a', 1)
+
+if __name__ == '__main__':
+    unittest.main()
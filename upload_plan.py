@@ -0,0 +1,546 @@
+"""
+Dry runs of upload_tree.
+
+plan_upload() walks the local tree and decides what upload_tree would do
+with every folder and file from what is known locally: the journal of an
+earlier run, the metadata in the local database (see sync_metadata) and,
+with prefetch, one read-only listing of the destination folders. Nothing
+is written to Drive. The plan is a file of JSON lines: a header, one
+record per folder and file in the order of the walk, and a summary with
+the totals, the number of requests the plan will take and an estimate of
+its duration at the current request rate.
+
+execute_plan() then carries out a plan as written, without looking
+anything up again, except for the files in folders the plan could not
+find: those may be on Drive already.
+"""
+
+from __future__ import print_function
+from gdrive import gdrive
+from gdrive import retry
+from gdrive.pathtree import PathTree
+from gdrive.pool import Results, WorkerPool
+from db import hashcache as dbhashcache
+from db import helper as dbhelper
+from db import journal as dbjournal
+from db import uploads as dbuploads
+import collections
+import functools
+import os
+import simplejson
+import sys
+import time
+
+import upload_tree
+
+# Folder records: an existing folder with its id, a folder known to
+# be missing, and one the plan could not tell about, which is looked
+# up and created if missing when the plan is executed
+OP_FOLDER = "folder"
+OP_MKDIR = "mkdir"
+OP_FIND = "find"
+
+# File records: a new file, a new revision of the Drive file "id",
+# a file linked or copied from the Drive file "id" with the same
+# content, and a file left alone
+OP_INSERT = "insert"
+OP_UPDATE = "update"
+OP_LINK = upload_tree.DEDUP_LINK
+OP_COPY = upload_tree.DEDUP_COPY
+OP_SKIP = "skip"
+
+FOLDER_OPS = (OP_FOLDER, OP_MKDIR, OP_FIND)
+FILE_OPS = (OP_INSERT, OP_UPDATE, OP_LINK, OP_COPY, OP_SKIP)
+
+OP_HEADER = "plan"
+OP_SUMMARY = "summary"
+
+# Requests per second estimates assume when no rate is configured
+ESTIMATE_RATE = 10.0
+
+def upload_requests(size, chunksize=None):
+    """
+    Returns the number of requests an upload of size bytes takes: one
+    for small files, one to start the resumable session and one per
+    chunk for large ones.
+    """
+    if size <= gdrive.RESUMABLE_THRESHOLD:
+        return 1
+    chunksize = gdrive.round_chunksize(chunksize or gdrive.UPLOAD_CHUNKSIZE)
+    return 1 + (size + chunksize - 1) // chunksize
+
+def record_requests(record, chunksize=None):
+    """
+    Returns the number of requests executing a plan record takes, at
+    most: a folder that is looked up may have to be created as well,
+    and a file that may be on Drive already is looked up first.
+    """
+    lookup = (record.get("check_existing") or record.get("resolve")) and 1 or 0
+    op = record["op"]
+    if op == OP_MKDIR:
+        return 1
+    if op == OP_FIND:
+        return 2
+    if op in (OP_LINK, OP_COPY):
+        return 1 + lookup
+    if op in (OP_INSERT, OP_UPDATE):
+        return upload_requests(record["size"], chunksize) + lookup
+    return 0
+
+class Summary(object):
+    """Counts the records of a plan, their bytes and requests."""
+
+    def __init__(self, chunksize=None):
+        self.chunksize = chunksize
+        self.counts = collections.defaultdict(int)
+        self.bytes = collections.defaultdict(int)
+        self.requests = 0
+
+    def add(self, record):
+        op = record["op"]
+        self.counts[op] += 1
+        if "size" in record:
+            self.bytes[op] += record["size"]
+        self.requests += record_requests(record, self.chunksize)
+
+    def record(self, rate=None, bandwidth=None):
+        """
+        Returns the summary record, with the estimated seconds of the
+        plan: the longer of its requests at rate per second and its
+        uploads at bandwidth bytes per second, if given.
+        """
+        rate = rate or retry.default_limiter.rate or ESTIMATE_RATE
+        transfer = self.bytes.get(OP_INSERT, 0) + self.bytes.get(OP_UPDATE, 0)
+        request_seconds = self.requests / float(rate)
+        transfer_seconds = bandwidth and transfer / float(bandwidth) or 0.0
+        return {
+            "op": OP_SUMMARY,
+            "counts": dict(self.counts),
+            "bytes": dict(self.bytes),
+            "transfer_bytes": transfer,
+            "requests": self.requests,
+            "rate": rate,
+            "bandwidth": bandwidth,
+            "request_seconds": request_seconds,
+            "transfer_seconds": transfer_seconds,
+            "estimated_seconds": max(request_seconds, transfer_seconds),
+        }
+
+def format_summary(summary):
+    counts = summary["counts"]
+    sizes = summary["bytes"]
+    def files(op):
+        return "%d (%.1f MiB)" % (counts.get(op, 0), sizes.get(op, 0) / float(2**20))
+    lines = [
+        "folders: %d existing, %d to create, %d to look up" % (counts.get(OP_FOLDER, 0),
+                counts.get(OP_MKDIR, 0), counts.get(OP_FIND, 0)),
+        "files: %s to insert, %s to update, %s to link, %s to copy, %s to skip" % (
+                files(OP_INSERT), files(OP_UPDATE), files(OP_LINK), files(OP_COPY), files(OP_SKIP)),
+        "requests: at most %d, %.0f s at %.1f per second" % (summary["requests"],
+                summary["request_seconds"], summary["rate"]),
+    ]
+    if summary["bandwidth"]:
+        lines.append("transfer: %.1f MiB, %.0f s at %.1f MiB/s" % (
+                summary["transfer_bytes"] / float(2**20), summary["transfer_seconds"],
+                summary["bandwidth"] / float(2**20)))
+    lines.append("estimated duration: %.0f s" % summary["estimated_seconds"])
+    return "\n".join(lines)
+
+def relative_path(rootdir, path):
+    if path == rootdir:
+        return ""
+    return os.path.relpath(path, rootdir)
+
+def parent_path(path):
+    """Returns the relative path of the parent of a plan record, None for the root."""
+    if not path:
+        return None
+    return os.path.dirname(path)
+
+def absolute_path(rootdir, path):
+    if not path:
+        return rootdir
+    return os.path.join(rootdir, path)
+
+def plan_folder(title, parent, index=None, session=None):
+    """
+    Decides about the folder called title in the planned folder parent,
+    an (op, id) tuple. Below the root, index (a prefetched
+    upload_tree.FolderIndex) knows every existing folder, while the
+    local database may be out of date, so a miss there leaves the
+    folder to be looked up.
+
+    Returns:
+        (op, folder id or None)
+    """
+    parent_op, parent_id = parent
+    if parent_op == OP_MKDIR:
+        return (OP_MKDIR, None)
+    if not parent_id:
+        return (OP_FIND, None)
+    if index is not None:
+        folder_id = index.get(parent_id, title)
+        return folder_id and (OP_FOLDER, folder_id) or (OP_MKDIR, None)
+    if session is not None:
+        folder_id = dbhelper.find_folder_by_parent(parent_id, title, session)
+        if folder_id:
+            return (OP_FOLDER, folder_id)
+    return (OP_FIND, None)
+
+def plan_root(service, title, prefetch=False, session=None):
+    """
+    Decides about the destination root, looking it up on Drive with
+    prefetch and in the local database otherwise.
+
+    Returns:
+        (op, folder id or None)
+    """
+    if prefetch and service is not None:
+        folder, code, reason = gdrive.find_folder(service, title)
+        if folder:
+            return (OP_FOLDER, folder['id'])
+        if code == 404:
+            return (OP_MKDIR, None)
+        print("failed to find folder:", title, code, reason)
+        return (OP_FIND, None)
+    if session is not None:
+        folder_id = dbhelper.find_folder_by_parent(None, title, session)
+        if folder_id:
+            return (OP_FOLDER, folder_id)
+    return (OP_FIND, None)
+
+def plan_file(local, title, parent_id, entry=None, incremental=False, session=None,
+              hashes=None, dedup=None):
+    """
+    Decides about the file local (an upload_tree.LocalFile) in the folder
+    parent_id, None if it does not exist yet, the same way upload_tree
+    does; files that only their md5 can tell apart are hashed here.
+
+    Returns:
+        (op, Drive id or None, reason or None)
+    """
+    st = local.st
+    if entry and entry[4] == dbjournal.STATUS_DONE and \
+            entry[2] == st.st_size and entry[3] == st.st_mtime:
+        return (OP_SKIP, entry[0], "journal")
+    if incremental and parent_id:
+        remote = dbhelper.find_file_by_parent(parent_id, title, session)
+        if remote:
+            changed = upload_tree.stat_changed(st, remote)
+            if changed is None:
+                changed = hashes.md5(local.path, st) != remote[2]
+            if not changed:
+                return (OP_SKIP, remote[0], "unchanged")
+            return (OP_UPDATE, remote[0], None)
+    if entry and entry[4] == dbjournal.STATUS_DONE:
+        # changed since it was uploaded
+        return (OP_UPDATE, entry[0], "journal")
+    if dedup and st.st_size >= upload_tree.DEDUP_MIN_SIZE:
+        match = dbhelper.find_file_by_md5(hashes.md5(local.path, st), st.st_size, title, session)
+        if match:
+            file_id, match_title = match
+            if dedup == upload_tree.DEDUP_LINK and match_title == title:
+                return (OP_LINK, file_id, None)
+            return (OP_COPY, file_id, None)
+    return (OP_INSERT, None, None)
+
+def plan_upload(service, rootdir, destroot, out, prefetch=False, journal=None, incremental=False,
+                session=None, dedup=None, chunksize=None, bandwidth=None):
+    """
+    Writes the plan for uploading rootdir to the Drive folder destroot
+    to the stream out. service is only used with prefetch, to find the
+    root and list the folders below it; incremental and dedup need
+    session. The options mean what they mean for upload_tree.
+
+    Returns:
+        the summary record
+    """
+    upload_tree.init_mimetypes()
+    rootdir = os.path.abspath(rootdir)
+    hashes = None
+    if incremental or dedup:
+        hashes = dbhashcache.HashCache(session)
+    entries = PathTree(rootdir)
+    # the planned (op, id) of every folder
+    folders = PathTree(rootdir)
+    if journal:
+        for path, entry in journal.iter_entries():
+            drive_id, is_folder, size, mtime, status = entry
+            if not is_folder:
+                entries[path] = entry
+            elif status == dbjournal.STATUS_DONE and drive_id:
+                folders[path] = (OP_FOLDER, drive_id)
+
+    summary = Summary(chunksize)
+    def write(record):
+        if record["op"] != OP_HEADER:
+            summary.add(record)
+        out.write(simplejson.dumps(record) + "\n")
+
+    write({"op": OP_HEADER, "root": rootdir, "destroot": destroot, "created": time.time(),
+            "prefetch": prefetch, "incremental": incremental, "dedup": dedup})
+    title = upload_tree.map_mac_filename(destroot)
+    root = folders.get(rootdir) or plan_root(service, title, prefetch, session)
+    folders[rootdir] = root
+    write({"op": root[0], "path": "", "title": title, "id": root[1]})
+    index = None
+    if prefetch and root[1]:
+        index = upload_tree.build_folder_index(service, root[1])
+
+    for folder, subs, files in upload_tree.read_ahead(upload_tree.scan_tree(rootdir),
+            upload_tree.SCAN_QUEUE_SIZE):
+        op, parent_id = folders.get(folder)
+        for dirname in subs:
+            folder_path = os.path.join(folder, dirname)
+            title = upload_tree.map_mac_filename(dirname)
+            sub = folders.get(folder_path) or plan_folder(title, (op, parent_id), index, session)
+            folders[folder_path] = sub
+            write({"op": sub[0], "path": relative_path(rootdir, folder_path), "title": title,
+                    "id": sub[1]})
+
+        for local in files:
+            st = local.st
+            title = upload_tree.map_mac_filename(local.name)
+            entry = entries.get(local.path)
+            file_op, file_id, reason = plan_file(local, title, parent_id, entry, incremental,
+                    session, hashes, dedup)
+            record = {"op": file_op, "path": relative_path(rootdir, local.path), "title": title,
+                    "size": st.st_size, "mtime": st.st_mtime,
+                    "mime_type": local.mime_type or 'application/octet-stream', "id": file_id}
+            if reason:
+                record["reason"] = reason
+            # a file in a folder the plan could not find may be on Drive
+            # already, changed or not: an incremental run looks it up
+            # once the folder is found, see resolve_file
+            if incremental and not parent_id:
+                record["resolve"] = True
+            elif file_op == OP_INSERT and entry is not None and entry[4] == dbjournal.STATUS_PENDING:
+                record["check_existing"] = True
+            write(record)
+
+    record = summary.record(bandwidth=bandwidth)
+    out.write(simplejson.dumps(record) + "\n")
+    return record
+
+def read_plan(path):
+    """Yields the records of the plan at path, the header first."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield simplejson.loads(line)
+
+def read_header(path):
+    header = next(read_plan(path), None)
+    if not header or header.get("op") != OP_HEADER:
+        raise ValueError("%s is not an upload plan" % path)
+    return header
+
+# A file record of a plan, with the id of its parent folder
+PlanJob = collections.namedtuple('PlanJob',
+        'op path title parent_id mime_type size mtime file_id check_existing resolve')
+
+def resolve_file(service, job, session=None):
+    """
+    Decides about a file of an incremental plan in a folder the plan
+    could not find, now that the folder's id is known, the way
+    plan_file does: the file is looked for in the local database, then
+    on Drive, and compared by size, modification time and, if those
+    cannot tell, md5.
+
+    Returns:
+        (op, Drive id or None, md5 of the Drive file to compare the local
+        file with before updating it, or None); op is None if the file is
+        gone or the lookup failed, and the planned op if there is no such
+        file on Drive
+    """
+    try:
+        st = os.stat(job.path)
+    except OSError as e:
+        print("cannot stat", job.path, ":", e, file=sys.stderr)
+        return (None, None, None)
+    remote = session and dbhelper.find_file_by_parent(job.parent_id, job.title, session)
+    if not remote:
+        file, code, reason = gdrive.find_file(service, job.title, job.parent_id,
+                'id,fileSize,md5Checksum,modifiedDate')
+        if not file:
+            if code == 404:
+                return (job.op, job.file_id, None)
+            print("failed to find file:", job.title, "in parent", job.parent_id, code, reason)
+            return (None, None, None)
+        remote = (file['id'], file.get('fileSize'), file.get('md5Checksum'),
+                file.get('modifiedDate'))
+    changed = upload_tree.stat_changed(st, remote)
+    if changed is False:
+        return (OP_SKIP, remote[0], None)
+    return (OP_UPDATE, remote[0], changed is None and remote[2] or None)
+
+def plan_job(service, job, journal=None, session=None, chunksize=None, store=None):
+    """
+    WorkerPool handler for the file records of a plan. A link or copy
+    that fails is uploaded instead.
+
+    Returns:
+        the file id or None
+    """
+    op, file_id, remote_md5 = job.op, job.file_id, None
+    if job.resolve:
+        op, file_id, remote_md5 = resolve_file(service, job, session)
+        if op is None:
+            return None
+        if op == OP_SKIP:
+            print("unchanged file:", job.path)
+            if journal:
+                journal.record(job.path, file_id, False, job.size, job.mtime, dbjournal.STATUS_DONE)
+            return file_id
+    if op == OP_LINK:
+        parent, code, reason = gdrive.add_parent(service, file_id, job.parent_id)
+        if parent:
+            if session:
+                dbhelper.add_parent(file_id, parent, session)
+            print("linked file:", job.title, "id:", file_id, "into parent", job.parent_id)
+            done_id = file_id
+        else:
+            done_id = None
+    elif op == OP_COPY:
+        file, code, reason = gdrive.copy_file(service, file_id, job.title, job.parent_id,
+                gdrive.METADATA_FIELDS)
+        if file and session:
+            dbhelper.save_file(file, session)
+        if file:
+            print("copied file:", job.title, "from id:", file_id, "into parent", job.parent_id)
+        done_id = file and file['id']
+    else:
+        done_id = None
+    if done_id:
+        if journal:
+            journal.record(job.path, done_id, False, job.size, job.mtime, dbjournal.STATUS_DONE)
+        return done_id
+    drive_id = op == OP_UPDATE and file_id or None
+    return upload_tree.upload_job(service, upload_tree.UploadJob(job.path, job.title, job.parent_id,
+            job.mime_type, job.size, job.mtime, drive_id, job.check_existing, remote_md5),
+            journal, session, chunksize, store)
+
+def create_folders(service, rootdir, records, path_mapping, journal=None):
+    """
+    Carries out the folder records of sibling folders with batch
+    requests, and maps their paths to their ids in path_mapping.
+    """
+    parent = parent_path(records[0]["path"])
+    parent_id = None
+    if parent is not None:
+        parent_id = path_mapping.get(absolute_path(rootdir, parent))
+        if not parent_id:
+            print("no folder for", absolute_path(rootdir, parent))
+            return
+    folder_ids = { }
+    mkdirs = [record["title"] for record in records if record["op"] == OP_MKDIR]
+    finds = [record["title"] for record in records if record["op"] == OP_FIND]
+    if parent_id is None:
+        # the root
+        for title in mkdirs:
+            folder_ids[title] = upload_tree.rate_limited_create_folder(service, title)
+        for title in finds:
+            folder_ids[title] = upload_tree.find_or_create_folder(service, title)
+    else:
+        if mkdirs:
+            batch = gdrive.Batch(service)
+            for title in mkdirs:
+                batch.insert_folder(title, "", parent_id)
+            for title, (folder, code, reason) in zip(mkdirs, batch.execute()):
+                folder_ids[title] = folder and folder['id']
+                if folder:
+                    print("created folder:", title, "id:", folder['id'], "in parent", parent_id)
+                else:
+                    print("failed to create folder:", title, "in parent", parent_id)
+        if finds:
+            folder_ids.update(upload_tree.find_or_create_folders(service, finds, parent_id))
+    for record in records:
+        path = absolute_path(rootdir, record["path"])
+        folder_id = record["op"] == OP_FOLDER and record["id"] or folder_ids.get(record["title"])
+        if folder_id:
+            path_mapping[path] = folder_id
+        if journal and record["op"] != OP_FOLDER:
+            journal.record_folder(path, folder_id)
+
+def execute_plan(service, path, workers=1, service_factory=upload_tree.new_service_object,
+                 journal=None, session=None, chunksize=None):
+    """
+    Carries out the plan at path: folders are created in the order of
+    the plan, batched per parent, and files are uploaded, updated,
+    linked or copied as planned, by workers upload threads. Files
+    changed since the plan was made are reported, and uploaded as they
+    are now: one planned to be skipped as the Drive file it was found
+    to be is updated, and one planned to be linked or copied is
+    inserted. The journal and the session are used as by upload_tree.
+
+    Returns:
+        a pool.Results with the number of files and the paths of the
+        failed ones
+    """
+    header = read_header(path)
+    rootdir = header["root"]
+    path_mapping = PathTree(rootdir)
+    store = None
+    if journal:
+        store = dbuploads.UploadSessionStore(journal.session)
+    handler = functools.partial(upload_tree.count_job, functools.partial(plan_job,
+            journal=journal, session=session, chunksize=chunksize, store=store))
+    results = Results()
+    pool = None
+    if workers > 1:
+        pool = WorkerPool(service_factory, handler, workers,
+                on_result=lambda job, file_id: results.add(job.path, file_id))
+    jobs = [ ]
+    siblings = [ ]
+    try:
+        for record in read_plan(path):
+            op = record["op"]
+            if op in FOLDER_OPS:
+                if siblings and parent_path(siblings[0]["path"]) != parent_path(record["path"]):
+                    create_folders(service, rootdir, siblings, path_mapping, journal)
+                    siblings = [ ]
+                siblings.append(record)
+                continue
+            if op not in FILE_OPS:
+                continue
+            if siblings:
+                create_folders(service, rootdir, siblings, path_mapping, journal)
+                siblings = [ ]
+            file_path = absolute_path(rootdir, record["path"])
+            size, mtime = record["size"], record["mtime"]
+            try:
+                st = os.stat(file_path)
+                if st.st_size != size or st.st_mtime != mtime:
+                    print("changed since planning:", file_path)
+                    size, mtime = st.st_size, st.st_mtime
+                    # the id of a skipped file is the Drive file at its
+                    # path, that of a linked or copied one is not
+                    if op == OP_SKIP and record["id"]:
+                        op = OP_UPDATE
+                    elif op in (OP_SKIP, OP_LINK, OP_COPY):
+                        op = OP_INSERT
+            except OSError as e:
+                print("cannot stat", file_path, ":", e, file=sys.stderr)
+                results.add(file_path, None)
+                continue
+            if op == OP_SKIP:
+                results.add(file_path, record["id"])
+                continue
+            parent_id = path_mapping.get(os.path.dirname(file_path))
+            if not parent_id:
+                print("no folder for", file_path)
+                results.add(file_path, None)
+                continue
+            jobs.append(PlanJob(op, file_path, record["title"], parent_id, record["mime_type"],
+                    size, mtime, record["id"], record.get("check_existing", False),
+                    record.get("resolve", False)))
+            if len(jobs) >= upload_tree.DISPATCH_BATCH:
+                upload_tree.dispatch(service, jobs, pool, results, handler, journal)
+                jobs = [ ]
+        if siblings:
+            create_folders(service, rootdir, siblings, path_mapping, journal)
+        upload_tree.dispatch(service, jobs, pool, results, handler, journal)
+    finally:
+        if pool:
+            pool.join()
+    return results
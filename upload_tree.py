@@ -3,14 +3,37 @@
 from __future__ import print_function
 from oauth import simple_cli
 from gdrive import gdrive
+from gdrive import retry
+from gdrive import stats
+from gdrive import trace
+from gdrive.pathtree import PathTree
+from gdrive.pool import Results, WorkerPool
+from db import hashcache as dbhashcache
+from db import helper as dbhelper
+from db.hashcache import md5_file
+from db import journal as dbjournal
+from db import uploads as dbuploads
+import argparse
+import calendar
+import collections
+import functools
 import mimetypes
 import os
 import pickle
-import random
+import Queue
 import re
 import sys
+import threading
 import time
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 # A collection of file extensions we did not have mimetypes for
 missing = { }
 
@@ -61,6 +84,99 @@ def get_file_mimetype(file_path):
         mt, enc = mimetypes.guess_type(file_path, False)
     return mt
   
+# A local file found by scan_tree, with its os.stat result
+LocalFile = collections.namedtuple('LocalFile', 'name path st mime_type')
+
+# Number of scanned folders buffered ahead of the uploads
+SCAN_QUEUE_SIZE = 64
+
+# List a folder, skipping hidden entries.  Returns the names of its
+# subfolders, the subset of them to descend into (not symlinks, as
+# with os.walk), and a LocalFile for each file.  Uses scandir where
+# available, which saves a stat per entry to tell folders from files.
+def scan_folder(folder):
+    subs = [ ]
+    descend = [ ]
+    files = [ ]
+    try:
+        if scandir is not None:
+            entries = [(entry.name, entry.path, entry.is_dir(), entry.is_symlink(), entry.stat)
+                    for entry in scandir(folder) if entry.name[0] != "."]
+        else:
+            entries = [ ]
+            for name in os.listdir(folder):
+                if name[0] != ".":
+                    path = os.path.join(folder, name)
+                    entries.append((name, path, os.path.isdir(path), os.path.islink(path),
+                            functools.partial(os.stat, path)))
+    except OSError as e:
+        print("cannot list", folder, ":", e, file=sys.stderr)
+        return (subs, descend, files)
+    for name, path, is_dir, is_link, stat in entries:
+        if is_dir:
+            subs.append(name)
+            if not is_link:
+                descend.append(name)
+            continue
+        try:
+            st = stat()
+        except OSError as e:
+            print("cannot stat", path, ":", e, file=sys.stderr)
+            continue
+        files.append(LocalFile(name, path, st, get_file_mimetype(path)))
+    return (subs, descend, files)
+
+# Walk a local tree top-down like os.walk, skipping hidden folders
+# and files.  Yields a (folder, subfolder names, LocalFile list)
+# tuple per folder, parents before their children.
+def scan_tree(rootdir):
+    stack = [rootdir]
+    while stack:
+        folder = stack.pop()
+        subs, descend, files = scan_folder(folder)
+        yield (folder, subs, files)
+        stack.extend(os.path.join(folder, name) for name in reversed(descend))
+
+# Run an iterator on a thread of its own, at most size items ahead
+# of the consumer, so its I/O overlaps with the consumer's work.  An
+# exception in the iterator is raised again in the consumer.
+def read_ahead(iterator, size):
+    items = Queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception:
+            put((False, sys.exc_info()))
+
+    thread = threading.Thread(target=produce, name="read-ahead")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            more, item = items.get()
+            if not more:
+                if item:
+                    raise item[0], item[1], item[2]
+                break
+            yield item
+    finally:
+        # lets the producer finish when the consumer stops early
+        stop.set()
+
 # Change ':' to '/' in file/folder titles
 def map_mac_filename(filename):
     return re.sub(r'\:', "/", filename)
@@ -74,9 +190,14 @@ def get_stored_credentials_path():
 
     return home + "/.gdrive_oauth"
 
+# Services share the stored credentials and a cached discovery
+# document; get_service_object returns the calling thread's service,
+# new_service_object a fresh one for another worker thread.
 def get_service_object():
-    credentials = get_stored_credentials()
-    return gdrive.build_service(credentials)
+    return service_factory()
+
+def new_service_object():
+    return service_factory.new()
 
 def store_credentials(scopes):
     credentials = simple_cli.authenticate(scopes)
@@ -89,109 +210,558 @@ def authenticate(scopes=None):
 def get_stored_credentials():
     pickled_creds_path = get_stored_credentials_path()
     return pickle.load(open(pickled_creds_path, "rb"))
+
+service_factory = gdrive.ServiceFactory(get_stored_credentials)
     
+# Create a folder or file and return its id, or None.  The gdrive
+# module retries rate limit errors itself (see gdrive/retry.py).
 def rate_limited_create_folder(service, title, parent=None):
-    folder_id = None
-    for retries in range(5):
-        folder, code, reason = gdrive.insert_folder(service, title, "", parent)
-        if folder:
-            return folder['id']
-        if not gdrive.is_rate_limited_error(code, reason):
-            break
-        # Apply exponential backoff.
-        wait = (2 ** retries) + random.randint(0, 1000) / 1000.
-        print("retrying after %f" % wait)
-        time.sleep(wait)
+    folder, code, reason = gdrive.insert_folder(service, title, "", parent)
+    if folder:
+        return folder['id']
     return None
 
 def rate_limited_create_file(service, title, description, parent_id, mime_type, filename):
-    file_id = None
-    for retries in range(5):
-        file, code, reason = gdrive.insert_file(service, title, description, parent_id, mime_type, filename)
-        if file:
-            return file['id']
-        if not gdrive.is_rate_limited_error(code, reason):
-            break
-        # Apply exponential backoff.
-        wait = (2 ** retries) + random.randint(0, 1000) / 1000.
-        print("retrying after %f" % wait)
-        time.sleep(wait)
+    file, code, reason = gdrive.insert_file(service, title, description,
+            parent_id, mime_type, filename, fields='id')
+    if file:
+        return file['id']
     return None
-    
-def find_or_create_folder(service, title, parent=None):
+
+# In-memory index of the folders below a destination root, keyed
+# by (parent_id, title).  Lets find_or_create_folder(s) answer from
+# memory instead of sending a find query per directory.
+class FolderIndex(object):
+    def __init__(self):
+        self.folders = { }
+
+    def get(self, parent_id, title):
+        return self.folders.get((parent_id, title))
+
+    def add(self, parent_id, title, folder_id):
+        self.folders[(parent_id, title)] = folder_id
+
+    def __len__(self):
+        return len(self.folders)
+
+# Build a FolderIndex of everything below root_id from one paged
+# listing of all folders.  Returns None if the listing failed.
+def build_folder_index(service, root_id):
+    folders, code, reason = gdrive.list_folders(service)
+    if folders is None:
+        print("failed to list folders:", code, reason)
+        return None
+    children = { }
+    for folder in folders:
+        for parent in folder.get('parents', []):
+            children.setdefault(parent['id'], []).append(folder)
+    index = FolderIndex()
+    seen = set([root_id])
+    pending = [root_id]
+    while pending:
+        parent_id = pending.pop()
+        for folder in children.get(parent_id, []):
+            # like find_folder, the first folder with a title wins
+            if index.get(parent_id, folder['title']) is None:
+                index.add(parent_id, folder['title'], folder['id'])
+            if folder['id'] not in seen:
+                seen.add(folder['id'])
+                pending.append(folder['id'])
+    return index
+
+# With an index, lookups below the indexed root are answered from
+# memory and a miss means the folder does not exist yet.
+def find_or_create_folder(service, title, parent=None, index=None):
     folder_id = None
-    folder, code, reason = gdrive.find_folder(service, title, parent)
-    if folder:
-        folder_id = folder['id']
+    if index is not None and parent:
+        folder_id = index.get(parent, title)
+    else:
+        folder, code, reason = gdrive.find_folder(service, title, parent)
+        if folder:
+            folder_id = folder['id']
+    if folder_id:
         print("found folder:", title, "id:", folder_id, "in parent", parent)
     else:
         folder_id = rate_limited_create_folder(service, title, parent)
         if folder_id:
             print("created folder:", title, "id:", folder_id, "in parent", parent)
+            if index is not None and parent:
+                index.add(parent, title, folder_id)
         else:
             print("failed to create folder:", title, "in parent", parent)
     return folder_id
 
+# Find or create several sibling folders with batch requests:
+# one round trip finds them all, another creates the missing ones.
+# Creations that hit rate limits are retried by Batch.execute.
+# With an index, the lookups are answered from memory instead.
+# Returns a dict mapping each title to its folder id, or to None if
+# the folder could not be created.
+def find_or_create_folders(service, titles, parent=None, index=None):
+    folder_ids = { }
+    batch = gdrive.Batch(service)
+    missing = [ ]
+    if index is not None and parent:
+        found = [index.get(parent, title) for title in titles]
+    else:
+        for title in titles:
+            batch.find_folder(title, parent)
+        found = [folder and folder['id'] for folder, code, reason in batch.execute()]
+    for title, folder_id in zip(titles, found):
+        if folder_id:
+            folder_ids[title] = folder_id
+            print("found folder:", title, "id:", folder_id, "in parent", parent)
+        else:
+            missing.append(title)
+
+    if missing:
+        for title in missing:
+            batch.insert_folder(title, "", parent)
+        for title, (folder, code, reason) in zip(missing, batch.execute()):
+            if folder:
+                folder_ids[title] = folder['id']
+                print("created folder:", title, "id:", folder['id'], "in parent", parent)
+                if index is not None and parent:
+                    index.add(parent, title, folder['id'])
+            else:
+                folder_ids[title] = None
+                print("failed to create folder:", title, "in parent", parent)
+    return folder_ids
+
+# Print the progress of a chunked upload.
+def print_progress(title, sent, total):
+    print("uploading %s: %d of %d MiB" % (title, sent / 2**20, total / 2**20))
+
+# Upload one file, or a new revision of it when job.drive_id is
+# set (a new file if that one is gone), and report the outcome.
+# Large files are sent in chunks of
+# about chunksize bytes; with a store, their resumable sessions
+# are kept so an interrupted upload continues where it stopped.
+# Returns the file metadata, limited to fields, or None.
+def upload_file(service, job, chunksize=None, store=None, fields='id'):
+    progress = functools.partial(print_progress, job.title)
+    if job.drive_id:
+        file, code, reason = gdrive.update_file(service, job.drive_id,
+                job.title, "", job.mime_type, job.path, True, chunksize, store, progress, fields)
+        if file:
+            print("updated file:", job.title, "in parent", job.parent_id)
+            return file
+        if code != 404:
+            print("failed to update file", job.title, "in parent", job.parent_id)
+            return file
+        # deleted from Drive since
+        print("file to update is gone:", job.title, "in parent", job.parent_id)
+    file, code, reason = gdrive.insert_file(service, job.title, "",
+            job.parent_id, job.mime_type, job.path, chunksize, store, progress, fields)
+    if file:
+        print("created file:", job.title, "in parent", job.parent_id)
+    else:
+        print("failed to create file", job.title, "in parent", job.parent_id)
+    return file
+
+# Seconds since the epoch for an RFC 3339 timestamp as used by
+# Drive, e.g. 2012-04-27T20:00:35.000Z
+def parse_drive_date(s):
+    return calendar.timegm(time.strptime(s[:19], "%Y-%m-%dT%H:%M:%S"))
+
+# Compare the os.stat result of a local file with the (id,
+# fileSize, md5Checksum, modifiedDate) row recorded for its remote
+# copy.  A file is taken as unchanged when its size matches and it
+# has not been modified since the remote copy was.  Returns None
+# when only the md5 can decide.
+def stat_changed(st, remote):
+    drive_id, size, md5, modified = remote
+    if size is None or int(size) != st.st_size:
+        return True
+    if modified and st.st_mtime <= parse_drive_date(modified):
+        return False
+    if md5:
+        return None
+    return True
+
+
+# Dedup modes: put an existing Drive file with the same content in
+# the destination folder as an additional parent, or copy it there
+# on the server
+DEDUP_LINK = "link"
+DEDUP_COPY = "copy"
+
+# Files smaller than this are uploaded rather than deduplicated:
+# the upload is a single request anyway
+DEDUP_MIN_SIZE = 256*2**10
+
+# Put an existing Drive file with the same content as job, found in
+# the local metadata database, in place of an upload.  With
+# DEDUP_LINK a file of the same title gets job's folder as another
+# parent; otherwise Drive makes a copy.  Returns the id of the
+# linked or copied file, or None to upload the file after all.
+def dedup_file(service, job, mode, hashes, session):
+    match = dbhelper.find_file_by_md5(hashes.md5(job.path), job.size, job.title, session)
+    if not match:
+        return None
+    file_id, title = match
+    if mode == DEDUP_LINK and title == job.title:
+        parent, code, reason = gdrive.add_parent(service, file_id, job.parent_id)
+        if parent:
+            dbhelper.add_parent(file_id, parent, session)
+            print("linked file:", job.title, "id:", file_id, "into parent", job.parent_id)
+            return file_id
+    else:
+        file, code, reason = gdrive.copy_file(service, file_id, job.title, job.parent_id,
+                gdrive.METADATA_FIELDS)
+        if file:
+            dbhelper.save_file(file, session)
+            print("copied file:", job.title, "from id:", file_id, "into parent", job.parent_id)
+            return file['id']
+    return None
+
+# Number of files journaled as pending with one commit
+DISPATCH_BATCH = 500
+
+# A file waiting to be uploaded.  drive_id is set when the file
+# replaces an existing Drive file, check_existing when a journaled
+# earlier run may have uploaded it before being interrupted, and
+# remote_md5 when the file is only uploaded if its md5 differs (the
+# hashing then runs on the upload threads).
+UploadJob = collections.namedtuple('UploadJob',
+        'path title parent_id mime_type size mtime drive_id check_existing remote_md5')
+
+# WorkerPool handler.  Records the outcome in the journal, if any,
+# and the file metadata in the local database when a session is
+# given.  With a dedup mode (which needs session and hashes), new
+# files are first looked for by content, see dedup_file.  Returns
+# the file id or None.
+def upload_job(service, job, journal=None, session=None, chunksize=None, store=None,
+               hashes=None, dedup=None):
+    if job.remote_md5:
+        if hashes:
+            md5 = hashes.md5(job.path)
+        else:
+            md5 = md5_file(job.path)
+        if md5 == job.remote_md5:
+            print("unchanged file:", job.path)
+            if journal:
+                journal.record(job.path, job.drive_id, False, job.size, job.mtime, dbjournal.STATUS_DONE)
+            return job.drive_id
+    if job.check_existing:
+        file, code, reason = gdrive.find_file(service, job.title, job.parent_id, 'id,fileSize')
+        if file and int(file.get('fileSize', -1)) == job.size:
+            print("found file:", job.title, "id:", file['id'], "in parent", job.parent_id)
+            if journal:
+                journal.record(job.path, file['id'], False, job.size, job.mtime, dbjournal.STATUS_DONE)
+            return file['id']
+    if dedup and not job.drive_id and job.size >= DEDUP_MIN_SIZE:
+        file_id = dedup_file(service, job, dedup, hashes, session)
+        if file_id:
+            if journal:
+                journal.record(job.path, file_id, False, job.size, job.mtime, dbjournal.STATUS_DONE)
+            return file_id
+    # the local database wants the whole metadata, the journal the id
+    fields = session and gdrive.METADATA_FIELDS or 'id'
+    file = upload_file(service, job, chunksize, store, fields)
+    if file and session:
+        dbhelper.save_file(file, session)
+    new_file_id = file and file['id']
+    if journal:
+        status = new_file_id and dbjournal.STATUS_DONE or dbjournal.STATUS_FAILED
+        journal.record(job.path, new_file_id, False, job.size, job.mtime, status)
+    return new_file_id
+
+# Run handler(service, job) and count the job and its bytes in the
+# stats as done or failed.
+def count_job(handler, service, job):
+    file_id = handler(service, job)
+    stats.default_stats.incr(file_id and "files_done" or "files_failed")
+    stats.default_stats.incr(file_id and "bytes_done" or "bytes_failed", job.size)
+    return file_id
+
+# Journal a list of jobs as pending, then run them on the pool or
+# with handler(service, job) on the calling thread.  The pending
+# entries are committed first so that after a crash every file that
+# may have reached Drive is checked before being uploaded again.
+def dispatch(service, jobs, pool, results, handler, journal=None):
+    if journal:
+        journal.record_many([(job.path, None, False, job.size, job.mtime, dbjournal.STATUS_PENDING)
+                for job in jobs])
+        journal.commit()
+    for job in jobs:
+        stats.default_stats.incr("files_queued")
+        stats.default_stats.incr("bytes_queued", job.size)
+        if pool:
+            pool.submit(job)
+        else:
+            results.add(job.path, handler(service, job))
+
+# Name under which a job is journaled
+def journal_name(rootdir, destroot):
+    return "%s -> %s" % (os.path.abspath(rootdir), destroot)
+
 # Walk a file tree and upload folders and files to new
 # destination in GDrive.  Requires full access to GDrive
 # scope ('https://www.googleapis.com/auth/drive')
-def upload_tree(service, rootdir, destroot):
+#
+# A scanner thread walks the local tree (see scan_tree) up to
+# SCAN_QUEUE_SIZE folders ahead, so stat calls and mimetype lookups
+# overlap with the uploads.  Folders are created on the calling
+# thread as the walk reaches them, so a folder always exists before
+# its children.  With
+# workers > 1, files are handed to a pool of upload threads as soon
+# as their parent id is known; each thread gets its own service
+# object from service_factory.
+#
+# With prefetch, every folder below the destination root is listed
+# once up front and existing folders are looked up in memory.
+#
+# With a journal (db.journal.Journal), every folder and file is
+# recorded as it is done.  Folders and unchanged files finished by
+# an earlier run of the same job are skipped without any request;
+# files that were in flight when that run stopped are looked up
+# before being uploaded again.
+#
+# The journal and the incremental metadata go through session, a
+# db.helper.Session committing in batches.
+#
+# With incremental, each file is compared with the metadata the
+# local database holds for a file of the same title in the same
+# folder (see stat_changed): unchanged files are skipped, changed
+# files get a new revision, and the metadata of every uploaded file
+# is saved so the next incremental run can compare against it.
+# Files that only their md5 can tell apart are hashed on the upload
+# threads through a db.hashcache.HashCache, so files unchanged since
+# they were last hashed are not read again.
+#
+# With dedup (DEDUP_LINK or DEDUP_COPY), a new file whose md5 matches
+# a file in the local metadata database (see sync_metadata) is
+# linked or copied on the server instead of uploaded.  Uploaded
+# files are saved to the database, so later copies in the same tree
+# are found as well.
+#
+# Returns a pool.Results with the number of files and the paths of
+# the failed ones; the journal has the id of each file.
+def upload_tree(service, rootdir, destroot, workers=1, service_factory=new_service_object,
+                prefetch=False, journal=None, incremental=False, session=None, chunksize=None,
+                dedup=None):
     init_mimetypes()
-    path_mapping = { }
-    title = map_mac_filename(destroot)
-    root_folder_id = find_or_create_folder(service, title)
-    path_mapping[rootdir] = root_folder_id
+    rootdir = os.path.abspath(rootdir)
+    owns_session = (incremental or dedup) and session is None
+    if owns_session:
+        session = dbhelper.Session()
+    metadata_session = None
+    hashes = None
+    if incremental or dedup:
+        metadata_session = session
+        hashes = dbhashcache.HashCache(session)
+    # journaled files, and the Drive ids of the folders created so far
+    entries = PathTree(rootdir)
+    path_mapping = PathTree(rootdir)
+    if journal:
+        for path, entry in journal.iter_entries():
+            drive_id, is_folder, size, mtime, status = entry
+            if not is_folder:
+                entries[path] = entry
+            elif status == dbjournal.STATUS_DONE:
+                path_mapping[path] = drive_id
+        print("journal has", len(entries) + len(path_mapping), "entries")
+    root_folder_id = path_mapping.get(rootdir)
+    if not root_folder_id:
+        title = map_mac_filename(destroot)
+        root_folder_id = find_or_create_folder(service, title)
+        path_mapping[rootdir] = root_folder_id
+        if journal:
+            journal.record_folder(rootdir, root_folder_id)
     print("root", destroot, "id:", root_folder_id)
-    for folder, subs, files in os.walk(rootdir):
-        parent, title = os.path.split(folder)
-        if title[0] == ".":
-            continue
-            
-        parent_id = None
-        try:
-            parent_id = path_mapping[folder]
-        except KeyError:
-            pass
-        if parent_id:
-            print("in folder:", folder)
-        else:
-            grandparent_id = None
-            try:
-                grandparent_id = path_mapping[parent]
-            except KeyError:
-                print("no path mapping for", folder)
-                raise
-            title = map_mac_filename(title)
-            parent_id = find_or_create_folder(service, title, grandparent_id)
-            if parent_id:
-                path_mapping[folder] = parent_id
+    index = None
+    if prefetch and root_folder_id:
+        index = build_folder_index(service, root_folder_id)
+        if index is not None:
+            print("indexed", len(index), "existing folders")
+    store = None
+    if journal:
+        store = dbuploads.UploadSessionStore(journal.session)
+    handler = functools.partial(count_job, functools.partial(upload_job, journal=journal,
+            session=metadata_session, chunksize=chunksize, store=store, hashes=hashes, dedup=dedup))
+    results = Results()
+    pool = None
+    if workers > 1:
+        pool = WorkerPool(service_factory, handler, workers,
+                on_result=lambda job, file_id: results.add(job.path, file_id))
+    jobs = [ ]
+    stats.default_stats.set("scanning", 1)
+    try:
+        for folder, subs, files in read_ahead(scan_tree(rootdir), SCAN_QUEUE_SIZE):
+            parent, title = os.path.split(folder)
+            if title[0] == ".":
+                continue
 
-        for dirname in subs:
-            folder_path = os.path.join(folder, dirname)
-            if dirname[0] == ".":
-                subs.remove(dirname)
+            parent_id = path_mapping.get(folder)
+            if parent_id:
+                print("in folder:", folder)
             else:
-                title = map_mac_filename(dirname)
-                folder_id = find_or_create_folder(service, title, parent_id)
+                grandparent_id = None
+                try:
+                    grandparent_id = path_mapping[parent]
+                except KeyError:
+                    print("no path mapping for", folder)
+                    raise
+                title = map_mac_filename(title)
+                parent_id = find_or_create_folder(service, title, grandparent_id, index)
+                if parent_id:
+                    path_mapping[folder] = parent_id
+                if journal:
+                    journal.record_folder(folder, parent_id)
+
+            new_subs = [dirname for dirname in subs
+                    if path_mapping.get_child(folder, dirname) is None]
+            titles = [map_mac_filename(dirname) for dirname in new_subs]
+            folder_ids = find_or_create_folders(service, titles, parent_id, index)
+            for dirname, title in zip(new_subs, titles):
+                folder_id = folder_ids[title]
                 if folder_id:
-                    path_mapping[folder_path] = folder_id
+                    path_mapping.set_child(folder, dirname, folder_id)
+                if journal:
+                    journal.record_folder(os.path.join(folder, dirname), folder_id)
 
-        for filename in files:
-            if filename[0] != ".":
-                file_path = os.path.join(folder, filename)
-                mt = get_file_mimetype(file_path)
+            for local in files:
+                file_path = local.path
+                st = local.st
+                entry = entries.get(file_path)
+                if entry and entry[4] == dbjournal.STATUS_DONE and \
+                        entry[2] == st.st_size and entry[3] == st.st_mtime:
+                    print("already uploaded:", file_path)
+                    results.add(file_path, entry[0])
+                    continue
+                mt = local.mime_type
                 if mt is None:
                     print("no mime type for", file_path, "; using octet-stream")
                     mt = 'application/octet-stream'
-                title = map_mac_filename(filename)
-                new_file_id = rate_limited_create_file(service, title, "", parent_id, mt, file_path)
-                if new_file_id:
-                    print("created file:", title, "in parent", parent_id)
-                else:
-                    print("failed to create file", title, "in parent", parent_id)
+                title = map_mac_filename(local.name)
+                # a journaled file that changed since it was uploaded
+                # gets a new revision
+                drive_id = None
+                if entry and entry[4] == dbjournal.STATUS_DONE:
+                    drive_id = entry[0]
+                remote_md5 = None
+                if incremental and parent_id:
+                    remote = dbhelper.find_file_by_parent(parent_id, title, metadata_session)
+                    if remote:
+                        changed = stat_changed(st, remote)
+                        if changed is False:
+                            print("unchanged file:", file_path)
+                            results.add(file_path, remote[0])
+                            continue
+                        drive_id = remote[0]
+                        if changed is None:
+                            remote_md5 = remote[2]
+                check_existing = entry is not None and entry[4] == dbjournal.STATUS_PENDING
+                job = UploadJob(file_path, title, parent_id, mt, st.st_size, st.st_mtime,
+                        drive_id, check_existing, remote_md5)
+                jobs.append(job)
+                if len(jobs) >= DISPATCH_BATCH:
+                    dispatch(service, jobs, pool, results, handler, journal)
+                    jobs = [ ]
+            dispatch(service, jobs, pool, results, handler, journal)
+            jobs = [ ]
+        stats.default_stats.set("scanning", 0)
+    finally:
+        if pool:
+            pool.join()
+        if owns_session:
+            session.close()
     # dump_missing_mimetypes()
+    return results
+
+def make_argparser():
+    """
+    ArgumentParser factory
+    """
+    parser = argparse.ArgumentParser(description="upload_tree: upload a local folder tree to google drive")
+
+    parser.add_argument("rootdir", help="local folder to upload", nargs="?")
+
+    parser.add_argument("destroot", help="title of the destination folder in google drive", nargs="?")
+
+    parser.add_argument("--workers", help="number of files to upload concurrently", type=int, default=1)
+
+    parser.add_argument("--prefetch", help="list all existing destination folders once instead of querying per folder", action="store_true")
+
+    parser.add_argument("--incremental", help="skip files unchanged since the last incremental run and update changed ones (uses local database)", action="store_true")
+
+    parser.add_argument("--resume", help="journal progress in the local database and skip work done by an earlier run", action="store_true")
+
+    parser.add_argument("--dedup", help="link (add a parent to) or copy files already in drive with the same md5 instead of uploading them (uses local database, see gdrive-cli --sync-metadata)",
+            choices=[DEDUP_LINK, DEDUP_COPY])
+
+    parser.add_argument("--chunk-size", help="initial chunk size in MiB for large files; adapts to the link speed", type=int)
+
+    parser.add_argument("--progress", help="show a progress line with throughput, queue depth, retries and ETA", action="store_true")
+
+    parser.add_argument("--stats-file", help="dump stats periodically: a prometheus textfile if the name ends in .prom, JSON lines otherwise", metavar="<path>")
+
+    parser.add_argument("--stats-interval", help="seconds between progress and stats reports", type=float, default=10.0)
+
+    parser.add_argument("--profile", help="print the number, time and bytes of the drive requests per API method at exit", action="store_true")
+
+    parser.add_argument("--trace-file", help="append one JSON line per drive request to a file", metavar="<path>")
+
+    parser.add_argument("--cprofile", help="profile the main thread with cProfile; '-' prints the report at exit, a path saves it for pstats", metavar="<path>")
+
+    parser.add_argument("--rate", help="limit the requests per second, starting at this rate and adapting to rate limit errors (default: no limit until the first rate limit error)", type=float)
+
+    parser.add_argument("--plan", help="dry run: write what the upload would do, with its number of requests and estimated duration, to a file without changing anything in drive (only --prefetch reads from drive)", metavar="<path>")
+
+    parser.add_argument("--execute", help="carry out a plan written with --plan instead of scanning rootdir (which then need not be given)", metavar="<path>")
+
+    parser.add_argument("--bandwidth", help="upload bandwidth in MiB/s for the estimate of --plan", type=float)
+
+    return parser
 
 if __name__ == "__main__":
-    authenticate('https://www.googleapis.com/auth/drive')
-    service = get_service_object()
-    upload_tree(service, '/Users/pz/Desktop/Test', 'Shared Folder')
+    parser = make_argparser()
+    args = parser.parse_args()
+    if args.execute:
+        import upload_plan
+        header = upload_plan.read_header(args.execute)
+        args.rootdir, args.destroot = header["root"], header["destroot"]
+    elif not args.rootdir or not args.destroot:
+        parser.error("rootdir and destroot are required")
+    retry.configure(rate=args.rate)
+    service = None
+    if not args.plan or args.prefetch:
+        authenticate('https://www.googleapis.com/auth/drive')
+        service = get_service_object()
+    session = None
+    journal = None
+    if args.resume or args.incremental or args.dedup or args.plan or args.execute:
+        session = dbhelper.Session()
+    if args.resume:
+        journal = dbjournal.Journal(journal_name(args.rootdir, args.destroot), session)
+    trace.setup(args.profile, args.trace_file, args.cprofile)
+    reporter = None
+    if args.progress or args.stats_file:
+        reporter = stats.Reporter(interval=args.stats_interval, progress=args.progress,
+                path=args.stats_file).start()
+    chunksize = args.chunk_size and args.chunk_size * 2**20
+    try:
+        if args.plan:
+            import upload_plan
+            with open(args.plan, "w") as out:
+                summary = upload_plan.plan_upload(service, args.rootdir, args.destroot, out,
+                        prefetch=args.prefetch, journal=journal, incremental=args.incremental,
+                        session=session, dedup=args.dedup, chunksize=chunksize,
+                        bandwidth=args.bandwidth and args.bandwidth * 2**20)
+            print(upload_plan.format_summary(summary))
+        elif args.execute:
+            upload_plan.execute_plan(service, args.execute, args.workers,
+                    service_factory=new_service_object, journal=journal,
+                    session=(header["incremental"] or header["dedup"]) and session or None,
+                    chunksize=chunksize)
+        else:
+            upload_tree(service, args.rootdir, args.destroot, args.workers, prefetch=args.prefetch,
+                    journal=journal, incremental=args.incremental, session=session,
+                    chunksize=chunksize, dedup=args.dedup)
+    finally:
+        if reporter:
+            reporter.stop()
+        trace.close()
+        if session:
+            session.close()